@@ -1,10 +1,11 @@
 import csv
 import logging
 import re
-import requests
+import threading
 
 from ricecooker.config import LOGGER
 
+from sheets import get_sheet_csv_path
 from structure import _clean_dict
 
 LOGGER.setLevel(logging.DEBUG)
@@ -40,16 +41,16 @@ PRADIGI_CORRECTIONS_ACTIONS = [SKIP_GAME_ACTION, ADD_MARGIN_TOP_ACTION]
 
 
 def download_corrections_csv():
-    response = requests.get(PRADIGI_CORRECTIONS_CSV_URL)
-    csv_data = response.content.decode('utf-8')
-    with open(PRADIGI_CORRECTIONS_CSV_PATH, 'w') as csvfile:
-        csvfile.write(csv_data)
-        LOGGER.info('Succesfully saved ' + PRADIGI_CORRECTIONS_CSV_PATH)
+    """
+    Returns the path of the local snapshot of the corrections sheet (downloaded
+    at most once per process, see sheets.py).
+    """
+    return get_sheet_csv_path(PRADIGI_CORRECTIONS_CSV_URL, PRADIGI_CORRECTIONS_CSV_PATH)
 
 def load_pradigi_corrections():
-    download_corrections_csv()
+    csv_path = download_corrections_csv()
     struct_list = []
-    with open(PRADIGI_CORRECTIONS_CSV_PATH, 'r') as csvfile:
+    with open(csv_path, 'r') as csvfile:
         reader = csv.DictReader(csvfile, fieldnames=PRADIGI_CORRECTIONS_CSV_FILEDNAMES)
         next(reader)  # Skip Headers row
         next(reader)  # Skip info line
@@ -72,7 +73,114 @@ def load_pradigi_corrections():
                 print('Unrecognized corrections row', clean_row)
     return struct_list
 
-PRADIGI_CORRECTIONS_LIST = load_pradigi_corrections()
+
+# COMPILED CORRECTIONS RULES
+################################################################################
+
+REPLACE_WITH_ACTION_PREFIX = 'REPLACE WITH:'
+
+
+def compile_action_pattern(rows):
+    """
+    Combine the URL patterns of the corrections `rows` into one pattern with a
+    named group for each row so a match tells which row fired (the first row
+    whose pattern matches, like checking the rows in order). Returns None if
+    the patterns can't be combined (e.g. they use backreferences).
+    """
+    pat_strs = [row[CORRECTIONS_SOURCE_URL_PAT_KEY].pattern for row in rows]
+    if not pat_strs or any(re.search(r'\\[1-9]|\(\?P=|\(\?P<', pat_str) for pat_str in pat_strs):
+        return None
+    combined_pat_str = '|'.join('(?P<rule{}>{})'.format(i, pat_str) for i, pat_str in enumerate(pat_strs))
+    try:
+        return re.compile(combined_pat_str)
+    except re.error:
+        return None
+
+
+class CorrectionsRules(object):
+    """
+    The corrections rows compiled into one combined pattern per action, with
+    the decisions for each URL memoized. Safe to use from multiple threads.
+    """
+
+    def __init__(self, corrections_list):
+        self.rows_by_action = {SKIP_GAME_ACTION: [], ADD_MARGIN_TOP_ACTION: [], REPLACE_WITH_ACTION_PREFIX: []}
+        for row in corrections_list:
+            action = row[CORRECTIONS_ACTION_KEY]
+            if action.startswith(REPLACE_WITH_ACTION_PREFIX):
+                action = REPLACE_WITH_ACTION_PREFIX
+            self.rows_by_action[action].append(row)
+        self.patterns = dict((action, compile_action_pattern(rows)) for action, rows in self.rows_by_action.items())
+        self._decisions = {}   # url --> decision dict
+        self._lock = threading.Lock()
+
+    def match_row(self, action, url):
+        """
+        Returns the first corrections row for `action` whose pattern matches `url`, or None.
+        """
+        rows = self.rows_by_action[action]
+        pat = self.patterns[action]
+        if pat is not None:
+            m = pat.match(url)
+            if m is None:
+                return None
+            for name, value in m.groupdict().items():
+                if value is not None:
+                    return rows[int(name.replace('rule', ''))]
+        for row in rows:
+            if row[CORRECTIONS_SOURCE_URL_PAT_KEY].match(url):
+                return row
+        return None
+
+    def classify(self, url):
+        """
+        Returns the corrections decisions for `url` as a dict with the keys:
+          - `skip`: True if the game must be skipped (SKIP GAME)
+          - `replace_with`: replacement url (REPLACE WITH:) or None
+          - `add_margin_top`: True if the game needs ADD MARGIN-TOP
+          - `correction_ids`: ids of the corrections rows that fired
+        """
+        with self._lock:
+            decision = self._decisions.get(url, None)
+        if decision is not None:
+            return decision
+        skip_row = self.match_row(SKIP_GAME_ACTION, url)
+        replace_row = self.match_row(REPLACE_WITH_ACTION_PREFIX, url)
+        margin_row = self.match_row(ADD_MARGIN_TOP_ACTION, url)
+        replace_with = None
+        if replace_row:
+            replace_with = replace_row[CORRECTIONS_ACTION_KEY].replace(REPLACE_WITH_ACTION_PREFIX, '').strip()
+        decision = dict(
+            skip=skip_row is not None,
+            replace_with=replace_with,
+            add_margin_top=margin_row is not None,
+            correction_ids=[row[CORRECTIONS_ID_KEY] for row in [skip_row, replace_row, margin_row] if row],
+        )
+        with self._lock:
+            self._decisions[url] = decision
+        return decision
+
+
+# the corrections sheet is loaded when first needed (not on import)
+_CORRECTIONS_RULES = None
+_CORRECTIONS_RULES_LOCK = threading.Lock()
+
+def get_corrections_rules():
+    """
+    Returns the CorrectionsRules compiled from the corrections sheet.
+    """
+    global _CORRECTIONS_RULES
+    with _CORRECTIONS_RULES_LOCK:
+        if _CORRECTIONS_RULES is None:
+            _CORRECTIONS_RULES = CorrectionsRules(load_pradigi_corrections())
+        return _CORRECTIONS_RULES
+
+
+def classify(url):
+    """
+    Returns the decisions of the corrections sheet for `url` (see `CorrectionsRules.classify`).
+    """
+    return get_corrections_rules().classify(url)
 
 
 def should_skip_file(url):
@@ -80,14 +188,7 @@ def should_skip_file(url):
     Checks `url` against list of SKIP GAME corrections.
     Returns True if `url` should be skipped, False otherwise
     """
-    should_skip = False
-    for row in PRADIGI_CORRECTIONS_LIST:
-        if row[CORRECTIONS_ACTION_KEY] == SKIP_GAME_ACTION:
-            pat = row[CORRECTIONS_SOURCE_URL_PAT_KEY]
-            m = pat.match(url)
-            if m:
-                should_skip = True
-    return should_skip
+    return classify(url)['skip']
 
 
 def should_replace_with(url):
@@ -95,14 +196,4 @@ def should_replace_with(url):
     Checks `url` against list of REPLACE WITH: corrections and returns the
     replaceement url if match found. Used to replace zips with manual fixes.
     """
-    for row in PRADIGI_CORRECTIONS_LIST:
-        action = row[CORRECTIONS_ACTION_KEY]
-        if action.startswith('REPLACE WITH:'):
-            pat = row[CORRECTIONS_SOURCE_URL_PAT_KEY]
-            m = pat.match(url)
-            if m:
-                replacement_url = action.replace('REPLACE WITH:', '')
-                return replacement_url.strip()
-    return None
-
-
+    return classify(url)['replace_with']
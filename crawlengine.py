@@ -0,0 +1,1172 @@
+import asyncio
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from basiccrawler.crawler import BasicCrawler, std_headers
+from bs4 import BeautifulSoup
+from ricecooker.config import LOGGER
+
+from crawlstats import CrawlStats
+from requestscheduler import RETRY_EXCEPTIONS
+from resourcecache import ResourceCache
+
+
+DEFAULT_MAX_IN_FLIGHT_PER_HOST = 1   # one request at a time = same as serial crawl
+DEFAULT_REQUEST_BUDGET = 8           # max concurrent requests across all crawlers
+DEFAULT_CHECKPOINT_INTERVAL = 300    # seconds between crawl checkpoints
+CRAWLED_PAGES_NAMESPACE = 'crawled_pages'
+HEAD_NAMESPACE = 'head'
+DETAIL_PAGE_MAX_AGE = 7*24*60*60     # revalidate detail pages resolved more than a week ago
+
+
+
+# GLOBAL REQUEST BUDGET
+################################################################################
+
+class RequestBudget(object):
+    """
+    Limits the total number of concurrent HTTP requests made by all the crawlers
+    that share this budget (e.g. the language crawls running in parallel threads)
+    so the origin server is not overloaded. Use as a context manager around each
+    request: `with budget: response = session.get(url)`.
+    """
+
+    def __init__(self, max_concurrent_requests=DEFAULT_REQUEST_BUDGET):
+        if max_concurrent_requests < 1:
+            raise ValueError('max_concurrent_requests must be at least 1')
+        self.max_concurrent_requests = max_concurrent_requests
+        self._semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
+        return False
+
+
+
+# CRAWL QUEUE WITH PREFETCHING
+################################################################################
+
+class FetchQueue(object):
+    """
+    FIFO queue of (url, context) crawl tasks that also keeps track of the fetch
+    task started for each url. Implements the `put`/`get`/`empty` interface that
+    `BasicCrawler.enqueue_url_and_context` and friends expect from `self.queue`.
+    If a `tree_writer` is given, it is told which subtrees have queued urls.
+    """
+
+    def __init__(self, tree_writer=None):
+        self.entries = deque()   # [url, context, fetch_task or None]
+        self.tree_writer = tree_writer
+
+    def put(self, url_and_context):
+        url, context = url_and_context
+        self.entries.append([url, context, None])
+        if self.tree_writer is not None:
+            self.tree_writer.add_pending(context['parent'])
+
+    def empty(self):
+        return len(self.entries) == 0
+
+    def get(self):
+        url, context, _ = self.get_entry()
+        return url, context
+
+    def get_entry(self):
+        return self.entries.popleft()
+
+    def start_fetches(self, start_fetch_fn, window):
+        """
+        Make sure the first `window` urls in the queue have a fetch task started.
+        """
+        for i, entry in enumerate(self.entries):
+            if i >= window:
+                break
+            if entry[2] is None:
+                entry[2] = start_fetch_fn(entry[0], entry[1])
+
+
+
+# ASYNC CRAWLER
+################################################################################
+
+class AsyncBasicCrawler(BasicCrawler):
+    """
+    BasicCrawler variant that fetches pages concurrently using asyncio.
+    Pages are downloaded ahead of time (up to `prefetch_window` urls at the head
+    of the queue, with at most `max_in_flight_per_host` requests to any host),
+    but handlers are always dispatched in queue order, so the web resource tree
+    produced is identical to the one produced by the serial BasicCrawler.crawl.
+    """
+    max_in_flight_per_host = DEFAULT_MAX_IN_FLIGHT_PER_HOST
+    prefetch_window = None   # defaults to 4 x max_in_flight_per_host
+    request_budget = None    # optional RequestBudget shared with other crawlers
+    request_scheduler = None # optional AdaptiveRequestScheduler (replaces request_budget)
+    PAGE_PARSER = 'html.parser'  # BeautifulSoup parser backend
+    kind_parse_only = {}     # kind --> SoupStrainer for the part of the page handler uses
+    raw_kinds = set()        # kinds of pages whose handler gets the html text (not parsed)
+    incremental = False      # use conditional GETs and replay unchanged pages
+    page_store = None        # ResourceCache of crawled pages (for incremental mode)
+    no_replay_kinds = set()  # kinds of pages whose handler results depend on other pages
+    CHECKPOINT_OUTPUT = None # defaults to CRAWLING_STAGE_OUTPUT with _checkpoint suffix
+    checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL   # 0 = no checkpoints
+    resource_index = None    # optional ResourceIndex shared with other crawlers
+    stream_output = False    # write finished subtrees to output as crawl progresses
+    stream_interval = 50     # pages processed between streaming output writes
+    CRAWL_REPORT_OUTPUT = None  # defaults to CRAWLING_STAGE_OUTPUT with _crawl_report suffix
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crawl_stats = CrawlStats()   # timings, bytes, and cache hits of this crawler
+
+    def crawl(self, limit=1000, save_web_resource_tree=True, devmode=True,
+              max_in_flight_per_host=None, prefetch_window=None, request_budget=None,
+              incremental=None, checkpoint_interval=None, resume=False,
+              resource_index=None, stream_output=None, request_scheduler=None):
+        """
+        Crawl the website starting from START_PAGE. Every `checkpoint_interval`
+        seconds the crawl frontier and the partial tree are saved to a checkpoint
+        file; use `resume=True` to continue from the last checkpoint (if any).
+        Crawlers that share a `resource_index` make HEAD requests for each URL
+        only once per run. Use `stream_output=True` to write the tree to the
+        output file while crawling instead of keeping it all in memory
+        (in this case checkpoints are not saved and the tree is not returned).
+        """
+        if stream_output is not None:
+            self.stream_output = stream_output
+        if request_scheduler is not None:
+            self.request_scheduler = request_scheduler
+        if resource_index is not None:
+            self.resource_index = resource_index
+        if checkpoint_interval is not None:
+            self.checkpoint_interval = checkpoint_interval
+        if request_budget is not None:
+            self.request_budget = request_budget
+        if incremental is not None:
+            self.incremental = incremental
+        if self.incremental and self.page_store is None:
+            self.page_store = ResourceCache(namespace=CRAWLED_PAGES_NAMESPACE)
+        if max_in_flight_per_host is not None:
+            self.max_in_flight_per_host = int(max_in_flight_per_host)
+        if self.max_in_flight_per_host < 1:
+            raise ValueError('max_in_flight_per_host must be at least 1')
+        if prefetch_window is not None:
+            self.prefetch_window = int(prefetch_window)
+        if self.prefetch_window is None:
+            self.prefetch_window = 4 * self.max_in_flight_per_host
+        return asyncio.run(self.crawl_async(limit=limit,
+                                            save_web_resource_tree=save_web_resource_tree,
+                                            devmode=devmode,
+                                            resume=resume))
+
+    async def crawl_async(self, limit=1000, save_web_resource_tree=True, devmode=True,
+                          resume=False):
+        # initialize or reset crawler state
+        start_time = time.time()
+        self.tree_writer = None
+        if self.stream_output and save_web_resource_tree:
+            if resume:
+                raise ValueError('Cannot resume a crawl when using streaming output')
+            self.tree_writer = self.make_tree_writer()
+        self.queue = FetchQueue(tree_writer=self.tree_writer)
+        self.global_urls_seen_count = defaultdict(int)
+        self.urls_visited = {}
+        self.page_effects = {}                 # original_url --> effects of handler
+        self.incremental_stats = Counter()     # unchanged / changed / new pages
+        self._enqueued = None
+
+        checkpoint = self.load_checkpoint() if resume else None
+        if checkpoint is not None:
+            channel_dict, counter = self.restore_checkpoint(checkpoint)
+            LOGGER.info('Resuming crawl of %s from checkpoint: %d pages done, %d urls in queue' % (
+                self.START_PAGE, counter, len(self.queue.entries)))
+        else:
+            #  add the start page to the crawling queue
+            channel_dict = dict(
+                url='This is a temp. outer container for the crawler channel tree.'
+                    'Its unique child node is the web root.',
+                kind='WEB_RESOURCE_TREE_CONTAINER',
+                children=[],
+            )
+            root_context = {'parent': channel_dict}
+            if self.START_PAGE_CONTEXT:
+                root_context.update(self.START_PAGE_CONTEXT)
+            self.enqueue_url_and_context(self.START_PAGE, root_context)
+            counter = 0
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.prefetch_window)
+        host_semaphores = {}
+
+        async def fetch(url, context):
+            host = urlparse(url).netloc
+            if host not in host_semaphores:
+                host_semaphores[host] = asyncio.Semaphore(self.max_in_flight_per_host)
+            async with host_semaphores[host]:
+                return await loop.run_in_executor(executor, self.fetch_url, url, context)
+
+        def start_fetch(url, context):
+            return asyncio.ensure_future(fetch(url, context))
+
+        last_checkpoint_time = time.time()
+        num_processed = 0
+        try:
+            while not self.queue_is_empty():
+                if self.tree_writer is not None:
+                    if num_processed % self.stream_interval == 0:
+                        self.stream_tree_output(channel_dict)
+                elif self.checkpoint_interval and time.time() - last_checkpoint_time > self.checkpoint_interval:
+                    self.save_checkpoint(channel_dict, counter)
+                    last_checkpoint_time = time.time()
+                self.queue.start_fetches(start_fetch, self.prefetch_window)
+
+                # 1. GET next url to crawl, its context dict, and the fetch results
+                original_url, context, fetch_task = self.queue.get_entry()
+                num_processed += 1
+                try:
+                    fetched = await fetch_task
+                    url, page = fetched['url'], fetched['page']
+
+                    # 2. Media files (PDF/ZIP/MP3) and broken link check
+                    if fetched['verdict'] == True:
+                        media_rsrc_dict = self.create_media_url_dict(original_url, fetched['head_response'])
+                        media_rsrc_dict['parent'] = context['parent']
+                        context['parent']['children'].append(media_rsrc_dict)
+                        continue
+
+                    # 3. Unchanged page in incremental mode: replay previous handler results
+                    if fetched['replay'] is not None:
+                        self.urls_visited[original_url] = 'visited'
+                        if url != original_url:
+                            context['original_url'] = original_url
+                        self.replay_page(original_url, context, fetched)
+                        counter += 1
+                        if limit and counter > limit:
+                            break
+                        continue
+
+                    # 4. Page downloaded by fetch task
+                    if page is None:
+                        LOGGER.warning('GET ' + original_url + ' did not return page.')
+                        broken_link_dict = self.create_broken_link_url_dict(original_url)
+                        broken_link_dict['parent'] = context['parent']
+                        context['parent']['children'].append(broken_link_dict)
+                        continue
+
+                    # record page URL as visited
+                    self.urls_visited[original_url] = 'visited'
+
+                    # annotate context to keep track of URL befor redirects
+                    if url != original_url:
+                        context['original_url'] = original_url
+
+                    if self.incremental:
+                        self.dispatch_and_record(original_url, url, page, context, fetched)
+                    else:
+                        self.dispatch_to_handler(url, page, context)
+
+                    # limit crawling to 1000 pages unless otherwise told (failsafe default)
+                    counter += 1
+                    if limit and counter > limit:
+                        break
+                finally:
+                    if self.tree_writer is not None:
+                        self.tree_writer.remove_pending(context['parent'])
+        finally:
+            for url, context, fetch_task in self.queue.entries:
+                if fetch_task is not None:
+                    fetch_task.cancel()
+            executor.shutdown(wait=True)
+
+        self.flush_pending_resources()
+        self.on_crawl_done(channel_dict)
+        if self.incremental:
+            self.save_page_effects()
+            self.log_incremental_stats()
+        self.remove_checkpoint()
+        if save_web_resource_tree:
+            self.write_crawl_report(wall_time_s=round(time.time() - start_time, 3), pages=counter)
+
+        if self.tree_writer is not None:
+            # write the rest of the tree; nodes already written are not in memory anymore
+            self.stream_tree_output(channel_dict)
+            self.tree_writer.finish()
+            LOGGER.info('Saved web resource tree to ' + self.tree_writer.path)
+            return None
+
+        # remove parent links before output tree
+        self.cleanup_web_resource_tree(channel_dict)
+
+        # hoist entire tree one level up to get rid of the tmep. outer container
+        channel_dict = channel_dict['children'][0]
+
+        # Save output
+        if save_web_resource_tree:
+            self.write_web_resource_tree_json(channel_dict)
+
+        # Display debug info
+        if devmode:
+            self.print_crawler_devmode(channel_dict)
+
+        return channel_dict
+
+
+    def make_request(self, url, *args, **kwargs):
+        """
+        Extend base request helper to record the request in `crawl_stats`.
+        """
+        method = kwargs.get('method', 'GET')
+        with self.crawl_stats.timer('http ' + method) as info:
+            response = self.send_request(url, *args, **kwargs)
+            self.record_response(info, method, response)
+        return response
+
+    def send_request(self, url, *args, **kwargs):
+        """
+        Make request through the adaptive request scheduler, or wait for a slot
+        in the shared request budget.
+        """
+        if self.request_scheduler is not None:
+            return self.make_scheduled_request(url, *args, **kwargs)
+        if self.request_budget is None:
+            return super().make_request(url, *args, **kwargs)
+        return self.make_budgeted_request(url, *args, **kwargs)
+
+    def make_budgeted_request(self, url, timeout=60, *args, method='GET', **kwargs):
+        """
+        Same as the base class `make_request`, but a slot in the shared request
+        budget is held only while the request is in flight, not during the wait
+        before a retry, so failing requests don't hold up the other requests.
+        """
+        retry_count = 0
+        max_retries = 10
+        while True:
+            try:
+                kwargs['headers'] = std_headers  # set random user-agent headers
+                with self.request_budget:
+                    response = self.SESSION.request(method, url, *args, timeout=timeout, **kwargs)
+                break
+            except RETRY_EXCEPTIONS as e:
+                retry_count += 1
+                LOGGER.warning("Connection error ('{msg}'); about to perform retry {count} of {trymax}."
+                               .format(msg=str(e), count=retry_count, trymax=max_retries))
+                if retry_count >= max_retries:
+                    LOGGER.error('FAILED TO RETRIEVE: ' + str(url))
+                    return None
+                time.sleep(retry_count * 1)
+            except Exception as e:
+                LOGGER.error('FAILED TO RETRIEVE: ' + str(url))
+                LOGGER.error('GOT ERROR: ' + str(e))
+                return None
+        if response.status_code != 200:
+            LOGGER.error('ERROR ' + str(response.status_code) + ' when getting url=' + url)
+            return None
+        return response
+
+    def make_scheduled_request(self, url, timeout=60, *args, method='GET', headers=None,
+                               allowed_status_codes=(200,), **kwargs):
+        """
+        Make request using `request_scheduler`, which adapts the number of concurrent
+        requests to the server health and retries failed requests with backoff.
+        Returns the response if its status code is allowed, otherwise None.
+        """
+        if headers is None:
+            headers = std_headers   # set random user-agent headers
+        send_fn = lambda: self.SESSION.request(method, url, *args, headers=headers,
+                                               timeout=timeout, **kwargs)
+        try:
+            response = self.request_scheduler.run(send_fn, description=method + ' ' + url)
+        except RETRY_EXCEPTIONS as e:
+            LOGGER.error('FAILED TO RETRIEVE: %s (%s)' % (url, e))
+            return None
+        except Exception as e:
+            LOGGER.error('FAILED TO RETRIEVE: %s' % url)
+            LOGGER.error('GOT ERROR: ' + str(e))
+            return None
+        if response.status_code not in allowed_status_codes:
+            LOGGER.error('ERROR ' + str(response.status_code) + ' when getting url=' + url)
+            return None
+        return response
+
+    def record_response(self, info, method, response):
+        """
+        Set the `crawl_stats` timer `info` for `response` and record whether it
+        came from the local web cache.
+        """
+        if response is None:
+            info['error'] = True
+            return
+        if method != 'HEAD':
+            info['bytes'] = len(response.content)
+        self.crawl_stats.record_cache('webcache', getattr(response, 'from_cache', False))
+
+
+    def is_media_file(self, url):
+        """
+        Extend base method to reuse the HEAD results of other crawlers that share
+        the `resource_index` (e.g. the same zip file linked from several languages).
+        """
+        if self.resource_index is None:
+            return super().is_media_file(url)
+        return self.resource_index.get_or_resolve(HEAD_NAMESPACE, url, super().is_media_file)
+
+
+    def on_crawl_done(self, channel_dict):
+        """
+        Called when all pages have been processed, before the tree is cleaned up
+        and saved. Subclasses can override to add metadata to the tree.
+        """
+        pass
+
+    def flush_pending_resources(self):
+        """
+        Called before the web resources in the tree are saved (checkpoints,
+        streaming output, and end of crawl). Subclasses can override to finalize
+        pending work on the web resources already added to the tree.
+        """
+        pass
+
+
+    def make_conditional_request(self, url, method='HEAD', etag=None, last_modified=None,
+                                 timeout=60, max_retries=3, no_cache=False):
+        """
+        Make a `method` request for `url` that sends If-None-Match/If-Modified-Since
+        headers for the given `etag`/`last_modified` validators. Use `no_cache=True`
+        to make sure the request reaches the server instead of the local web cache.
+        Returns the response for status codes 200 and 304, otherwise None.
+        """
+        with self.crawl_stats.timer('http conditional ' + method) as info:
+            response = self.send_conditional_request(url, method=method, etag=etag,
+                                                     last_modified=last_modified, timeout=timeout,
+                                                     max_retries=max_retries, no_cache=no_cache)
+            self.record_response(info, method, response)
+            if response is not None:
+                self.crawl_stats.record_cache('conditional ' + method, response.status_code == 304)
+        return response
+
+    def send_conditional_request(self, url, method='HEAD', etag=None, last_modified=None,
+                                 timeout=60, max_retries=3, no_cache=False):
+        headers = dict(std_headers)
+        if no_cache:
+            headers['Cache-Control'] = 'no-cache'
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if self.request_scheduler is not None:
+            return self.make_scheduled_request(url, timeout, method=method, headers=headers,
+                                               allowed_status_codes=(200, 304))
+        retry_count = 0
+        while True:
+            try:
+                if self.request_budget is None:
+                    response = self.SESSION.request(method, url, headers=headers, timeout=timeout)
+                else:
+                    with self.request_budget:
+                        response = self.SESSION.request(method, url, headers=headers, timeout=timeout)
+                break
+            except RETRY_EXCEPTIONS as e:
+                retry_count += 1
+                if retry_count >= max_retries:
+                    LOGGER.error('FAILED TO RETRIEVE: %s (%s)' % (url, e))
+                    return None
+                time.sleep(retry_count * 1)
+        if response.status_code not in [200, 304]:
+            LOGGER.error('ERROR ' + str(response.status_code) + ' when getting url=' + url)
+            return None
+        return response
+
+
+    def download_page(self, url, context=None):
+        """
+        Download `url` (following redirects) and parse the response contents using
+        `parse_page` so only the parts of the page needed by the handler are kept.
+        Returns (final_url, page) where final_url is URL afrer following redirects.
+        """
+        response = self.make_request(url)
+        if not response:
+            return (None, None)
+        response.encoding = 'utf-8'
+        page = self.parse_page(response.text, context)
+        return (response.url, page)
+
+    def parse_page(self, html, context=None):
+        """
+        Parse `html` using the `PAGE_PARSER` backend. If `kind_parse_only` has a
+        SoupStrainer for the kind of page in `context`, only the matching elements
+        are added to the tree, which is much faster than parsing the whole page.
+        Pages of `raw_kinds` are not parsed: `html` is returned as is.
+        """
+        parse_only = None
+        if context is not None:
+            parse_only = self.kind_parse_only.get(context.get('kind', None), None)
+        kind = context.get('kind', 'page') if context is not None else 'page'
+        if kind in self.raw_kinds:
+            return html
+        with self.crawl_stats.timer('parse ' + kind):
+            return BeautifulSoup(html, self.PAGE_PARSER, parse_only=parse_only)
+
+
+    def fetch_url(self, original_url, context=None):
+        """
+        Runs in executor thread: HEAD check for media files then GET the page.
+        Returns a dict with the keys `verdict`, `head_response`, `url`, `page`,
+        and, in incremental mode, `replay` (previous page entry if unchanged)
+        and `validators` (etag, last-modified, and body hash of the page).
+        """
+        fetched = dict(verdict=False, head_response=None, url=None, page=None,
+                       replay=None, validators=None, previous=None)
+        previous = self.page_store.get(original_url) if self.incremental else None
+        if previous is None:
+            # only new urls can be media files since stored entries are all pages
+            verdict, head_response = self.is_media_file(original_url)
+            fetched.update(verdict=verdict, head_response=head_response)
+            if verdict == True:
+                return fetched
+        if self.incremental:
+            return self.fetch_page_incremental(original_url, context, previous, fetched)
+        url, page = self.download_page(original_url, context)
+        fetched.update(url=url, page=page)
+        return fetched
+
+
+    # INCREMENTAL RECRAWL
+    ############################################################################
+    #
+    # In incremental mode every page is requested with If-None-Match/If-Modified-Since
+    # using the validators saved in `page_store` during the previous crawl. For each
+    # page we also save the handler's effects: the page dicts it added to the tree,
+    # the children it attached to them directly, and the urls+contexts it enqueued.
+    # When a page is unchanged (304, or same body hash) the saved effects are
+    # replayed instead of parsing the page and calling the handler. Pages of the
+    # kinds in `no_replay_kinds` are always handled again since their handler
+    # results also depend on other pages (e.g. detail pages resolved by the handler).
+
+    def fetch_page_incremental(self, original_url, context, previous, fetched):
+        replayable = previous is not None
+        if context is not None and context.get('kind', None) in self.no_replay_kinds:
+            replayable = False
+        etag = previous.get('etag') if replayable else None
+        last_modified = previous.get('last-modified') if replayable else None
+        response = self.make_conditional_request(original_url, method='GET', etag=etag,
+                                                 last_modified=last_modified, no_cache=True)
+        fetched['previous'] = previous
+        if response is None:
+            return fetched
+        if response.status_code == 304 and replayable:
+            fetched.update(url=previous['url'], replay=previous)
+            return fetched
+        response.encoding = 'utf-8'
+        validators = {'etag': response.headers.get('etag', None),
+                      'last-modified': response.headers.get('last-modified', None),
+                      'body_hash': hashlib.sha1(response.content).hexdigest()}
+        fetched.update(url=response.url, validators=validators)
+        if replayable and previous.get('body_hash') == validators['body_hash']:
+            fetched['replay'] = previous
+            return fetched
+        fetched['page'] = self.parse_page(response.text, context)
+        return fetched
+
+    def enqueue_url_and_context(self, url, context, force=False):
+        if self._enqueued is not None:
+            # save a copy of the context as it is now since handlers can modify it later
+            saved_context = _without_parent_links(dict((key, val) for key, val in context.items() if key != 'parent'))
+            self._enqueued.append((url, context, saved_context, force))
+        if not self.should_crawl(url, context):
+            return
+        super().enqueue_url_and_context(url, context, force=force)
+
+    def should_crawl(self, url, context):
+        """
+        Returns False to skip the crawl of `url` even though a handler enqueued it.
+        Called after the link is recorded in the page effects so the incremental
+        page store is the same whether or not links are skipped.
+        """
+        return True
+
+    def dispatch_and_record(self, original_url, url, page, context, fetched):
+        """
+        Call the handler and keep track of its effects so they can be saved.
+        """
+        parent_children = context['parent']['children']
+        num_children_before = len(parent_children)
+        self._enqueued = []
+        try:
+            self.dispatch_to_handler(url, page, context)
+            enqueued = self._enqueued
+        finally:
+            self._enqueued = None
+        page_dicts = parent_children[num_children_before:]
+        self.page_effects[original_url] = dict(
+            url=url,
+            context_keys=list(context.keys()),
+            page_dicts=page_dicts,
+            direct_children=[list(page_dict['children']) for page_dict in page_dicts],
+            enqueued=enqueued,
+            validators=fetched['validators'],
+            previous=fetched['previous'],
+        )
+
+    def replay_page(self, original_url, context, fetched):
+        """
+        Reproduce the effects of the handler saved in the `fetched['replay']` entry.
+        """
+        with self.crawl_stats.timer('replay ' + context.get('kind', 'page')):
+            self.replay_page_effects(original_url, context, fetched)
+        self.incremental_stats['unchanged'] += 1
+
+    def replay_page_effects(self, original_url, context, fetched):
+        entry = fetched['replay']
+        page_dicts = []
+        for saved_page in entry['pages']:
+            page_dict = copy.deepcopy(saved_page['record'])
+            page_dict['children'] = []
+            page_dict.update(context)
+            page_dict['children'].extend(copy.deepcopy(saved_page['children']))
+            context['parent']['children'].append(page_dict)
+            page_dicts.append(page_dict)
+        for saved_enqueued in entry['enqueued']:
+            child_context = copy.deepcopy(saved_enqueued['context'])
+            child_context['parent'] = page_dicts[saved_enqueued['parent_index']]
+            self.enqueue_url_and_context(saved_enqueued['url'], child_context,
+                                         force=saved_enqueued['force'])
+        validators = fetched['validators']
+        if validators and any(entry.get(key) != val for key, val in validators.items()):
+            new_entry = dict(entry)
+            new_entry.update(validators)
+            self.page_store.set(original_url, new_entry)
+
+    def save_page_effects(self):
+        """
+        Save the effects of the handlers called since last save in `page_store`.
+        """
+        for original_url, effects in self.page_effects.items():
+            context_keys = set(effects['context_keys'])
+            saved_pages = []
+            for page_dict, direct_children in zip(effects['page_dicts'], effects['direct_children']):
+                record = dict((key, val) for key, val in page_dict.items()
+                              if key not in context_keys and key not in ['children', 'parent'])
+                saved_pages.append(dict(
+                    record=record,
+                    children=[_without_parent_links(child) for child in direct_children],
+                ))
+            saved_enqueued = []
+            for url, context, saved_context, force in effects['enqueued']:
+                parent_index = None
+                for i, page_dict in enumerate(effects['page_dicts']):
+                    if context.get('parent') is page_dict:
+                        parent_index = i
+                if parent_index is None:
+                    saved_pages = None   # enqueued with unknown parent, so can't replay
+                    break
+                saved_enqueued.append(dict(url=url, context=saved_context,
+                                           parent_index=parent_index, force=force))
+            if saved_pages is None:
+                continue
+            fingerprint_data = json.dumps([saved_pages, saved_enqueued], ensure_ascii=False, sort_keys=True)
+            entry = dict(
+                url=effects['url'],
+                pages=saved_pages,
+                enqueued=saved_enqueued,
+                fingerprint=hashlib.sha1(fingerprint_data.encode('utf-8')).hexdigest(),
+            )
+            entry.update(effects['validators'] or {})
+            previous = effects['previous']
+            if previous is None:
+                self.incremental_stats['new'] += 1
+            elif previous.get('fingerprint') != entry['fingerprint']:
+                self.incremental_stats['changed'] += 1
+            else:
+                self.incremental_stats['unchanged'] += 1
+            self.page_store.set(original_url, entry)
+        self.page_effects = {}
+
+    def log_incremental_stats(self):
+        LOGGER.info('Incremental crawl of %s: %d unchanged, %d changed, %d new pages' % (
+            self.START_PAGE, self.incremental_stats['unchanged'],
+            self.incremental_stats['changed'], self.incremental_stats['new']))
+
+
+    # STREAMING OUTPUT
+    ############################################################################
+
+    def make_tree_writer(self):
+        """
+        Returns the StreamingTreeWriter used to write the output when `stream_output`
+        is set. Subclasses can override to transform the tree while writing it.
+        """
+        return StreamingTreeWriter(self.CRAWLING_STAGE_OUTPUT)
+
+    def stream_tree_output(self, channel_dict):
+        """
+        Write the subtrees that are finished to the output file and free them.
+        """
+        self.flush_pending_resources()
+        if self.incremental:
+            self.save_page_effects()
+        if self.tree_writer.root is None:
+            if not channel_dict['children']:
+                return
+            # the output tree is the web root (the unique child of the outer container)
+            self.tree_writer.start(channel_dict['children'][0])
+        self.tree_writer.advance()
+
+
+    # CRAWL REPORT
+    ############################################################################
+
+    def get_crawl_report_path(self):
+        if self.CRAWL_REPORT_OUTPUT:
+            return self.CRAWL_REPORT_OUTPUT
+        root, ext = os.path.splitext(self.CRAWLING_STAGE_OUTPUT)
+        return root + '_crawl_report' + ext
+
+    def write_crawl_report(self, **extra):
+        """
+        Write the `crawl_stats` of this crawl and the crawl options to the report
+        file next to the web resource tree (see `crawlstats.py` to compare reports).
+        """
+        report_path = self.get_crawl_report_path()
+        options = dict(
+            max_in_flight_per_host=self.max_in_flight_per_host,
+            prefetch_window=self.prefetch_window,
+            incremental=self.incremental,
+            stream_output=self.stream_output,
+            request_scheduler=self.request_scheduler is not None,
+            request_budget=self.request_budget.max_concurrent_requests if self.request_budget else None,
+        )
+        self.crawl_stats.write_report(report_path, start_page=self.START_PAGE, options=options,
+                                      urls_visited=len(self.urls_visited),
+                                      incremental_stats=self.incremental_stats, **extra)
+        LOGGER.info('Saved crawl report to ' + report_path)
+
+
+    # CHECKPOINTS
+    ############################################################################
+    #
+    # The checkpoint file contains the partial web resource tree, the crawl queue
+    # (urls and contexts), and the crawl-only-once bookkeeping. Since tree nodes
+    # and contexts link to their parent node, the tree is saved as a list of nodes
+    # in depth-first order and the `parent` links are saved as node indices.
+
+    def get_checkpoint_path(self):
+        if self.CHECKPOINT_OUTPUT:
+            return self.CHECKPOINT_OUTPUT
+        root, ext = os.path.splitext(self.CRAWLING_STAGE_OUTPUT)
+        return root + '_checkpoint' + ext
+
+    def save_checkpoint(self, channel_dict, counter):
+        """
+        Save the crawl state to the checkpoint file (atomically).
+        """
+        self.flush_pending_resources()
+        if self.incremental:
+            self.save_page_effects()
+        nodes = []
+        node_indices = {}   # id(node) --> index in nodes
+        def add_node(node):
+            node_indices[id(node)] = len(nodes)
+            nodes.append(node)
+            for child in node.get('children', []):
+                add_node(child)
+        add_node(channel_dict)
+        def parent_index(parent):
+            if id(parent) not in node_indices:
+                raise ValueError('Found parent link to node that is not in the tree')
+            return node_indices[id(parent)]
+        saved_nodes = []
+        for node in nodes:
+            data = dict((key, val) for key, val in node.items() if key not in ['children', 'parent'])
+            saved_node = dict(data=data, num_children=len(node.get('children', [])))
+            if 'parent' in node:
+                saved_node['parent'] = parent_index(node['parent'])
+            saved_nodes.append(saved_node)
+        saved_queue = []
+        for url, context, _ in self.queue.entries:
+            saved_context = dict((key, val) for key, val in context.items() if key != 'parent')
+            saved_queue.append(dict(url=url, context=saved_context, parent=parent_index(context['parent'])))
+        checkpoint = dict(
+            start_page=self.START_PAGE,
+            nodes=saved_nodes,
+            queue=saved_queue,
+            global_urls_seen_count=self.global_urls_seen_count,
+            urls_visited=self.urls_visited,
+            counter=counter,
+            incremental_stats=self.incremental_stats,
+        )
+        checkpoint_path = self.get_checkpoint_path()
+        dirname = os.path.dirname(checkpoint_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, ensure_ascii=False)
+        os.replace(tmp_path, checkpoint_path)
+        LOGGER.info('Saved crawl checkpoint for %s: %d pages done, %d urls in queue' % (
+            self.START_PAGE, counter, len(saved_queue)))
+
+    def load_checkpoint(self):
+        """
+        Returns the checkpoint dict saved for this crawler, or None if not found.
+        """
+        checkpoint_path = self.get_checkpoint_path()
+        if not os.path.exists(checkpoint_path):
+            LOGGER.info('No crawl checkpoint found in %s, starting from scratch' % checkpoint_path)
+            return None
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint['start_page'] != self.START_PAGE:
+            raise ValueError('Checkpoint %s is for a different start page' % checkpoint_path)
+        return checkpoint
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        Restore crawler state from `checkpoint` and returns (channel_dict, counter).
+        """
+        nodes = []
+        for saved_node in checkpoint['nodes']:
+            node = dict(saved_node['data'])
+            node['children'] = []
+            if 'parent' in saved_node:
+                node['parent'] = nodes[saved_node['parent']]
+            nodes.append(node)
+        # children come right after their parent (depth-first order)
+        def link_children(index):
+            node = nodes[index]
+            next_index = index + 1
+            for i in range(checkpoint['nodes'][index]['num_children']):
+                node['children'].append(nodes[next_index])
+                next_index = link_children(next_index)
+            return next_index
+        link_children(0)
+        for saved_entry in checkpoint['queue']:
+            context = dict(saved_entry['context'])
+            context['parent'] = nodes[saved_entry['parent']]
+            self.queue.put((saved_entry['url'], context))
+        self.global_urls_seen_count = defaultdict(int, checkpoint['global_urls_seen_count'])
+        self.urls_visited = checkpoint['urls_visited']
+        self.incremental_stats = Counter(checkpoint['incremental_stats'])
+        return nodes[0], checkpoint['counter']
+
+    def remove_checkpoint(self):
+        checkpoint_path = self.get_checkpoint_path()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+
+    def dispatch_to_handler(self, url, page, context):
+        """
+        Call the handler registered in `kind_handlers` for `context['kind']`,
+        falling back to the default `on_page` handler.
+        """
+        handler_fn = self.on_page
+        if 'kind' in context:
+            kind = context['kind']
+            if kind in self.kind_handlers:
+                handler = self.kind_handlers[kind]
+                if callable(handler):
+                    handler_fn = handler
+                elif isinstance(handler, str) and hasattr(self, handler):
+                    handler_fn = getattr(self, handler)
+                else:
+                    raise ValueError('Unrecognized handler type', handler, 'Should be method or name of method.')
+            else:
+                LOGGER.info('No handler registered for kind ' + str(kind)
+                            + ' so falling back to on_page handler.')
+        handler_name = getattr(handler_fn, '__name__', str(context.get('kind')))
+        with self.crawl_stats.timer('handler ' + handler_name):
+            handler_fn(url, page, context)
+
+
+
+# STREAMING TREE WRITER
+################################################################################
+
+class StreamingTreeWriter(object):
+    """
+    Writes a web resource tree to `path` while it is being crawled, producing the
+    same output as `json.dump(tree, indent=2, sort_keys=True)` in the end.
+    The crawler tells the writer about the urls in the queue (`add_pending`) and
+    the urls processed (`remove_pending`), so the writer knows which subtrees
+    are finished: a subtree is finished when no queued url will add to it.
+    Finished subtrees are written in document order and removed from memory.
+    Nodes that are not finished yet but whose position in the output is known
+    are written in two parts: the keys that come before `children` when opened,
+    and the keys after `children` when closed.
+
+    Subclasses can transform the tree while writing it by overriding
+    `transforms_children` and `transform_child`, e.g. to replace nodes by their
+    only child; the decision is made once the child subtree is finished.
+    """
+    INDENT = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.subtree_pending = {}   # id(node) --> num of queued urls that add to subtree
+        self.root = None
+        self.stack = []             # open nodes (see `open_node`)
+        self.file = None
+
+    def add_pending(self, node):
+        while node is not None:
+            self.subtree_pending[id(node)] = self.subtree_pending.get(id(node), 0) + 1
+            node = node.get('parent', None)
+
+    def remove_pending(self, node):
+        while node is not None:
+            count = self.subtree_pending[id(node)] - 1
+            if count == 0:
+                del self.subtree_pending[id(node)]
+            else:
+                self.subtree_pending[id(node)] = count
+            node = node.get('parent', None)
+
+    def is_finished(self, node):
+        return id(node) not in self.subtree_pending
+
+
+    # HOOKS
+    ############################################################################
+
+    def transforms_children(self, node, parent_transforms):
+        """
+        Returns True if `transform_child` must be applied to the children of
+        `node`, where `parent_transforms` is the value for its parent node
+        (True for the root of the tree).
+        """
+        return False
+
+    def transform_child(self, child):
+        """
+        Returns the node to write in place of the finished subtree `child`,
+        or None to leave it out of the output.
+        """
+        return child
+
+    def may_transform_child(self, child):
+        """
+        Returns True if `transform_child` could replace or remove `child` once
+        it is finished, which means it can't be written until then.
+        """
+        return True
+
+
+    # WRITING
+    ############################################################################
+
+    def start(self, root):
+        parent_dir = os.path.dirname(self.path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        self.file = open(self.tmp_path, 'w')
+        self.root = root
+        self.open_node(root, self.transforms_children(root, True), 0)
+
+    def advance(self, finish=False):
+        """
+        Write all the nodes that can be written now, in document order.
+        """
+        while self.stack:
+            frame = self.stack[-1]
+            node, children = frame['node'], frame['node']['children']
+            if frame['next'] < len(children):
+                child = children[frame['next']]
+                if finish or self.is_finished(child):
+                    if frame['transforms']:
+                        child = self.transform_child(child)
+                    if child is not None:
+                        transforms = self.transforms_children(child, frame['transforms'])
+                        self.write_child(frame, self.clean_subtree(child, transforms))
+                    children[frame['next']] = None   # free memory
+                    frame['next'] += 1
+                elif not frame['transforms'] or not self.may_transform_child(child):
+                    self.write_child(frame, None)
+                    self.open_node(child, self.transforms_children(child, frame['transforms']),
+                                   frame['indent'] + 2*self.INDENT)
+                else:
+                    break
+            elif finish or (node is not self.root and self.is_finished(node)):
+                self.close_node(frame)
+                self.stack.pop()
+                if self.stack:
+                    children = self.stack[-1]['node']['children']
+                    children[self.stack[-1]['next']] = None
+                    self.stack[-1]['next'] += 1
+            else:
+                break
+
+    def finish(self):
+        """
+        Write everything left (including the keys of the root added at the end)
+        and move the output file into place.
+        """
+        if self.root is None:
+            raise ValueError('Cannot write empty web resource tree')
+        self.advance(finish=True)
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def dumps_value(self, value, indent):
+        data = json.dumps(value, ensure_ascii=False, indent=self.INDENT, sort_keys=True)
+        return data.replace('\n', '\n' + ' '*indent)
+
+    def clean_subtree(self, node, transforms):
+        """
+        Returns a copy of the finished subtree `node` without parent links and
+        with `transform_child` applied to the children if `transforms` is True.
+        """
+        cleaned = dict((key, val) for key, val in node.items() if key not in ['parent', 'children'])
+        if 'children' in node:
+            children = node['children']
+            if transforms:
+                children = [child for child in map(self.transform_child, children) if child is not None]
+            cleaned['children'] = [self.clean_subtree(child, self.transforms_children(child, transforms))
+                                   for child in children]
+        return cleaned
+
+    def write_child(self, frame, subtree):
+        """
+        Write the separator before the next child of the open node in `frame`
+        followed by the `subtree` dict (if given).
+        """
+        child_indent = frame['indent'] + 2*self.INDENT
+        separator = '\n' if frame['num_written'] == 0 else ',\n'
+        self.file.write(separator + ' '*child_indent)
+        if subtree is not None:
+            self.file.write(self.dumps_value(subtree, child_indent))
+        frame['num_written'] += 1
+
+    def open_node(self, node, transforms, indent):
+        pad = ' '*(indent + self.INDENT)
+        self.file.write('{')
+        for key in sorted(key for key in node.keys() if key < 'children' and key != 'parent'):
+            self.file.write('\n' + pad + self.dumps_value(key, 0) + ': ' +
+                            self.dumps_value(node[key], indent + self.INDENT) + ',')
+        self.file.write('\n' + pad + '"children": [')
+        self.stack.append(dict(node=node, transforms=transforms, indent=indent, next=0, num_written=0))
+
+    def close_node(self, frame):
+        node, indent = frame['node'], frame['indent']
+        pad = ' '*(indent + self.INDENT)
+        self.file.write(']' if frame['num_written'] == 0 else '\n' + pad + ']')
+        for key in sorted(key for key in node.keys() if key > 'children' and key != 'parent'):
+            self.file.write(',\n' + pad + self.dumps_value(key, 0) + ': ' +
+                            self.dumps_value(node[key], indent + self.INDENT))
+        self.file.write('\n' + ' '*indent + '}')
+
+
+
+# DETAIL PAGE RESOLUTION
+################################################################################
+
+class DetailPageResolver(object):
+    """
+    Resolves the URLs found on resource detail pages (pages that are not crawled
+    themselves but must be visited to find where the resource actually lives).
+    All the detail pages of a listing page are fetched concurrently through the
+    crawler's `fetch_fn` (which uses the crawler's cached session), and the
+    results of `extract_fn(html)` are saved in `cache` along with the `etag` and
+    `last-modified` validators of the page. Entries older than `max_age` seconds
+    are revalidated with a conditional GET (re-extracted unless the page is
+    unchanged), so fresh entries skip the GET in later runs.
+    If a `resource_index` is shared by several crawlers, each detail page is
+    fetched only once per run even when crawlers ask for it at the same time.
+    Cache hits and misses are recorded in `stats` (a CrawlStats) if given.
+    """
+
+    def __init__(self, fetch_fn, extract_fn, cache=None, max_workers=4,
+                 resource_index=None, namespace='detail_pages', stats=None,
+                 max_age=DETAIL_PAGE_MAX_AGE):
+        self.fetch_fn = fetch_fn    # fetch_fn(url, etag=, last_modified=) --> response (200 or 304)
+        self.extract_fn = extract_fn
+        self.cache = cache
+        self.max_workers = max_workers
+        self.resource_index = resource_index
+        self.namespace = namespace
+        self.stats = stats
+        self.max_age = max_age
+
+    def is_stale(self, entry):
+        return entry is None or time.time() - entry.get('checked', 0) > self.max_age
+
+    def resolve_all(self, urls):
+        """
+        Returns dict {url: resolved} where `resolved` is the dict returned by
+        `extract_fn` with an extra key `url` (the detail page URL after redirects),
+        or None if the detail page could not be fetched.
+        """
+        results = {}
+        urls_to_fetch = []
+        old_entries = []
+        for url in urls:
+            if url in results or url in urls_to_fetch:
+                continue
+            cached = self.cache.get(url) if self.cache is not None else None
+            if self.stats is not None:
+                self.stats.record_cache(self.namespace, not self.is_stale(cached))
+            if not self.is_stale(cached):
+                results[url] = cached
+            else:
+                urls_to_fetch.append(url)
+                old_entries.append(cached)
+        if urls_to_fetch:
+            max_workers = min(self.max_workers, len(urls_to_fetch))
+            resolve_fn = self.resolve if self.resource_index is None else self.resolve_once
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for url, resolved in zip(urls_to_fetch, executor.map(resolve_fn, urls_to_fetch, old_entries)):
+                    results[url] = resolved
+        return results
+
+    def resolve_once(self, url, entry=None):
+        return self.resource_index.get_or_resolve(
+            self.namespace, url, lambda url: self.resolve(url, entry))
+
+    def resolve(self, url, entry=None):
+        """
+        GET the detail page `url` (conditional if there is a previous `entry`)
+        and returns the resolved dict. Keeps using `entry` if the GET fails.
+        """
+        etag = entry.get('etag') if entry else None
+        last_modified = entry.get('last-modified') if entry else None
+        try:
+            response = self.fetch_fn(url, etag=etag, last_modified=last_modified)
+        except Exception as e:
+            LOGGER.error('DetailPageResolver failed to GET %s: %s' % (url, e))
+            response = None
+        if not response:
+            return entry
+        if self.stats is not None and entry is not None:
+            self.stats.record_cache(self.namespace + ' revalidation', response.status_code == 304)
+        if response.status_code == 304 and entry is not None:
+            resolved = dict(entry)
+        else:
+            response.encoding = 'utf-8'
+            resolved = self.extract_fn(response.text)
+            resolved['url'] = response.url
+            resolved['etag'] = response.headers.get('etag', None)
+            resolved['last-modified'] = response.headers.get('last-modified', None)
+        resolved['checked'] = time.time()
+        if self.cache is not None:
+            self.cache.set(url, resolved)
+        return resolved
+
+
+def _without_parent_links(web_resource):
+    """
+    Returns a deep copy of `web_resource` dict without the `parent` references.
+    """
+    copied = dict((key, val) for key, val in web_resource.items() if key != 'parent')
+    if 'children' in copied:
+        copied['children'] = [_without_parent_links(child) for child in copied['children']]
+    return copy.deepcopy(copied)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Instrumentation of the crawl: call counts, latency histograms, bytes transferred
+and cache hit/miss rates. Each crawl writes a JSON report next to its web
+resource tree output. To compare the reports of two runs, use:
+
+    ./crawlstats.py chefdata/old/pradigi_hi_crawl_report.json chefdata/trees/pradigi_hi_crawl_report.json
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+
+# upper bounds of the latency histogram buckets (in ms)
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+
+# CRAWL STATS
+################################################################################
+
+class CrawlStats(object):
+    """
+    Thread-safe collector of per-operation timings and per-cache hit/miss counts.
+    Operations are named, e.g. `handler on_lesson_page`, `http GET`, `parse lesson_page`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}    # name --> dict(count, total_s, max_s, bytes, errors, histogram)
+        self.caches = {}        # name --> dict(hits, misses)
+
+    def record(self, name, seconds, num_bytes=0, error=False):
+        """
+        Record one call of operation `name` that took `seconds`.
+        """
+        bucket = len(LATENCY_BUCKETS_MS)
+        for i, upper_bound in enumerate(LATENCY_BUCKETS_MS):
+            if seconds*1000 <= upper_bound:
+                bucket = i
+                break
+        with self._lock:
+            if name not in self.operations:
+                self.operations[name] = dict(count=0, total_s=0.0, max_s=0.0, bytes=0, errors=0,
+                                             histogram=[0]*(len(LATENCY_BUCKETS_MS) + 1))
+            op = self.operations[name]
+            op['count'] += 1
+            op['total_s'] += seconds
+            op['max_s'] = max(op['max_s'], seconds)
+            op['bytes'] += num_bytes
+            op['errors'] += 1 if error else 0
+            op['histogram'][bucket] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time the code in the `with` block as one call of operation `name`.
+        The block can set `info['bytes']` and `info['error']` on the yielded dict.
+        An exception raised in the block is recorded as an error.
+        """
+        info = dict(bytes=0, error=False)
+        start_time = time.perf_counter()
+        try:
+            yield info
+        except Exception:
+            info['error'] = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start_time,
+                        num_bytes=info['bytes'], error=info['error'])
+
+    def record_cache(self, name, hit):
+        with self._lock:
+            if name not in self.caches:
+                self.caches[name] = dict(hits=0, misses=0)
+            self.caches[name]['hits' if hit else 'misses'] += 1
+
+    def to_dict(self):
+        """
+        Returns the stats in the format of the JSON report.
+        """
+        bucket_labels = ['<=%dms' % ub for ub in LATENCY_BUCKETS_MS] + ['>%dms' % LATENCY_BUCKETS_MS[-1]]
+        with self._lock:
+            operations = {}
+            for name, op in self.operations.items():
+                operations[name] = dict(
+                    count=op['count'],
+                    total_s=round(op['total_s'], 3),
+                    mean_ms=round(1000*op['total_s']/op['count'], 3),
+                    max_ms=round(1000*op['max_s'], 3),
+                    bytes=op['bytes'],
+                    errors=op['errors'],
+                    latency_histogram=[[label, n] for label, n in zip(bucket_labels, op['histogram']) if n],
+                )
+            caches = {}
+            for name, cache in self.caches.items():
+                total = cache['hits'] + cache['misses']
+                caches[name] = dict(cache, hit_rate=round(cache['hits']/total, 4) if total else None)
+        return dict(operations=operations, caches=caches)
+
+    def write_report(self, path, **extra):
+        """
+        Write the JSON report to `path` with the `extra` keys added to it.
+        """
+        report = self.to_dict()
+        report.update(extra)
+        parent_dir = os.path.dirname(path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+
+# COMPARE REPORTS
+################################################################################
+
+def compare_reports(old_path, new_path):
+    """
+    Print the operation counts, total times, and cache hit rates of two crawl
+    reports side by side.
+    """
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+    print('wall time: {:.1f}s --> {:.1f}s'.format(old.get('wall_time_s', 0), new.get('wall_time_s', 0)))
+    print('{:<40}{:>14}{:>24}{:>24}'.format('operation', 'count', 'total (s)', 'mean (ms)'))
+    for name in sorted(set(old['operations']) | set(new['operations'])):
+        old_op = old['operations'].get(name, dict(count=0, total_s=0, mean_ms=0))
+        new_op = new['operations'].get(name, dict(count=0, total_s=0, mean_ms=0))
+        print('{:<40}{:>8} --> {:<6}{:>10.2f} --> {:<10.2f}{:>9.1f} --> {:<9.1f}'.format(
+            name, old_op['count'], new_op['count'], old_op['total_s'], new_op['total_s'],
+            old_op['mean_ms'], new_op['mean_ms']))
+    print('{:<40}{:>17}'.format('cache', 'hit rate'))
+    for name in sorted(set(old['caches']) | set(new['caches'])):
+        old_rate = old['caches'].get(name, {}).get('hit_rate', None)
+        new_rate = new['caches'].get(name, {}).get('hit_rate', None)
+        print('{:<40}{:>12} --> {}'.format(name, str(old_rate), str(new_rate)))
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare two crawl reports')
+    parser.add_argument('old_report')
+    parser.add_argument('new_report')
+    args = parser.parse_args()
+    compare_reports(args.old_report, args.new_report)
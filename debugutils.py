@@ -7,8 +7,10 @@ from urllib.parse import urlparse
 from le_utils.constants.languages import getlang_by_name
 
 from sushichef import load_pradigi_structure, find_games_for_lang, get_all_game_names
-from sushichef import should_skip_file
+from sushichef import get_website_game_index
+from sushichef import should_skip_file, get_video_size_bytes
 from sushichef import PRADIGI_WEBSITE_LANGUAGES, PRADIGI_STRINGS
+from resourcecatalog import ResourceCatalog
 
 
 
@@ -66,6 +68,19 @@ def compute_games_by_language_csv(game_names):
     return languages_matches
 
 
+def print_game_near_misses():
+    """
+    Print the website games with names similar to the game names in the
+    structure CSV that are not matched by `find_games_for_lang`.
+    """
+    website_game_index = get_website_game_index()
+    for game_name in get_all_game_names():
+        for lang in PRADIGI_WEBSITE_LANGUAGES:
+            for game in website_game_index.find_near_misses(game_name, lang):
+                print('Skipped game', game['title_en'], 'even though similar to', game_name,
+                      'in lang', lang, game['url'])
+
+
 def flatten_tree(tree):
     if len(tree['children'])==0:
         return [tree]
@@ -170,31 +185,31 @@ def new_find_undocumented_games():
 ################################################################################
 
 
-def find_large_video_files(tree, parent):
-    if tree['kind'] == 'PrathamVideoResource':
-        url_p = urlparse(tree['url'])
+def find_large_video_files(entry):
+    if entry['kind'] == 'PrathamVideoResource':
+        url_p = urlparse(entry['url'])
         filename = os.path.basename(url_p.path)
-        if 'content-length' in tree:
-            size_bytes = tree['content-length']
+        size_bytes = get_video_size_bytes(entry['node'])
+        if size_bytes is not None:
             size_mb = int(size_bytes)/1024/1024
             if size_mb > 100:
-                print('Large video file' + '\t' + filename + '\t'+ tree['url'] + \
-                    '\t' + parent['url'] + '\t' + 'File size is %.2fMB, so not good for web' % size_mb)
+                print('Large video file' + '\t' + filename + '\t'+ entry['url'] + \
+                    '\t' + entry['parent_url'] + '\t' + 'File size is %.2fMB, so not good for web' % size_mb)
         else:
-            print('404 video file' + '\t' + filename + '\t' + tree['url'] + '\t' + parent['url'])
+            print('404 video file' + '\t' + filename + '\t' + entry['url'] + '\t' + entry['parent_url'])
 
 
 
 
-def find_missing_zip_resources(tree, parent):
-    if tree['kind'] == 'PrathamZipResource':
-        url = tree['url']
+def find_missing_zip_resources(entry):
+    if entry['kind'] == 'PrathamZipResource':
+        url = entry['url']
         url_p = urlparse(url)
         filename = os.path.basename(url_p.path)
         
         resp = requests.head(url)
         if resp.status_code == 404:
-            print('404 zip file' + '\t' + filename + '\t' + url + '\t' + parent['url'])
+            print('404 zip file' + '\t' + filename + '\t' + url + '\t' + entry['parent_url'])
 
 
 
@@ -204,11 +219,34 @@ def walk_tree(tree, parent={'url':None}, el_fn=lambda x: x):
         walk_tree(child, parent=tree, el_fn=el_fn)
 
 
+_VADER_RESOURCE_CATALOG = None
+
+def get_vader_resource_catalog():
+    """
+    Returns the resource catalog of the trees in `chefdata/vader/trees/` (opened
+    when first needed).
+    """
+    global _VADER_RESOURCE_CATALOG
+    if _VADER_RESOURCE_CATALOG is None:
+        _VADER_RESOURCE_CATALOG = ResourceCatalog(path='chefdata/vader/resource_catalog.sqlite',
+                                                  tree_path_tmpl='chefdata/vader/trees/pradigi_{}_web_resource_tree.json')
+    return _VADER_RESOURCE_CATALOG
+
 def find_problem_resources_files():
+    catalog = get_vader_resource_catalog()
     for lang in ['hi', 'mr']:
-        wrt_filename = 'chefdata/vader/trees/pradigi_{}_web_resource_tree.json'.format(lang)
-        with open(wrt_filename) as jsonfile:
-            web_resource_tree = json.load(jsonfile)
-            # walk_tree(web_resource_tree, el_fn=find_large_video_files)
-            walk_tree(web_resource_tree, el_fn=find_missing_zip_resources)
+        catalog.sync(lang)
+        # for entry in catalog.find(lang=lang, kind='PrathamVideoResource'):
+        #     find_large_video_files(entry)
+        for entry in catalog.find(lang=lang, kind='PrathamZipResource'):
+            find_missing_zip_resources(entry)
+
 
+def find_shared_zip_files():
+    """
+    Print the zip files used in more than one language.
+    """
+    catalog = get_vader_resource_catalog()
+    catalog.sync_all()
+    for url, langs in catalog.find_shared_urls(kind='PrathamZipResource'):
+        print('Shared zip file' + '\t' + url + '\t' + ','.join(langs))
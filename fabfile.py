@@ -31,7 +31,6 @@ CORRECTIONS_CACHE_FILENAME = 'pradigi_corrections.csv'
 WEBSITE_GAMES_JSON_FILENAME = 'website_games_all_langs.json'
 CRAWLING_STAGE_OUTPUT_TMPL = 'pradigi_{}_web_resource_tree.json'
 SCRAPING_STAGE_OUTPUT = 'pradigi_ricecooker_json_tree.json'
-from sushichef import PRADIGI_WEBSITE_LANGUAGES
 
 
 
@@ -58,6 +57,7 @@ def get_trees(langs='all'):
     trees_dir = os.path.join(CHEF_DATA_DIR, 'chefdata', 'trees')
     local_dir = os.path.join('chefdata', 'vader', 'trees')
     if langs == 'all':
+        from sushichef import PRADIGI_WEBSITE_LANGUAGES   # slow import, only when needed
         langs = PRADIGI_WEBSITE_LANGUAGES
     # crawling trees
     for lang in langs:
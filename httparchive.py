@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Record/replay archive of HTTP responses used to run the chef offline, e.g. to
+time the `pre_run` pipeline before and after a code change on the same inputs.
+
+Record every response seen by the crawlers, the zip file downloads, and the
+structure and corrections CSV downloads, then replay them without network:
+
+    PRADIGI_HTTP_ARCHIVE=record ./sushichef.py -v --token=<your_token> crawlonly=t
+    PRADIGI_HTTP_ARCHIVE=replay ./sushichef.py -v --token=<your_token> crawlonly=t
+
+Set PRADIGI_HTTP_ARCHIVE_LATENCY to a number of seconds (or to `recorded`) to
+add simulated latency to each replayed response, and PRADIGI_HTTP_ARCHIVE_PATH
+to use a different archive file. Use `./httparchive.py summary` to see what
+an archive contains.
+"""
+from collections import Counter
+from datetime import timedelta
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from ricecooker.config import LOGGER
+
+
+HTTP_ARCHIVE_PATH = 'chefdata/http_archive.sqlite'
+HTTP_ARCHIVE_MODES = ['record', 'replay']
+VALIDATOR_HEADERS = ['If-None-Match', 'If-Modified-Since']   # part of the request key
+REPLAY_DROP_HEADERS = ['content-encoding', 'transfer-encoding']  # bodies are stored decoded
+
+
+
+# HTTP ARCHIVE
+################################################################################
+
+class HTTPArchive(object):
+    """
+    Compact sqlite archive of HTTP responses (zlib-compressed bodies) keyed by
+    request method, URL, and conditional request headers.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path=HTTP_ARCHIVE_PATH):
+        self.path = path
+        parent_dir, _ = os.path.split(path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        self.stats = Counter()   # recorded, replayed, and missing requests
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                '  key TEXT PRIMARY KEY,'
+                '  url TEXT NOT NULL,'
+                '  status INTEGER NOT NULL,'
+                '  reason TEXT,'
+                '  headers TEXT NOT NULL,'
+                '  body BLOB NOT NULL,'
+                '  elapsed REAL NOT NULL)'
+            )
+            self._conn.commit()
+
+    def get_key(self, request):
+        """
+        Returns the archive key for the PreparedRequest `request`.
+        """
+        key = request.method + ' ' + request.url
+        for header in VALIDATOR_HEADERS:
+            value = request.headers.get(header, None)
+            if value:
+                key += ' ' + header + '=' + value
+        return key
+
+    def record(self, request, response, elapsed):
+        """
+        Save `response` (received in `elapsed` seconds) for `request`.
+        """
+        headers = json.dumps(list(response.headers.items()), ensure_ascii=False)
+        body = zlib.compress(response.content or b'')
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, url, status, reason, headers, body, elapsed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.get_key(request), response.url, response.status_code, response.reason,
+                 headers, body, elapsed))
+            self._conn.commit()
+            self.stats['recorded'] += 1
+
+    def lookup(self, request):
+        """
+        Returns (response, elapsed) saved for `request`, or (None, None) if not found.
+        Conditional requests fall back to the response of the unconditional request.
+        """
+        keys = [self.get_key(request), request.method + ' ' + request.url]
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute(
+                    'SELECT url, status, reason, headers, body, elapsed FROM responses WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None:
+                    break
+            self.stats['replayed' if row is not None else 'missing'] += 1
+        if row is None:
+            return None, None
+        url, status, reason, headers, body, elapsed = row
+        response = requests.models.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(
+            (name, value) for name, value in json.loads(headers) if name.lower() not in REPLAY_DROP_HEADERS)
+        response._content = zlib.decompress(body)
+        response.raw = io.BytesIO(response._content)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = url
+        response.request = request
+        response.elapsed = timedelta(seconds=elapsed)
+        return response, elapsed
+
+    def summary(self):
+        """
+        Returns a list of (host, number of responses, compressed bytes) tuples.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT url, length(body) FROM responses').fetchall()
+        counts, sizes = Counter(), Counter()
+        for url, size in rows:
+            host = urlparse(url).netloc
+            counts[host] += 1
+            sizes[host] += size
+        return [(host, counts[host], sizes[host]) for host in sorted(counts)]
+
+    def reopen(self):
+        """
+        Use a new connection to the archive, e.g. in a forked worker process
+        which must not use the connection of its parent (kept open, unused).
+        """
+        with self._lock:
+            self._parent_conn = self._conn
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+
+# RECORD/REPLAY OF ALL REQUESTS
+################################################################################
+#
+# Every request made with `requests` (module functions like `requests.get`,
+# the crawler sessions, and the ricecooker download helpers) goes through
+# `requests.Session.send`, above the local web cache adapters, so this is where
+# the archive is installed.
+
+_original_send = None
+_installed_archive = None
+
+
+def install(archive, mode, latency=0.0):
+    """
+    Route all requests through `archive`: in `record` mode the responses are
+    saved, in `replay` mode they are served from the archive (404 if missing)
+    after sleeping `latency` seconds, or the recorded time if `latency='recorded'`.
+    """
+    global _original_send, _installed_archive
+    if mode not in HTTP_ARCHIVE_MODES:
+        raise ValueError('HTTP archive mode must be one of ' + str(HTTP_ARCHIVE_MODES))
+    if _original_send is not None:
+        raise ValueError('HTTP archive already installed')
+    _original_send = original_send = requests.Session.send
+
+    def record_send(session, request, **kwargs):
+        start_time = time.perf_counter()
+        response = original_send(session, request, **kwargs)
+        archive.record(request, response, time.perf_counter() - start_time)
+        return response
+
+    def replay_send(session, request, **kwargs):
+        response, elapsed = archive.lookup(request)
+        if response is None:
+            LOGGER.warning('Not in HTTP archive: %s %s' % (request.method, request.url))
+            response = requests.models.Response()
+            response.status_code = 404
+            response.reason = 'Not in HTTP archive'
+            response._content = b''
+            response.url = request.url
+            response.request = request
+            return response
+        delay = elapsed if latency == 'recorded' else latency
+        if delay:
+            time.sleep(delay)
+        return response
+
+    requests.Session.send = record_send if mode == 'record' else replay_send
+    _installed_archive = archive
+    LOGGER.info('HTTP archive %s: %s mode' % (archive.path, mode))
+
+
+def uninstall():
+    global _original_send, _installed_archive
+    if _original_send is not None:
+        requests.Session.send = _original_send
+        _original_send = None
+        _installed_archive = None
+
+
+def get_installed_archive():
+    return _installed_archive
+
+
+def install_from_environment():
+    """
+    Install the HTTP archive if the PRADIGI_HTTP_ARCHIVE environment variable
+    is set to `record` or `replay`. Returns the archive or None.
+    Must be called before importing the modules that download the structure
+    and corrections CSVs when they are imported. Calling it again is a no-op.
+    """
+    mode = os.environ.get('PRADIGI_HTTP_ARCHIVE', None)
+    if not mode or _installed_archive is not None:
+        return _installed_archive
+    path = os.environ.get('PRADIGI_HTTP_ARCHIVE_PATH', HTTP_ARCHIVE_PATH)
+    latency = os.environ.get('PRADIGI_HTTP_ARCHIVE_LATENCY', '0')
+    if latency != 'recorded':
+        latency = float(latency)
+    archive = HTTPArchive(path)
+    install(archive, mode, latency=latency)
+    return archive
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the contents of an HTTP archive')
+    parser.add_argument('command', choices=['summary'])
+    parser.add_argument('--path', default=HTTP_ARCHIVE_PATH, help='archive file')
+    args = parser.parse_args()
+    archive = HTTPArchive(args.path)
+    total_count, total_size = 0, 0
+    print('{:<40}{:>12}{:>16}'.format('host', 'responses', 'bytes (zlib)'))
+    for host, count, size in archive.summary():
+        print('{:<40}{:>12}{:>16}'.format(host, count, size))
+        total_count += count
+        total_size += size
+    print('{:<40}{:>12}{:>16}'.format('total', total_count, total_size))
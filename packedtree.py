@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Compact binary format for web resource trees that can be memory-mapped and
+read lazily: opening a packed tree doesn't parse anything, nodes and strings
+are decoded only when accessed, and processes that open the same file share
+one copy of it in the OS page cache.
+
+    ./packedtree.py pack chefdata/trees/pradigi_hi_web_resource_tree.json
+    ./packedtree.py export chefdata/trees/pradigi_hi_web_resource_tree.wrtb out.json
+    ./packedtree.py info chefdata/trees/pradigi_hi_web_resource_tree.wrtb
+
+File layout (all integers are little-endian uint32):
+  - header: magic, version, num_nodes, num_attrs, num_strings
+  - nodes: (attr_start, attr_count, child_start, child_count) for each node in
+    breadth-first order, so the children of each node are consecutive
+    (child_start is NO_CHILDREN for nodes without a `children` list)
+  - attrs: (key_string, value_tag, value) for each key of each node except `children`
+  - string offsets: num_strings + 1 offsets in the string data
+  - string data: all distinct keys and values in UTF-8
+"""
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+PACKED_TREE_MAGIC = b'WRTB'
+PACKED_TREE_VERSION = 1
+PACKED_TREE_EXT = '.wrtb'
+HEADER = struct.Struct('<4sIIII')
+NODE = struct.Struct('<IIII')
+ATTR = struct.Struct('<III')
+OFFSET = struct.Struct('<I')
+OFFSET_PAIR = struct.Struct('<II')
+# attribute value tags
+TAG_STR = 0     # value is string index
+TAG_NULL = 1    # value is unused
+TAG_JSON = 2    # value is string index of JSON-encoded value (numbers, lists, ...)
+NO_CHILDREN = 0xFFFFFFFF   # child_start of nodes without `children` key
+
+
+
+# WRITE
+################################################################################
+
+def write_packed_tree(tree, path):
+    """
+    Write the web resource `tree` (nested dicts with `children` lists) to `path`
+    in the packed format (atomically).
+    """
+    strings = {}   # string --> index
+    def string_index(string):
+        if string not in strings:
+            strings[string] = len(strings)
+        return strings[string]
+
+    nodes, attrs = array('I'), array('I')
+    queue = [tree]
+    next_child = 1   # index of the first child of the next node in breadth-first order
+    for node in queue:   # queue grows while iterating
+        children = node.get('children', [])
+        keys = sorted(key for key in node.keys() if key != 'children')
+        child_start = next_child if 'children' in node else NO_CHILDREN
+        nodes.extend([len(attrs) // 3, len(keys), child_start, len(children)])
+        for key in keys:
+            value = node[key]
+            if isinstance(value, str):
+                attrs.extend([string_index(key), TAG_STR, string_index(value)])
+            elif value is None:
+                attrs.extend([string_index(key), TAG_NULL, 0])
+            else:
+                attrs.extend([string_index(key), TAG_JSON, string_index(json.dumps(value))])
+        queue.extend(children)
+        next_child += len(children)
+
+    string_data = bytearray()
+    offsets = array('I', [0])
+    for string in strings:   # in order of index
+        string_data.extend(string.encode('utf-8'))
+        offsets.append(len(string_data))
+    if sys.byteorder != 'little':
+        nodes.byteswap()
+        attrs.byteswap()
+        offsets.byteswap()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as packed_file:
+        packed_file.write(HEADER.pack(PACKED_TREE_MAGIC, PACKED_TREE_VERSION,
+                                      len(queue), len(attrs) // 3, len(strings)))
+        packed_file.write(nodes.tobytes())
+        packed_file.write(attrs.tobytes())
+        packed_file.write(offsets.tobytes())
+        packed_file.write(string_data)
+    os.replace(tmp_path, path)
+
+
+def pack_json_tree(json_path, packed_path=None):
+    """
+    Convert the JSON web resource tree in `json_path` to the packed format.
+    Returns the path of the packed tree (same name with PACKED_TREE_EXT by default).
+    """
+    if packed_path is None:
+        packed_path = os.path.splitext(json_path)[0] + PACKED_TREE_EXT
+    with open(json_path) as jsonfile:
+        tree = json.load(jsonfile)
+    write_packed_tree(tree, packed_path)
+    return packed_path
+
+
+
+# READ
+################################################################################
+
+class PackedTree(object):
+    """
+    Read-only memory-mapped packed web resource tree. Use `root` to get the
+    lazy accessor for the root node.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as packed_file:
+            self._mm = mmap.mmap(packed_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_nodes, self.num_attrs, self.num_strings = HEADER.unpack_from(self._mm, 0)
+        if magic != PACKED_TREE_MAGIC or version != PACKED_TREE_VERSION:
+            raise ValueError('Not a packed web resource tree (version %d): %s' % (PACKED_TREE_VERSION, path))
+        self._nodes_start = HEADER.size
+        self._attrs_start = self._nodes_start + self.num_nodes * NODE.size
+        self._offsets_start = self._attrs_start + self.num_attrs * ATTR.size
+        self._strings_start = self._offsets_start + (self.num_strings + 1) * OFFSET.size
+        self._string_cache = {}
+
+    @property
+    def root(self):
+        return PackedNode(self, 0)
+
+    def node(self, index):
+        return PackedNode(self, index)
+
+    def get_string(self, index):
+        try:
+            return self._string_cache[index]
+        except KeyError:
+            start, end = OFFSET_PAIR.unpack_from(self._mm, self._offsets_start + index * OFFSET.size)
+            string = self._mm[self._strings_start + start:self._strings_start + end].decode('utf-8')
+            self._string_cache[index] = string
+            return string
+
+    def get_node_record(self, index):
+        if not 0 <= index < self.num_nodes:
+            raise IndexError('Node index out of range')
+        return NODE.unpack_from(self._mm, self._nodes_start + index * NODE.size)
+
+    def get_attr(self, index):
+        """
+        Returns the (key, value) of attribute number `index`.
+        """
+        key_index, tag, value = ATTR.unpack_from(self._mm, self._attrs_start + index * ATTR.size)
+        if tag == TAG_STR:
+            return self.get_string(key_index), self.get_string(value)
+        elif tag == TAG_NULL:
+            return self.get_string(key_index), None
+        return self.get_string(key_index), json.loads(self.get_string(value))
+
+    def get_attrs(self, start, count):
+        """
+        Returns the list of the (key, value) of attributes `start` to `start+count`.
+        """
+        values = struct.unpack_from('<%dI' % (3 * count), self._mm, self._attrs_start + start * ATTR.size)
+        attrs = []
+        for i in range(0, 3 * count, 3):
+            key_index, tag, value = values[i:i+3]
+            if tag == TAG_STR:
+                attrs.append((self.get_string(key_index), self.get_string(value)))
+            elif tag == TAG_NULL:
+                attrs.append((self.get_string(key_index), None))
+            else:
+                attrs.append((self.get_string(key_index), json.loads(self.get_string(value))))
+        return attrs
+
+    def iter_nodes(self):
+        """
+        Iterate over all the nodes in breadth-first order.
+        """
+        for index in range(self.num_nodes):
+            yield PackedNode(self, index)
+
+    def to_dict(self):
+        return self.root.to_dict()
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class PackedNode(object):
+    """
+    Lazy accessor for one node of a PackedTree with a read-only dict interface.
+    `node['children']` is the list of child PackedNodes. The attributes and the
+    children of a node are decoded on first access and then kept by the accessor.
+    """
+    __slots__ = ['packed_tree', 'index', '_attr_start', '_attr_count',
+                 '_child_start', '_child_count', '_attrs', '_children']
+
+    def __init__(self, packed_tree, index):
+        self.packed_tree = packed_tree
+        self.index = index
+        self._attr_start, self._attr_count, self._child_start, self._child_count = \
+            packed_tree.get_node_record(index)
+        self._attrs = None
+        self._children = None
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = dict(self.packed_tree.get_attrs(self._attr_start, self._attr_count))
+        return self._attrs
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [PackedNode(self.packed_tree, self._child_start + i) for i in range(self._child_count)]
+        return self._children
+
+    def items(self):
+        for item in self.attrs.items():
+            yield item
+        if self._child_start != NO_CHILDREN:
+            yield 'children', self.children
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def get(self, key, default=None):
+        if key == 'children':
+            return self.children if self._child_start != NO_CHILDREN else default
+        return self.attrs.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if key == 'children':
+            return self._child_start != NO_CHILDREN
+        return key in self.attrs
+
+    def to_dict(self):
+        """
+        Returns the subtree rooted at this node as nested dicts (same as JSON).
+        """
+        node = dict(self.attrs)
+        if self._child_start != NO_CHILDREN:
+            node['children'] = [child.to_dict() for child in self.children]
+        return node
+
+    def __repr__(self):
+        return '<PackedNode %d %s>' % (self.index, self.get('source_id'))
+
+
+def export_json_tree(packed_path, json_path):
+    """
+    Write the packed tree in `packed_path` as JSON in the same format as the
+    web resource trees written by the crawlers.
+    """
+    with PackedTree(packed_path) as packed_tree:
+        tree = packed_tree.to_dict()
+    with open(json_path, 'w') as jsonfile:
+        json.dump(tree, jsonfile, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack, export, and inspect packed web resource trees')
+    subparsers = parser.add_subparsers(dest='command')
+    pack_parser = subparsers.add_parser('pack', help='convert JSON tree to packed tree')
+    pack_parser.add_argument('json_path')
+    pack_parser.add_argument('packed_path', nargs='?', default=None)
+    export_parser = subparsers.add_parser('export', help='convert packed tree to JSON tree')
+    export_parser.add_argument('packed_path')
+    export_parser.add_argument('json_path')
+    info_parser = subparsers.add_parser('info', help='print stats about a packed tree')
+    info_parser.add_argument('packed_path')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        print('Saved packed tree to', pack_json_tree(args.json_path, args.packed_path))
+    elif args.command == 'export':
+        export_json_tree(args.packed_path, args.json_path)
+    elif args.command == 'info':
+        with PackedTree(args.packed_path) as packed_tree:
+            print('nodes={} attrs={} strings={} size={} bytes'.format(
+                packed_tree.num_nodes, packed_tree.num_attrs, packed_tree.num_strings,
+                os.path.getsize(args.packed_path)))
+    else:
+        parser.print_help()
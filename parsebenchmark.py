@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to parse PraDigi pages using the full `html.parser`
+parse used by BasicCrawler and using the selective lxml + SoupStrainer parse
+used by PraDigiCrawler, for each kind of page.
+
+Usage:
+    ./parsebenchmark.py save --lang hi       # save page fixtures from website
+    ./parsebenchmark.py run                  # run benchmark on saved fixtures
+
+No page fixtures are included in the repo, so run `save` once before `run`.
+Saving fixtures doesn't touch the state of the chef crawls (checkpoints,
+resource caches, catalog, and web resource trees).
+"""
+import argparse
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+from crawlengine import AsyncBasicCrawler, DetailPageResolver
+from pradigi_crawlers import PraDigiCrawler, PAGE_CONTAINERS, get_detail_page_urls_from_html
+from resourcecache import ResourceCache, VideoMetadataStore, VIDEO_METADATA_NAMESPACE
+
+
+PAGE_FIXTURES_DIR = 'chefdata/page_fixtures'
+
+
+
+# PAGE FIXTURES
+################################################################################
+
+class PageFixtureSaver(PraDigiCrawler):
+    """
+    Crawler that saves the html of the pages it parses in `fixtures_dir`,
+    keeping at most `max_pages_per_kind` pages of each kind. Uses its own
+    checkpoint path and in-memory caches so the chef crawl state is not changed.
+    """
+    fixtures_dir = PAGE_FIXTURES_DIR
+    max_pages_per_kind = 5
+    incremental = False
+    checkpoint_interval = 0
+
+    def __init__(self, lang=None, fixtures_dir=PAGE_FIXTURES_DIR, **kwargs):
+        super().__init__(lang=lang, **kwargs)
+        self.fixtures_dir = fixtures_dir
+        self.CHECKPOINT_OUTPUT = os.path.join(fixtures_dir, 'fixture_saver_checkpoint.json')
+
+    def get_detail_page_resolver(self):
+        if self.detail_page_resolver is None:
+            self.detail_page_resolver = DetailPageResolver(
+                fetch_fn=self.fetch_detail_page,
+                extract_fn=get_detail_page_urls_from_html,
+                cache=None,
+                max_workers=self.DETAIL_PAGE_WORKERS,
+            )
+        return self.detail_page_resolver
+
+    def get_video_metadata_store(self):
+        if self.video_metadata_store is None:
+            self.video_metadata_store = VideoMetadataStore(
+                head_fn=self.make_conditional_request,
+                cache=ResourceCache(namespace=VIDEO_METADATA_NAMESPACE, path=':memory:'),
+                max_workers=self.VIDEO_METADATA_WORKERS,
+            )
+        return self.video_metadata_store
+
+    def parse_page(self, html, context=None):
+        kind = context.get('kind', None) if context else None
+        if kind in PAGE_CONTAINERS:
+            kind_dir = os.path.join(self.fixtures_dir, kind)
+            os.makedirs(kind_dir, exist_ok=True)
+            num_saved = len(os.listdir(kind_dir))
+            if num_saved < self.max_pages_per_kind:
+                fixture_path = os.path.join(kind_dir, '{:03d}.html'.format(num_saved))
+                with open(fixture_path, 'w') as fixture_file:
+                    fixture_file.write(html)
+        return super().parse_page(html, context)
+
+
+def save_page_fixtures(lang, fixtures_dir=PAGE_FIXTURES_DIR, max_pages_per_kind=5, limit=200):
+    """
+    Crawl the first `limit` pages of the `lang` website and save page fixtures.
+    """
+    crawler = PageFixtureSaver(lang=lang, fixtures_dir=fixtures_dir)
+    crawler.max_pages_per_kind = max_pages_per_kind
+    # call base class crawl to avoid overwriting the web resource tree of `lang`
+    # and updating the resource catalog
+    AsyncBasicCrawler.crawl(crawler, limit=limit, save_web_resource_tree=False, devmode=False,
+                            checkpoint_interval=0, incremental=False)
+
+
+
+# BENCHMARK
+################################################################################
+
+def load_page_fixtures(fixtures_dir=PAGE_FIXTURES_DIR):
+    """
+    Returns dict {kind: [html, ...]} of the page fixtures saved in `fixtures_dir`.
+    """
+    if not os.path.isdir(fixtures_dir):
+        raise ValueError('No page fixtures in {} (run `./parsebenchmark.py save` first)'.format(fixtures_dir))
+    pages_by_kind = {}
+    for kind in sorted(os.listdir(fixtures_dir)):
+        kind_dir = os.path.join(fixtures_dir, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        pages = []
+        for filename in sorted(os.listdir(kind_dir)):
+            with open(os.path.join(kind_dir, filename)) as fixture_file:
+                pages.append(fixture_file.read())
+        pages_by_kind[kind] = pages
+    return pages_by_kind
+
+
+def time_parse(pages, parse_fn, repeat):
+    """
+    Returns the best time of `repeat` runs of `parse_fn` on all `pages`.
+    """
+    best = None
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        for html in pages:
+            parse_fn(html)
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_parse_benchmark(fixtures_dir=PAGE_FIXTURES_DIR, repeat=5):
+    """
+    Time full and selective parse for each kind of page and check that the
+    container used by the handler is the same in both parse results.
+    Returns a list of dicts with one row of results per kind of page.
+    """
+    crawler = PraDigiCrawler(lang='hi')
+    results = []
+    for kind, pages in load_page_fixtures(fixtures_dir).items():
+        if kind not in PAGE_CONTAINERS or not pages:
+            continue
+        name, attrs = PAGE_CONTAINERS[kind]
+        context = {'kind': kind}
+        full_parse = lambda html: BeautifulSoup(html, 'html.parser')
+        selective_parse = lambda html: crawler.parse_page(html, context)
+        mismatches = 0
+        for html in pages:
+            full_containers = full_parse(html).find_all(name, attrs)
+            selective_containers = selective_parse(html).find_all(name, attrs)
+            if [c.get_text() for c in full_containers] != [c.get_text() for c in selective_containers]:
+                mismatches += 1
+        full_time = time_parse(pages, full_parse, repeat)
+        selective_time = time_parse(pages, selective_parse, repeat)
+        results.append(dict(
+            kind=kind,
+            pages=len(pages),
+            full_ms=1000*full_time/len(pages),
+            selective_ms=1000*selective_time/len(pages),
+            speedup=full_time/selective_time if selective_time else float('inf'),
+            mismatches=mismatches,
+        ))
+    return results
+
+
+def print_parse_benchmark(results):
+    print('{:<24}{:>6}{:>12}{:>15}{:>10}{:>12}'.format(
+        'kind', 'pages', 'full (ms)', 'selective (ms)', 'speedup', 'mismatches'))
+    for row in results:
+        print('{kind:<24}{pages:>6}{full_ms:>12.2f}{selective_ms:>15.2f}{speedup:>9.1f}x{mismatches:>12}'.format(**row))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PraDigi page parsing benchmark')
+    parser.add_argument('command', choices=['save', 'run'])
+    parser.add_argument('--lang', default='hi', help='website language to save fixtures from')
+    parser.add_argument('--fixtures', default=PAGE_FIXTURES_DIR, help='page fixtures dir')
+    parser.add_argument('--max-pages', type=int, default=5, help='max fixtures per kind of page')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing runs')
+    args = parser.parse_args()
+    if args.command == 'save':
+        save_page_fixtures(args.lang, fixtures_dir=args.fixtures, max_pages_per_kind=args.max_pages)
+    else:
+        print_parse_benchmark(run_parse_benchmark(fixtures_dir=args.fixtures, repeat=args.repeat))
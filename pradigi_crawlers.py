@@ -1,16 +1,19 @@
-from bs4 import BeautifulSoup
+from html import unescape
 import json
 import logging
 import re
-import requests
 from urllib.parse import urljoin, urlparse
 
 
-from basiccrawler.crawler import BasicCrawler
+from bs4 import SoupStrainer
 from ricecooker.config import LOGGER
 LOGGER.setLevel(logging.WARNING)
 from le_utils.constants.languages import getlang
 
+from crawlengine import AsyncBasicCrawler, DetailPageResolver, StreamingTreeWriter, DETAIL_PAGE_MAX_AGE
+from resourcecache import ResourceCache, VideoMetadataStore
+from resourcecatalog import get_resource_catalog
+
 from sushichef import (
     PRADIGI_DOMAIN,
     PRADIGI_STRINGS,
@@ -37,9 +40,21 @@ for lang, langdata in PRADIGI_STRINGS.items():
 
 
 
+# The part of the page used by the handler for each kind of page: (name, attrs)
+# (story_resource_page is not parsed, see PraDigiCrawler.raw_kinds)
+PAGE_CONTAINERS = {
+    'lang_page': ('div', {'id': 'menu-row'}),
+    'topic_page': ('div', {'id': 'body-row'}),
+    'subtopic_page': ('div', {'id': 'body-row'}),
+    'special_subtopic_page': ('div', {'id': 'body-row'}),
+    'lesson_page': ('div', {'id': 'row-exu'}),
+    'fun_page': ('div', {'id': 'body-row'}),
+    'story_page': ('div', {'id': 'body-row'}),
+}
+
 
 
-class PraDigiCrawler(BasicCrawler):
+class PraDigiCrawler(AsyncBasicCrawler):
     SOURCE_DOMAINS = [FULL_DOMAIN_URL, 'http://www.'+PRADIGI_DOMAIN]
     MAIN_SOURCE_DOMAIN = FULL_DOMAIN_URL
     START_PAGE_CONTEXT = {'kind': 'lang_page'}
@@ -55,6 +70,17 @@ class PraDigiCrawler(BasicCrawler):
         'special_subtopic_page': 'on_special_subtopic_page',
     }
     # ALLOW_BROKEN_HEAD_URLS = ['http://www.prathamopenschool.org/hn/Course/Construction']
+    PAGE_PARSER = 'lxml'
+    kind_parse_only = dict(
+        (kind, SoupStrainer(name, attrs)) for kind, (name, attrs) in PAGE_CONTAINERS.items()
+    )
+    raw_kinds = {'story_resource_page'}   # respath found with regex in the html text
+    DETAIL_PAGE_WORKERS = 4     # concurrent GETs of Fun detail pages
+    no_replay_kinds = {'fun_page'}   # results depend on the Fun detail pages
+    detail_page_resolver = None
+    VIDEO_METADATA_WORKERS = 8  # concurrent HEADs for video metadata
+    video_metadata_store = None
+    selected_course_ids = None  # source_ids of the top-level menu links to crawl (None = all)
 
     # CRALWING
     ############################################################################
@@ -70,16 +96,36 @@ class PraDigiCrawler(BasicCrawler):
         self.lang = lang
         start_page = PRADIGI_LANG_URL_MAP[self.lang]
         self.CRAWLING_STAGE_OUTPUT = 'chefdata/trees/pradigi_{}_web_resource_tree.json'.format(lang)
+        self.CHECKPOINT_OUTPUT = 'chefdata/checkpoints/pradigi_{}_crawl_checkpoint.json'.format(lang)
+        self.CRAWL_REPORT_OUTPUT = 'chefdata/trees/pradigi_{}_crawl_report.json'.format(lang)
         super().__init__(start_page=start_page)
 
 
-    def crawl(self, **kwargs):
+    def crawl(self, selected_course_ids=None, **kwargs):
         """
-        Extend base crawl method to add PraDigi channel metadata. 
+        Extend base crawl method to add PraDigi channel metadata.
+        Pass `max_in_flight_per_host=N` to fetch up to N pages concurrently and
+        `incremental=True` to only process the pages that changed since last crawl.
+        Use `resume=True` to continue a crawl from the last saved checkpoint and
+        `stream_output=True` to write the (flattened) tree while crawling.
+        Pass `selected_course_ids` to crawl only these top-level menu links.
         """
-        web_resource_tree = super().crawl(**kwargs)
+        if selected_course_ids is not None:
+            self.selected_course_ids = set(selected_course_ids)
+        super().crawl(**kwargs)
+
+        if not self.stream_output:
+            # remove extra nesting
+            flatten_web_resource_tree(self.lang)
+        # update the catalog of the web resources of all languages
+        get_resource_catalog().sync(self.lang)
+
 
-        # channel metadata
+    def on_crawl_done(self, channel_dict):
+        """
+        Add PraDigi channel metadata to the web root.
+        """
+        web_resource_tree = channel_dict['children'][0]
         lang_obj = getlang(self.lang)
         channel_metadata = dict(
             title='PraDigi ({})'.format(lang_obj.native_name),
@@ -94,11 +140,27 @@ class PraDigiCrawler(BasicCrawler):
         # convert tree format expected by scraping functions
         # restructure_web_resource_tree(web_resource_tree)
         # remove_sections(web_resource_tree)
-        self.write_web_resource_tree_json(web_resource_tree)
 
+    def flush_pending_resources(self):
+        """
+        Fill in metadata for the videos still waiting in the last HEAD batch.
+        """
+        with self.crawl_stats.timer('flush_video_metadata'):
+            self.get_video_metadata_store().flush()
+
+    def make_tree_writer(self):
+        return FlatteningTreeWriter(self.CRAWLING_STAGE_OUTPUT)
 
-        # remove extra nesting
-        flatten_web_resource_tree(self.lang)
+    def should_crawl(self, url, context):
+        """
+        Skip the top-level menu links that are not in `selected_course_ids`.
+        """
+        if self.selected_course_ids is None or context['parent'].get('kind') != 'lang_page':
+            return True
+        if context.get('source_id') not in self.selected_course_ids:
+            LOGGER.info('Skipping topic %s not used in channel structure' % url)
+            return False
+        return True
 
 
 
@@ -346,7 +408,7 @@ class PraDigiCrawler(BasicCrawler):
                         thumbnail_url=thumbnail,
                         children=[],
                     )
-                    video.update(self.get_video_metadata(main_file))
+                    self.add_video_metadata(video)
                     page_dict['children'].append(video)
 
                 elif main_file.endswith('pdf'):
@@ -450,6 +512,8 @@ class PraDigiCrawler(BasicCrawler):
             return
         contents = contents_row.find_all('div', {'class': 'col-md-3'})
 
+        # 1. collect the listed items
+        fun_items = []
         for content in contents:
             try:
                 title = get_text(content.find('div', {'class': 'txtline'}))
@@ -461,17 +525,24 @@ class PraDigiCrawler(BasicCrawler):
                 link = content.find('a')
                 source_id = link['href'][1:]
                 fun_resource_url = get_absolute_path(link['href'])
-                # direct_download_url = None
-                direct_download_link = content.find('a', class_='dnlinkfunstory')
-                if direct_download_link:
-                    direct_download_href = direct_download_link['href'].strip()
-                    # direct_download_url = get_absolute_path(direct_download_href)
-
-                # Need to GET the FunResource detail page since main_file is not in avail. in listing
-                fun_rsrc_html = requests.get(fun_resource_url).text
-                respath_url = get_respath_url_from_html(fun_rsrc_html)
-                fun_doc = BeautifulSoup(fun_rsrc_html, "html.parser")
-                download_url = get_download_url_from_doc(url, fun_doc)
+                fun_items.append((content, title, thumbnail, source_id, fun_resource_url))
+            except Exception as e:
+                LOGGER.error('on_fun_page: %s : %s' % (e, content))
+
+        # 2. Need to GET the FunResource detail pages since main_file is not in avail. in listing
+        resolver = self.get_detail_page_resolver()
+        resolved_by_url = resolver.resolve_all([item[4] for item in fun_items])
+
+        for content, title, thumbnail, source_id, fun_resource_url in fun_items:
+            try:
+                resolved = resolved_by_url[fun_resource_url]
+                if resolved is None or resolved['respath_url'] is None:
+                    LOGGER.error('on_fun_page: no respath found on %s' % fun_resource_url)
+                    continue
+                respath_url = resolved['respath_url']
+                download_url = None
+                if resolved['download_href'] is not None:
+                    download_url = urljoin(url, resolved['download_href'])
                 respath_path = urlparse(respath_url).path
 
                 if self.should_ignore_url(respath_url):
@@ -490,7 +561,7 @@ class PraDigiCrawler(BasicCrawler):
                         thumbnail_url=thumbnail,
                         children=[],
                     )
-                    video.update(self.get_video_metadata(respath_url))
+                    self.add_video_metadata(video)
                     page_dict['children'].append(video)
 
                 elif respath_path.endswith('pdf'):
@@ -607,8 +678,7 @@ class PraDigiCrawler(BasicCrawler):
 
     def on_story_resource_page(self, url, page, context):
         LOGGER.debug('     in on_story_resource_page' + url)
-        html = str(page)
-        story_resource_url = get_respath_url_from_html(html)
+        story_resource_url = get_respath_url_from_html(page)   # page is the html text
         if story_resource_url:
             page_dict = dict(
                 url=story_resource_url,
@@ -620,22 +690,61 @@ class PraDigiCrawler(BasicCrawler):
             LOGGER.error('Failed to find story_resource_url on page %s' % url)
 
 
+    def get_detail_page_resolver(self):
+        """
+        Returns the resolver used to GET the Fun detail pages concurrently.
+        Resolved URLs are saved in the resource cache so later runs skip the GET
+        until they are revalidated (after a week, or every time in incremental mode).
+        """
+        if self.detail_page_resolver is None:
+            self.detail_page_resolver = DetailPageResolver(
+                fetch_fn=self.fetch_detail_page,
+                extract_fn=get_detail_page_urls_from_html,
+                cache=ResourceCache(namespace='detail_pages'),
+                max_workers=max(self.DETAIL_PAGE_WORKERS, self.max_in_flight_per_host),
+                resource_index=self.resource_index,
+                stats=self.crawl_stats,
+                max_age=0 if self.incremental else DETAIL_PAGE_MAX_AGE,
+            )
+        return self.detail_page_resolver
+
+    def fetch_detail_page(self, url, etag=None, last_modified=None):
+        """
+        GET the detail page `url`, as a conditional request if validators are given.
+        """
+        if etag is None and last_modified is None:
+            return self.make_request(url)
+        return self.make_conditional_request(url, method='GET', etag=etag,
+                                             last_modified=last_modified, no_cache=True)
+
+
+    def get_video_metadata_store(self):
+        """
+        Returns the persistent store of video metadata (content-type, content-length).
+        HEAD requests are only made for videos that are new or stale.
+        """
+        if self.video_metadata_store is None:
+            self.video_metadata_store = VideoMetadataStore(
+                head_fn=self.make_conditional_request,
+                max_workers=max(self.VIDEO_METADATA_WORKERS, self.max_in_flight_per_host),
+                resource_index=self.resource_index,
+                stats=self.crawl_stats,
+            )
+        return self.video_metadata_store
+
+    def add_video_metadata(self, video):
+        """
+        Schedule the `video` web resource to receive 'content-type' and
+        'content-length' metadata. HEAD requests are sent in concurrent batches.
+        """
+        self.get_video_metadata_store().add_pending(video['url'], video)
+
     def get_video_metadata(self, video_url):
         """
-        Make HEAD request to obtain 'content-length' for video files
+        Obtain 'content-type' and 'content-length' for video files (from store or HEAD)
         """
-        head_response = self.make_request(video_url, method='HEAD')
-        if head_response:
-            video_metadata = {}
-            content_type = head_response.headers.get('content-type', None)
-            if content_type:
-                video_metadata['content-type'] = content_type
-            content_length = head_response.headers.get('content-length', None)
-            if content_length:
-                video_metadata['content-length'] = content_length
-            return video_metadata
-        else:
-            return {}
+        with self.crawl_stats.timer('get_video_metadata'):
+            return self.get_video_metadata_store().refresh([video_url])[video_url]
 
 
 
@@ -661,6 +770,32 @@ def get_download_url_from_doc(url, doc):
         return download_url
     return None
 
+_DOWNLOAD_BUTTON_PATTERN = re.compile(r'<a\s[^>]*\bid\s*=\s*["\']btndownload["\'][^>]*>', re.IGNORECASE)
+_HREF_ATTR_PATTERN = re.compile(r'\bhref\s*=\s*(?:"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\')', re.IGNORECASE)
+def get_download_href_from_html(html):
+    """
+    Same as `get_download_url_from_doc` but works on the raw html (no DOM) and
+    returns the unresolved `href` of the download button, or None if not found.
+    """
+    m = _DOWNLOAD_BUTTON_PATTERN.search(html)
+    if m is None:
+        return None
+    href_m = _HREF_ATTR_PATTERN.search(m.group(0))
+    if href_m is None:
+        return None
+    href = href_m.group('dq') if href_m.group('dq') is not None else href_m.group('sq')
+    return unescape(href)
+
+def get_detail_page_urls_from_html(html):
+    """
+    Extract the `respath` URL and the download button href from the raw html of
+    a Fun detail page without building a DOM.
+    """
+    return dict(
+        respath_url=get_respath_url_from_html(html),
+        download_href=get_download_href_from_html(html),
+    )
+
 
 def get_text(element):
     """
@@ -676,7 +811,7 @@ def get_source_id(path):
     return path.strip('/').split('/')[-1]
 
 
-
+_RES_CLICK_PATTERN = re.compile(r"res_click\('(.*)','.*','.*','(.*)'\)")
 def get_content_link(content):
     """
     The link to a content has an onclick attribute that executes
@@ -688,8 +823,7 @@ def get_content_link(content):
     """
     link = content.find('a', {'id': 'navigate'})
     source_id = link['href'][1:]
-    regex = re.compile(r"res_click\('(.*)','.*','.*','(.*)'\)")
-    match = regex.search(link['onclick'])
+    match = _RES_CLICK_PATTERN.search(link['onclick'])
     link = match.group(1)
     main_file = get_absolute_path(link)
     master_file = match.group(2)
@@ -720,20 +854,9 @@ def flatten_web_resource_tree(lang):
             # 1. do replacment if matches conditions
             new_children = []
             for child in subtree['children']:
-                if 'title' not in child:
-                    print('|||| >>>>', 'NO TITLE', child)
-                    continue
-                child_title = child['title']
-                if 'children' in child and len(child['children']) == 1:
-                    grandchild = child['children'][0]
-                    grandchild_title = grandchild['title']
-                    # REPLACEMENT CONDITION
-                    if child_title == grandchild_title:
-                        new_children.append(grandchild)
-                    else:
-                        new_children.append(child)
-                else:
-                    new_children.append(child)
+                new_child = get_flattened_child(child)
+                if new_child is not None:
+                    new_children.append(new_child)
             subtree['children'] = new_children
             #
             # 2. continue recusively
@@ -744,3 +867,37 @@ def flatten_web_resource_tree(lang):
     with open(wrt_filename, 'w') as wrt_file:
         json.dump(web_resource_tree, wrt_file, ensure_ascii=False, indent=2, sort_keys=True)
 
+
+def get_flattened_child(child):
+    """
+    Returns the node that replaces `child` when flattening: its only child if
+    it has the same title, `child` itself otherwise, or None if no title.
+    """
+    if 'title' not in child:
+        print('|||| >>>>', 'NO TITLE', child)
+        return None
+    child_title = child['title']
+    if 'children' in child and len(child['children']) == 1:
+        grandchild = child['children'][0]
+        grandchild_title = grandchild['title']
+        # REPLACEMENT CONDITION
+        if child_title == grandchild_title:
+            return grandchild
+    return child
+
+
+class FlatteningTreeWriter(StreamingTreeWriter):
+    """
+    Writes the web resource tree while crawling and applies the same flattening
+    as `flatten_web_resource_tree`, so the output doesn't need to be read again.
+    """
+
+    def transforms_children(self, node, parent_transforms):
+        # Do not flatten stucture in KhelBadi, WatchAndDo, and KhelPuri
+        return parent_transforms and node.get('source_id', None) not in SPECIAL_SUBTOPIC_COURSE_IDS
+
+    def transform_child(self, child):
+        return get_flattened_child(child)
+
+    def may_transform_child(self, child):
+        return 'title' not in child or len(child.get('children', [])) <= 1
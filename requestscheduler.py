@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Adaptive scheduler for HTTP requests made by the crawlers and the downloads.
+Run this module directly to try the scheduler against a local HTTP server that
+injects latency and errors:
+
+    ./requestscheduler.py --requests 200 --error-rate 0.1 --slow-rate 0.2
+"""
+from collections import Counter
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import requests
+from ricecooker.config import LOGGER
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+
+# AIMD REQUEST SCHEDULER
+################################################################################
+
+class AdaptiveRequestScheduler(object):
+    """
+    Runs HTTP requests with a concurrency limit that adapts to the server health
+    using additive-increase/multiplicative-decrease (AIMD):
+      - after `concurrency` consecutive fast successful requests (about one round
+        trip of requests), the limit is increased by `additive_increase`
+      - when a request fails (connection error, timeout, 429, 5xx) or takes longer
+        than `latency_target` seconds, the limit is multiplied by `decrease_factor`
+        (at most once every `decrease_cooldown` seconds to react once per burst).
+    Failed requests are retried up to `max_retries` times with exponential backoff
+    and full jitter. While waiting to be retried, a request does not hold a slot:
+    it is put back in the scheduler queue with the time when it becomes ready, so
+    other requests can use the slot in the meantime.
+    Thread safe: one scheduler can be shared by all the crawlers and downloaders.
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=8, initial_concurrency=2,
+                 additive_increase=1, decrease_factor=0.5, latency_target=5.0,
+                 decrease_cooldown=1.0, max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        if not 1 <= min_concurrency <= initial_concurrency <= max_concurrency:
+            raise ValueError('Must have 1 <= min_concurrency <= initial_concurrency <= max_concurrency')
+        if not 0 < decrease_factor < 1:
+            raise ValueError('decrease_factor must be between 0 and 1')
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.decrease_cooldown = decrease_cooldown
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency = float(initial_concurrency)   # current limit (AIMD state)
+        self.in_flight = 0
+        self.stats = Counter()
+        self._successes = 0              # fast successes since last change of limit
+        self._last_decrease = 0
+        self._waiting = []               # heap of (ready_time, seq) tickets
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def run(self, send_fn, description=''):
+        """
+        Call `send_fn()`, which makes one HTTP request and returns the response,
+        when the scheduler allows it and retry it if it fails. Returns the last
+        response (which can have an error status code if retries ran out) or
+        raises the last connection error/timeout if no response was received.
+        """
+        attempt = 0
+        ready_time = time.monotonic()
+        while True:
+            self._acquire(ready_time)
+            start_time = time.monotonic()
+            response, error = None, None
+            try:
+                response = send_fn()
+            except RETRY_EXCEPTIONS as e:
+                error = e
+            except Exception:
+                self._release(None, failed=False)
+                raise
+            latency = time.monotonic() - start_time
+            failed = error is not None or response.status_code in RETRY_STATUS_CODES
+            self._release(latency, failed)
+            if not failed:
+                return response
+            attempt += 1
+            if attempt > self.max_retries:
+                self.stats['gave up'] += 1
+                LOGGER.error('Giving up on %s after %d attempts' % (description, attempt))
+                if error is not None:
+                    raise error
+                return response
+            delay = self.get_backoff(attempt, response)
+            self.stats['retries'] += 1
+            LOGGER.warning('Request %s failed (%s), retry %d in %.1fs' % (
+                description, error or response.status_code, attempt, delay))
+            ready_time = time.monotonic() + delay
+
+    def get_backoff(self, attempt, response=None):
+        """
+        Returns the delay before retry number `attempt`: exponential backoff with
+        full jitter, or the delay in the `Retry-After` header if the server sent one.
+        """
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(float(response.headers['Retry-After']), self.backoff_max)
+        max_delay = min(self.backoff_max, self.backoff_base * 2**(attempt - 1))
+        return random.uniform(0, max_delay)
+
+    def _acquire(self, ready_time):
+        """
+        Wait until the ticket for `ready_time` is first in the queue, it is ready,
+        and there is a free slot.
+        """
+        ticket = (ready_time, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.monotonic()
+                is_first = self._waiting[0] == ticket
+                if is_first and ticket[0] <= now and self.in_flight < int(self.concurrency):
+                    heapq.heappop(self._waiting)
+                    self.in_flight += 1
+                    self._cond.notify_all()   # next ticket is now first in queue
+                    return
+                if is_first and ticket[0] > now:
+                    self._cond.wait(timeout=ticket[0] - now)
+                else:
+                    self._cond.wait()
+
+    def _release(self, latency, failed):
+        """
+        Free the slot and update the concurrency limit given the request outcome.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self.stats['requests'] += 1
+            now = time.monotonic()
+            if latency is None:
+                pass    # not an HTTP error, so says nothing about server health
+            elif failed or latency > self.latency_target:
+                self.stats['failed' if failed else 'slow'] += 1
+                self._successes = 0
+                if now - self._last_decrease > self.decrease_cooldown:
+                    self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease_factor)
+                    self._last_decrease = now
+                    self.stats['decreases'] += 1
+            else:
+                self._successes += 1
+                if self._successes >= int(self.concurrency):
+                    self.concurrency = min(self.max_concurrency, self.concurrency + self.additive_increase)
+                    self._successes = 0
+            self.stats['max concurrency reached'] = max(self.stats['max concurrency reached'],
+                                                        int(self.concurrency))
+            self._cond.notify_all()
+
+    def summary(self):
+        with self._cond:
+            return 'concurrency=%d %s' % (int(self.concurrency), dict(self.stats))
+
+
+
+# LOCAL TEST SERVER
+################################################################################
+
+def start_flaky_server(port=0, latency=0.05, slow_rate=0.0, slow_latency=2.0, error_rate=0.0):
+    """
+    Start a local HTTP server (in a daemon thread) that stands in for the website:
+    it answers every GET after `latency` seconds, is slow (`slow_latency` seconds)
+    for a `slow_rate` fraction of the requests, and returns 503 for an
+    `error_rate` fraction of the requests. Returns the server (see server_port).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(slow_latency if random.random() < slow_rate else latency)
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = b'<html><body>ok</body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), FlakyHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def run_scheduler_demo(num_requests=200, num_threads=16, **server_kwargs):
+    """
+    Make `num_requests` GET requests from `num_threads` threads to the local
+    flaky server through one scheduler and print the results.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    server = start_flaky_server(**server_kwargs)
+    url = 'http://127.0.0.1:%d/' % server.server_port
+    scheduler = AdaptiveRequestScheduler(max_concurrency=num_threads, latency_target=1.0,
+                                         backoff_base=0.1, backoff_max=2.0)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=num_threads))
+    def get(i):
+        response = scheduler.run(lambda: session.get(url, timeout=10), description=url)
+        return response.status_code
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        status_codes = Counter(executor.map(get, range(num_requests)))
+    print('Made %d requests in %.1fs, status codes: %s' % (
+        num_requests, time.time() - start_time, dict(status_codes)))
+    print('Scheduler: ' + scheduler.summary())
+    server.shutdown()
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Try the AIMD request scheduler on a local flaky server')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests')
+    parser.add_argument('--threads', type=int, default=16, help='number of client threads')
+    parser.add_argument('--latency', type=float, default=0.05, help='normal server latency')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of slow responses')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    args = parser.parse_args()
+    run_scheduler_demo(num_requests=args.requests, num_threads=args.threads, latency=args.latency,
+                       slow_rate=args.slow_rate, error_rate=args.error_rate)
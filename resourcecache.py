@@ -0,0 +1,288 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urldefrag, urlparse, urlunparse
+
+from ricecooker.config import LOGGER
+
+
+RESOURCE_CACHE_PATH = 'chefdata/resource_cache.sqlite'
+
+
+
+# PERSISTENT PER-URL METADATA STORE
+################################################################################
+
+class ResourceCache(object):
+    """
+    Persistent store of metadata dicts keyed by URL, saved in a sqlite database
+    so the information obtained during one chef run can be reused in the next.
+    Different kinds of metadata are kept separate using `namespace`.
+    Safe to use from multiple threads (and from multiple crawlers at once).
+    """
+
+    def __init__(self, namespace, path=RESOURCE_CACHE_PATH):
+        self.namespace = namespace
+        self.path = path
+        parent_dir, _ = os.path.split(path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS resources ('
+                '  namespace TEXT NOT NULL,'
+                '  url TEXT NOT NULL,'
+                '  data TEXT NOT NULL,'
+                '  updated REAL NOT NULL,'
+                '  PRIMARY KEY (namespace, url))'
+            )
+            self._conn.commit()
+
+    def get(self, url):
+        """
+        Returns the metadata dict stored for `url`, or None if not found.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM resources WHERE namespace = ? AND url = ?',
+                (self.namespace, url)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, url, data):
+        """
+        Store the metadata dict `data` for `url` (replaces previous value).
+        """
+        data_str = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO resources (namespace, url, data, updated) VALUES (?, ?, ?, ?)',
+                (self.namespace, url, data_str, time.time()))
+            self._conn.commit()
+
+    def delete(self, url):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM resources WHERE namespace = ? AND url = ?',
+                (self.namespace, url))
+            self._conn.commit()
+
+    def clear(self):
+        """
+        Remove all the entries in this namespace.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM resources WHERE namespace = ?', (self.namespace,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+
+# SHARED RESOURCE INDEX
+################################################################################
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def canonicalize_url(url):
+    """
+    Returns the canonical form of `url` used as key in the ResourceIndex:
+    no fragment, lowercase scheme and host, and no default port.
+    """
+    url = urldefrag(url)[0]
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.hostname.lower() if parsed.hostname else ''
+    if parsed.port and parsed.port != DEFAULT_PORTS.get(scheme, None):
+        netloc += ':' + str(parsed.port)
+    return urlunparse((scheme, netloc, parsed.path or '/', parsed.params, parsed.query, ''))
+
+
+class ResourceIndex(object):
+    """
+    In-memory index of resolved resource metadata keyed by (namespace, canonical URL)
+    shared by all the crawlers of a chef run, including crawlers running in parallel
+    threads. Each unique resource is resolved only once per run: if another thread
+    is already resolving the same URL, `get_or_resolve` waits for its result.
+    Failed resolutions (result is None) are not stored so they can be retried.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}      # (namespace, canonical_url) --> resolved value
+        self._pending = {}      # (namespace, canonical_url) --> threading.Event
+        self.stats = Counter()  # hits and misses by namespace
+
+    def get_or_resolve(self, namespace, url, resolve_fn):
+        """
+        Returns the value stored for `url` in `namespace`, calling `resolve_fn(url)`
+        to obtain it if this is the first time the resource is seen in this run.
+        """
+        key = (namespace, canonicalize_url(url))
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self.stats[namespace + ' hits'] += 1
+                    return self._entries[key]
+                event = self._pending.get(key, None)
+                if event is None:
+                    event = threading.Event()
+                    self._pending[key] = event
+                    break
+            event.wait()   # another thread is resolving the same resource
+        try:
+            value = resolve_fn(url)
+            with self._lock:
+                if value is not None:
+                    self._entries[key] = value
+                self.stats[namespace + ' misses'] += 1
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+
+# VIDEO METADATA
+################################################################################
+
+VIDEO_METADATA_NAMESPACE = 'video_metadata'
+VIDEO_METADATA_MAX_AGE = 7*24*60*60       # revalidate entries older than one week
+VIDEO_METADATA_KEYS = ['content-type', 'content-length']   # keys copied to web resources
+
+
+class VideoMetadataStore(object):
+    """
+    Persistent video URL --> metadata store that keeps the `content-type` and
+    `content-length` obtained from HEAD requests along with the `etag` and
+    `last-modified` headers used to revalidate entries once they are stale.
+    Web resource dicts are registered using `add_pending` and their metadata is
+    filled in batches by `flush`, which sends concurrent HEAD requests only for
+    URLs that are new or stale. Fresh/stale entries and the outcome of the
+    revalidations are recorded in `stats` (a CrawlStats) if given.
+    """
+
+    def __init__(self, head_fn=None, cache=None, max_workers=8, batch_size=32,
+                 max_age=VIDEO_METADATA_MAX_AGE, resource_index=None, stats=None):
+        self.head_fn = head_fn      # head_fn(url, etag=, last_modified=) --> response
+        self.cache = cache if cache is not None else ResourceCache(namespace=VIDEO_METADATA_NAMESPACE)
+        self.resource_index = resource_index   # optional ResourceIndex shared with other crawlers
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.pending = []           # list of (url, web_resource_dict) tuples
+        self.stats = stats
+
+    def get_metadata(self, url):
+        """
+        Returns the stored metadata dict for `url` (no network), or {} if unknown.
+        """
+        return self.entry_to_metadata(self.cache.get(url))
+
+    def get_content_length(self, url):
+        return self.get_metadata(url).get('content-length', None)
+
+    def is_stale(self, entry):
+        return entry is None or time.time() - entry.get('checked', 0) > self.max_age
+
+    def add_pending(self, url, web_resource):
+        """
+        Register `web_resource` to receive the metadata of `url` on next flush.
+        """
+        self.pending.append((url, web_resource))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Refresh the metadata for all pending URLs and update the web resources.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        metadata_by_url = self.refresh([url for url, _ in pending])
+        for url, web_resource in pending:
+            web_resource.update(metadata_by_url[url])
+
+    def refresh(self, urls):
+        """
+        Make HEAD requests (concurrently) for the URLs in `urls` that are new or
+        stale and returns a dict {url: metadata}.
+        """
+        entries = {}
+        urls_to_check = []
+        for url in urls:
+            if url in entries or url in urls_to_check:
+                continue
+            entry = self.cache.get(url)
+            if self.stats is not None:
+                self.stats.record_cache(VIDEO_METADATA_NAMESPACE, not self.is_stale(entry))
+            if self.is_stale(entry) and self.head_fn is not None:
+                urls_to_check.append(url)
+            entries[url] = entry
+        if urls_to_check:
+            max_workers = min(self.max_workers, len(urls_to_check))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                old_entries = [entries[url] for url in urls_to_check]
+                revalidate_fn = self.revalidate
+                if self.resource_index is not None:
+                    revalidate_fn = self.revalidate_once
+                for url, entry in zip(urls_to_check, executor.map(revalidate_fn, urls_to_check, old_entries)):
+                    entries[url] = entry
+        return dict((url, self.entry_to_metadata(entry)) for url, entry in entries.items())
+
+    def entry_to_metadata(self, entry):
+        if entry is None:
+            return {}
+        return dict((key, entry[key]) for key in VIDEO_METADATA_KEYS if key in entry)
+
+    def revalidate_once(self, url, entry):
+        """
+        Revalidate `url` at most once per run across all the crawlers sharing
+        the `resource_index`.
+        """
+        return self.resource_index.get_or_resolve(
+            VIDEO_METADATA_NAMESPACE, url, lambda url: self.revalidate(url, entry))
+
+    def revalidate(self, url, entry):
+        """
+        Make a conditional HEAD request for `url` and returns the updated entry.
+        Keeps using the old `entry` if the request fails.
+        """
+        etag = entry.get('etag') if entry else None
+        last_modified = entry.get('last-modified') if entry else None
+        try:
+            response = self.head_fn(url, etag=etag, last_modified=last_modified)
+        except Exception as e:
+            LOGGER.error('HEAD request failed for %s: %s' % (url, e))
+            response = None
+        if response is None:
+            return entry
+        if self.stats is not None and entry is not None:
+            self.stats.record_cache(VIDEO_METADATA_NAMESPACE + ' revalidation', response.status_code == 304)
+        if response.status_code == 304 and entry is not None:
+            new_entry = dict(entry)
+        else:
+            new_entry = {}
+            for key in VIDEO_METADATA_KEYS + ['etag', 'last-modified']:
+                value = response.headers.get(key, None)
+                if value:
+                    new_entry[key] = value
+        new_entry['checked'] = time.time()
+        self.cache.set(url, new_entry)
+        return new_entry
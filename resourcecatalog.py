@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Indexed sqlite catalog of the nodes of the web resource trees of all languages,
+for questions that would otherwise need a walk over every JSON tree, e.g.
+
+    ./resourcecatalog.py sync
+    ./resourcecatalog.py find --kind PrathamVideoResource --min-mb 100
+    ./resourcecatalog.py find --source_id 860
+    ./resourcecatalog.py shared --kind PrathamZipResource
+
+The crawl stage updates the catalog after it saves the tree of each language,
+and `sync` re-indexes any tree that changed on disk since it was catalogued.
+"""
+import glob
+import json
+import os
+import sqlite3
+import threading
+
+from treestore import WEB_RESOURCE_TREE_PATH_TMPL
+
+
+RESOURCE_CATALOG_PATH = 'chefdata/resource_catalog.sqlite'
+PARENT_PATH_SEPARATOR = ' > '
+CATALOG_COLUMNS = ['lang', 'position', 'depth', 'kind', 'source_id', 'url', 'title',
+                   'course_id', 'parent_url', 'parent_path', 'content_length', 'thumbnail_url']
+
+
+
+# RESOURCE CATALOG
+################################################################################
+
+class ResourceCatalog(object):
+    """
+    Sqlite catalog with one row per web resource tree node (in depth-first order)
+    with its language, kind, source_id, url, the source_id of its top-level course,
+    its parent path, content-length, and thumbnail. Query results are dicts of
+    the CATALOG_COLUMNS with the original node (without children) under `node`.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path=RESOURCE_CATALOG_PATH, tree_path_tmpl=WEB_RESOURCE_TREE_PATH_TMPL):
+        self.path = path
+        self.tree_path_tmpl = tree_path_tmpl
+        parent_dir, _ = os.path.split(path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS trees ('
+                '  lang TEXT PRIMARY KEY,'
+                '  mtime_ns INTEGER,'
+                '  size INTEGER)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS nodes ('
+                '  lang TEXT NOT NULL,'
+                '  position INTEGER NOT NULL,'
+                '  depth INTEGER NOT NULL,'
+                '  kind TEXT,'
+                '  source_id TEXT,'
+                '  url TEXT,'
+                '  title TEXT,'
+                '  course_id TEXT,'
+                '  parent_url TEXT,'
+                '  parent_path TEXT NOT NULL,'
+                '  content_length INTEGER,'
+                '  thumbnail_url TEXT,'
+                '  node TEXT NOT NULL,'
+                '  PRIMARY KEY (lang, position))'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS nodes_kind ON nodes (kind, lang)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS nodes_source_id ON nodes (source_id)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS nodes_url ON nodes (url)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS nodes_content_length ON nodes (content_length)')
+            self._conn.commit()
+
+    def get_tree_path(self, lang):
+        return self.tree_path_tmpl.format(lang)
+
+    def index_tree(self, lang, tree, signature=(None, None)):
+        """
+        Replace the catalog entries of `lang` with the nodes of the web resource
+        `tree`. The `signature` (mtime_ns, size) of the tree file is used by `sync`.
+        """
+        rows = []
+        stack = [(tree, None, [])]   # (node, parent, source_ids of ancestors)
+        while stack:
+            node, parent, ancestor_ids = stack.pop()
+            source_id = node.get('source_id', None)
+            depth = len(ancestor_ids)
+            if depth == 0:
+                course_id = None
+            elif depth == 1:
+                course_id = source_id
+            else:
+                course_id = ancestor_ids[1]
+            content_length = node.get('content-length', None)
+            if content_length is not None:
+                content_length = int(content_length)
+            node_data = dict((key, value) for key, value in node.items() if key != 'children')
+            rows.append((lang, len(rows), depth, node.get('kind', None), source_id,
+                         node.get('url', None), node.get('title', None), course_id,
+                         parent.get('url', None) if parent else None,
+                         PARENT_PATH_SEPARATOR.join(str(ancestor_id) for ancestor_id in ancestor_ids),
+                         content_length,
+                         node.get('thumbnail_url', node.get('thumbnail', None)),
+                         json.dumps(node_data, ensure_ascii=False)))
+            child_ancestor_ids = ancestor_ids + [source_id]
+            for child in reversed(node.get('children', [])):
+                stack.append((child, node, child_ancestor_ids))
+        with self._lock:
+            self._conn.execute('DELETE FROM nodes WHERE lang = ?', (lang,))
+            self._conn.executemany(
+                'INSERT INTO nodes (' + ', '.join(CATALOG_COLUMNS) + ', node) '
+                'VALUES (' + ', '.join(['?']*(len(CATALOG_COLUMNS) + 1)) + ')', rows)
+            self._conn.execute('INSERT OR REPLACE INTO trees (lang, mtime_ns, size) VALUES (?, ?, ?)',
+                               (lang,) + tuple(signature))
+            self._conn.commit()
+        return len(rows)
+
+    def sync(self, lang):
+        """
+        Index the web resource tree file of `lang` if it changed since it was
+        catalogued. Returns True if the tree was (re)indexed, False if the
+        catalog was up to date or there is no tree file for `lang`.
+        """
+        path = self.get_tree_path(lang)
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            row = self._conn.execute('SELECT mtime_ns, size FROM trees WHERE lang = ?', (lang,)).fetchone()
+        if row is not None and tuple(row) == signature:
+            return False
+        with open(path) as jsonfile:
+            tree = json.load(jsonfile)
+        self.index_tree(lang, tree, signature=signature)
+        return True
+
+    def sync_all(self):
+        """
+        Sync all the languages that have a tree file. Returns the list of
+        languages that were (re)indexed.
+        """
+        prefix, suffix = self.tree_path_tmpl.split('{}')
+        langs = sorted(path[len(prefix):len(path)-len(suffix)] for path in glob.glob(prefix + '*' + suffix))
+        return [lang for lang in langs if self.sync(lang)]
+
+    def get_langs(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT lang FROM trees ORDER BY lang').fetchall()
+        return [row[0] for row in rows]
+
+    def find(self, lang=None, kind=None, source_id=None, url=None, course_id=None,
+             min_content_length=None):
+        """
+        Returns the entries that match all the given criteria, in depth-first
+        order of the tree of each language.
+        """
+        conditions, params = [], []
+        for column, value in [('lang', lang), ('kind', kind), ('source_id', source_id),
+                              ('url', url), ('course_id', course_id)]:
+            if value is not None:
+                conditions.append(column + ' = ?')
+                params.append(value)
+        if min_content_length is not None:
+            conditions.append('content_length >= ?')
+            params.append(min_content_length)
+        query = 'SELECT ' + ', '.join(CATALOG_COLUMNS) + ', node FROM nodes'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY lang, position'
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(CATALOG_COLUMNS, row))
+            entry['node'] = json.loads(row[-1])
+            entries.append(entry)
+        return entries
+
+    def find_shared_urls(self, kind=None, min_langs=2):
+        """
+        Returns a list of (url, langs) for the urls that appear in the trees of
+        at least `min_langs` languages.
+        """
+        query = 'SELECT url, group_concat(DISTINCT lang) FROM nodes WHERE url IS NOT NULL'
+        params = []
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        query += ' GROUP BY url HAVING count(DISTINCT lang) >= ? ORDER BY url'
+        params.append(min_langs)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(url, sorted(langs.split(','))) for url, langs in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_RESOURCE_CATALOG = None
+_RESOURCE_CATALOG_LOCK = threading.Lock()
+
+def get_resource_catalog():
+    """
+    Returns the resource catalog of the chef trees in `chefdata/trees/` (shared
+    by all the users in this process).
+    """
+    global _RESOURCE_CATALOG
+    with _RESOURCE_CATALOG_LOCK:
+        if _RESOURCE_CATALOG is None:
+            _RESOURCE_CATALOG = ResourceCatalog()
+        return _RESOURCE_CATALOG
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Query the catalog of web resources of all languages')
+    parser.add_argument('--path', default=RESOURCE_CATALOG_PATH, help='catalog file')
+    parser.add_argument('--trees', default=WEB_RESOURCE_TREE_PATH_TMPL, help='web resource tree path template')
+    subparsers = parser.add_subparsers(dest='command')
+    sync_parser = subparsers.add_parser('sync', help='index the trees that changed')
+    sync_parser.add_argument('langs', nargs='*', help='default: all languages with a tree')
+    find_parser = subparsers.add_parser('find', help='list the matching nodes')
+    for column in ['lang', 'kind', 'source_id', 'url', 'course_id']:
+        find_parser.add_argument('--' + column)
+    find_parser.add_argument('--min-mb', type=float, help='min content-length in MB')
+    shared_parser = subparsers.add_parser('shared', help='list the urls used in several languages')
+    shared_parser.add_argument('--kind')
+    shared_parser.add_argument('--min-langs', type=int, default=2)
+    args = parser.parse_args()
+    catalog = ResourceCatalog(args.path, tree_path_tmpl=args.trees)
+    if args.command == 'sync':
+        if args.langs:
+            indexed_langs = [lang for lang in args.langs if catalog.sync(lang)]
+        else:
+            indexed_langs = catalog.sync_all()
+        print('Indexed langs:', ' '.join(indexed_langs), '(catalog has', ' '.join(catalog.get_langs()) + ')')
+    elif args.command == 'find':
+        min_content_length = int(args.min_mb*1024*1024) if args.min_mb is not None else None
+        entries = catalog.find(lang=args.lang, kind=args.kind, source_id=args.source_id,
+                               url=args.url, course_id=args.course_id,
+                               min_content_length=min_content_length)
+        for entry in entries:
+            size = '%.2fMB' % (entry['content_length']/1024/1024) if entry['content_length'] is not None else ''
+            print('\t'.join([entry['lang'], str(entry['kind']), str(entry['source_id']), str(entry['url']),
+                             size, entry['parent_path']]))
+    elif args.command == 'shared':
+        for url, langs in catalog.find_shared_urls(kind=args.kind, min_langs=args.min_langs):
+            print(url + '\t' + ','.join(langs))
+    else:
+        parser.print_help()
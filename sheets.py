@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Offline-first local snapshots of the Google sheets used by the chef (structure,
+English structure, and corrections). A sheet is downloaded at most once per
+process, when it is first needed, with a conditional request (ETag and
+Last-Modified) so unchanged sheets are not downloaded again. If the sheet can't
+be downloaded, the last snapshot is used. In offline mode (`--offline` chef
+argument or PRADIGI_OFFLINE=1) only the local snapshots are used.
+
+Each distinct version of a sheet is also kept in `chefdata/sheet_snapshots/`
+so the inputs of past runs can be compared:
+
+    ./sheets.py status
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import requests
+from ricecooker.config import LOGGER
+
+
+SHEET_SNAPSHOTS_DIR = 'chefdata/sheet_snapshots'
+SHEET_SNAPSHOTS_INDEX = os.path.join(SHEET_SNAPSHOTS_DIR, 'index.json')
+OFFLINE_ENV_VAR = 'PRADIGI_OFFLINE'
+
+
+
+# SHEET SNAPSHOTS
+################################################################################
+
+class SheetSnapshotStore(object):
+    """
+    Keeps the CSV export of each sheet in its `csv_path` along with the ETag,
+    Last-Modified, and version (content hash) of the snapshot in the index file.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, snapshots_dir=SHEET_SNAPSHOTS_DIR, index_path=SHEET_SNAPSHOTS_INDEX):
+        self.snapshots_dir = snapshots_dir
+        self.index_path = index_path
+        self._checked = set()   # csv paths already revalidated in this process
+        self._lock = threading.Lock()
+
+    def is_offline(self):
+        return os.environ.get(OFFLINE_ENV_VAR, '') in ['t', 'true', 'True', '1']
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as index_file:
+            return json.load(index_file)
+
+    def save_index(self, index):
+        if not os.path.exists(self.snapshots_dir):
+            os.makedirs(self.snapshots_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(index, index_file, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def get_csv_path(self, url, csv_path):
+        """
+        Returns `csv_path` after making sure it contains the snapshot of the
+        sheet CSV export at `url` (revalidated once per process unless offline).
+        """
+        with self._lock:
+            if csv_path not in self._checked:
+                if self.is_offline():
+                    if not os.path.exists(csv_path):
+                        raise ValueError('No local snapshot of sheet {} in offline mode'.format(csv_path))
+                    LOGGER.info('Offline mode: using local snapshot ' + csv_path)
+                else:
+                    self.revalidate(url, csv_path)
+                self._checked.add(csv_path)
+        return csv_path
+
+    def get_checked(self):
+        """
+        Returns the csv paths of the snapshots already revalidated in this process.
+        """
+        with self._lock:
+            return sorted(self._checked)
+
+    def mark_checked(self, csv_paths):
+        """
+        Use the current snapshots in `csv_paths` without revalidating them, e.g.
+        in worker processes after the snapshots were revalidated by the parent.
+        """
+        with self._lock:
+            self._checked.update(csv_paths)
+
+    def revalidate(self, url, csv_path):
+        """
+        Download the sheet at `url` to `csv_path` unless the saved snapshot is
+        still current. Falls back to the saved snapshot on network errors.
+        """
+        index = self.load_index()
+        entry = index.get(csv_path, {})
+        have_snapshot = os.path.exists(csv_path) and entry.get('url', None) == url
+        headers = {}
+        if have_snapshot:
+            if entry.get('etag', None):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified', None):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = requests.get(url, headers=headers, timeout=60)
+        except requests.exceptions.RequestException as e:
+            if os.path.exists(csv_path):
+                LOGGER.warning('Could not download sheet {} ({}) so using local snapshot {}'.format(url, e, csv_path))
+                return
+            raise
+        if response.status_code == 304 and have_snapshot:
+            LOGGER.info('Sheet {} unchanged (version {})'.format(csv_path, entry.get('version', None)))
+            return
+        if response.status_code != 200:
+            if os.path.exists(csv_path):
+                LOGGER.warning('Status {} for sheet {} so using local snapshot {}'.format(
+                    response.status_code, url, csv_path))
+                return
+            raise ValueError('Could not download sheet {} (status {})'.format(url, response.status_code))
+
+        csv_data = response.content.decode('utf-8')
+        version = hashlib.sha1(response.content).hexdigest()[0:12]
+        with open(csv_path, 'w') as csvfile:
+            csvfile.write(csv_data)
+            LOGGER.info('Succesfully saved ' + csv_path)
+        if version != entry.get('version', None):
+            LOGGER.info('Sheet {} version {} --> {}'.format(csv_path, entry.get('version', None), version))
+            root, ext = os.path.splitext(os.path.basename(csv_path))
+            if not os.path.exists(self.snapshots_dir):
+                os.makedirs(self.snapshots_dir, exist_ok=True)
+            shutil.copyfile(csv_path, os.path.join(self.snapshots_dir, root + '.' + version + ext))
+        index[csv_path] = dict(
+            url=url,
+            etag=response.headers.get('ETag', None),
+            last_modified=response.headers.get('Last-Modified', None),
+            version=version,
+            fetched=datetime.now().isoformat(),
+        )
+        self.save_index(index)
+
+
+SHEET_SNAPSHOTS = SheetSnapshotStore()
+
+
+def set_offline(offline=True):
+    """
+    Use only the local snapshots of the sheets (also in subprocesses).
+    """
+    os.environ[OFFLINE_ENV_VAR] = '1' if offline else '0'
+
+
+def get_sheet_csv_path(url, csv_path):
+    """
+    Returns the path of the up-to-date local snapshot of the sheet at `url`.
+    """
+    return SHEET_SNAPSHOTS.get_csv_path(url, csv_path)
+
+
+def get_sheet_version(csv_path):
+    """
+    Returns the version (content hash) of the local snapshot in `csv_path`,
+    computed the same way as the versions in the snapshots index.
+    """
+    with open(csv_path, 'rb') as csvfile:
+        return hashlib.sha1(csvfile.read()).hexdigest()[0:12]
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the local snapshots of the sheets')
+    parser.add_argument('command', choices=['status'])
+    args = parser.parse_args()
+    for csv_path, entry in sorted(SHEET_SNAPSHOTS.load_index().items()):
+        print('{:<45}{:>14}  {}'.format(csv_path, entry['version'], entry['fetched']))
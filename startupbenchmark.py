@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Track the startup time of the chef entry points. Each entry point is imported
+in a fresh python process (with `-X importtime`) several times and the best and
+median import times, the slowest modules imported directly by the entry point,
+and the number of network connections opened during the import are reported.
+Importing an entry point should not open any network connections.
+
+Usage:
+    ./startupbenchmark.py run                # print startup times
+    ./startupbenchmark.py run --save         # also save them in chefdata/startup_benchmark.json
+    ./startupbenchmark.py run --compare      # compare with the saved startup times
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+STARTUP_BENCHMARK_PATH = 'chefdata/startup_benchmark.json'
+ENTRY_POINTS = ['sushichef', 'fabfile', 'debugutils']
+RESULT_MARKER = 'STARTUP_BENCHMARK_RESULT '
+
+# runs in the child process: counts socket connections and times the import
+IMPORT_TIMER_CODE = """
+import json, socket, sys, time
+connections = []
+socket_connect = socket.socket.connect
+def connect(sock, address):
+    connections.append(str(address))
+    return socket_connect(sock, address)
+socket.socket.connect = connect
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+sys.stdout.write('\\n' + {marker!r} + json.dumps(dict(seconds=elapsed, connections=connections)) + '\\n')
+"""
+
+
+
+# IMPORT TIMING
+################################################################################
+
+def parse_importtime(stderr, module):
+    """
+    Returns the list of (name, cumulative ms) of the modules imported directly
+    by `module` from the `-X importtime` output in `stderr`, slowest first.
+    """
+    entries = []   # (depth, name, cumulative_us) in the order printed
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name_field = line.split('|')
+        depth = (len(name_field) - len(name_field.lstrip()) - 1) // 2
+        entries.append((depth, name_field.strip(), int(cumulative_us)))
+    # children are printed before their parent, after the previous top-level import
+    direct_imports = []
+    for depth, name, cumulative_us in entries:
+        if depth == 0:
+            if name == module:
+                return sorted(direct_imports, key=lambda item: -item[1])
+            direct_imports = []
+        elif depth == 1:
+            direct_imports.append((name, cumulative_us / 1000))
+    return []
+
+
+def time_import(module, env=None):
+    """
+    Import `module` in a new python process. Returns a dict with the import
+    time in `seconds`, the `connections` opened, and the `direct_imports`,
+    or with the `error` printed if the import failed.
+    """
+    code = IMPORT_TIMER_CODE.format(module=module, marker=RESULT_MARKER)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, env=env)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            result = json.loads(line[len(RESULT_MARKER):])
+            result['direct_imports'] = parse_importtime(process.stderr, module)
+            return result
+    error_lines = [line for line in process.stderr.splitlines() if not line.startswith('import time:')]
+    return dict(error=error_lines[-1] if error_lines else 'exit code {}'.format(process.returncode))
+
+
+def run_startup_benchmark(modules=ENTRY_POINTS, repeat=5, top=5):
+    """
+    Time `repeat` imports of each of the entry point `modules`.
+    Returns a list of dicts with one row of results per module.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH', None)]))
+    results = []
+    for module in modules:
+        runs = [time_import(module, env=env) for i in range(repeat)]
+        errors = [run['error'] for run in runs if 'error' in run]
+        if errors:
+            results.append(dict(module=module, error=errors[0]))
+            continue
+        times_ms = [1000*run['seconds'] for run in runs]
+        fastest_run = runs[times_ms.index(min(times_ms))]
+        results.append(dict(
+            module=module,
+            best_ms=min(times_ms),
+            median_ms=statistics.median(times_ms),
+            connections=max(len(run['connections']) for run in runs),
+            direct_imports=fastest_run['direct_imports'][0:top],
+        ))
+    return results
+
+
+def print_startup_benchmark(results, previous=None):
+    previous_by_module = dict((row['module'], row) for row in previous or [] if 'error' not in row)
+    print('{:<20}{:>12}{:>12}{:>13}{:>10}'.format('module', 'best (ms)', 'median (ms)', 'connections', 'change'))
+    for row in results:
+        if 'error' in row:
+            print('{:<20}  import failed: {}'.format(row['module'], row['error']))
+            continue
+        change = ''
+        if row['module'] in previous_by_module:
+            previous_ms = previous_by_module[row['module']]['best_ms']
+            change = '{:+.0f}%'.format(100*(row['best_ms'] - previous_ms)/previous_ms)
+        print('{module:<20}{best_ms:>12.1f}{median_ms:>12.1f}{connections:>13}'.format(**row) + '{:>10}'.format(change))
+        for name, cumulative_ms in row['direct_imports']:
+            print('    {:<36}{:>8.1f}'.format(name, cumulative_ms))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PraDigi chef startup time benchmark')
+    parser.add_argument('command', choices=['run'])
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS, help='entry point modules to import')
+    parser.add_argument('--repeat', type=int, default=5, help='number of imports of each module')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest direct imports to show')
+    parser.add_argument('--save', action='store_true', help='save results in ' + STARTUP_BENCHMARK_PATH)
+    parser.add_argument('--compare', action='store_true', help='compare with saved results')
+    args = parser.parse_args()
+    previous = None
+    if args.compare and os.path.exists(STARTUP_BENCHMARK_PATH):
+        with open(STARTUP_BENCHMARK_PATH) as json_file:
+            previous = json.load(json_file)
+    results = run_startup_benchmark(modules=args.modules, repeat=args.repeat, top=args.top)
+    print_startup_benchmark(results, previous=previous)
+    if args.save:
+        with open(STARTUP_BENCHMARK_PATH, 'w') as json_file:
+            json.dump(results, json_file, ensure_ascii=False, indent=2)
@@ -1,15 +1,17 @@
 import csv
-from itertools import groupby
-from operator import itemgetter
+import json
 
 
 import logging
-import requests
+import os
+import threading
 
 from ricecooker.config import LOGGER
 
 from le_utils.constants import content_kinds
 
+from sheets import get_sheet_csv_path, get_sheet_version
+
 LOGGER.setLevel(logging.DEBUG)
 
 # NEW VOCATIONAL STRUCTURE
@@ -100,20 +102,14 @@ PRADIGI_ENGLISH_SHEET_CSV_PATH = 'chefdata/pradigi_english_structure.csv'
 
 
 def download_structure_csv(which=None):
+    """
+    Returns the path of the local snapshot of the structure sheet (downloaded
+    at most once per process, see sheets.py).
+    """
     if which == 'English':
-        response = requests.get(PRADIGI_ENGLISH_SHEET_CSV_URL)
-        csv_data = response.content.decode('utf-8')
-        with open(PRADIGI_ENGLISH_SHEET_CSV_PATH, 'w') as csvfile:
-            csvfile.write(csv_data)
-            LOGGER.info('Succesfully saved ' + PRADIGI_ENGLISH_SHEET_CSV_PATH)
-        return PRADIGI_ENGLISH_SHEET_CSV_PATH
+        return get_sheet_csv_path(PRADIGI_ENGLISH_SHEET_CSV_URL, PRADIGI_ENGLISH_SHEET_CSV_PATH)
     else:
-        response = requests.get(PRADIGI_SHEET_CSV_URL)
-        csv_data = response.content.decode('utf-8')
-        with open(PRADIGI_SHEET_CSV_PATH, 'w') as csvfile:
-            csvfile.write(csv_data)
-            LOGGER.info('Succesfully saved ' + PRADIGI_SHEET_CSV_PATH)
-        return PRADIGI_SHEET_CSV_PATH
+        return get_sheet_csv_path(PRADIGI_SHEET_CSV_URL, PRADIGI_SHEET_CSV_PATH)
 
 def _clean_dict(row):
     """
@@ -127,8 +123,7 @@ def _clean_dict(row):
             row_cleaned[key] = val.strip()
     return row_cleaned
 
-def load_pradigi_structure(which=None):
-    csv_path = download_structure_csv(which=which)
+def parse_structure_csv(csv_path):
     struct_list = []
     with open(csv_path, 'r') as csvfile:
         reader = csv.DictReader(csvfile, fieldnames=PRADIGI_SHEET_CSV_FILEDNAMES)
@@ -152,13 +147,159 @@ def load_pradigi_structure(which=None):
     return struct_list
 
 
+# the sheets are loaded when first needed (not on import) and parsed once
+_STRUCTURE_CACHE = {}
+_STRUCTURE_CACHE_LOCK = threading.RLock()
+
+def get_struct_list(which=None):
+    """
+    Returns the rows of the structure sheet (the English one if `which='English'`).
+    The list is shared by all callers so it must not be modified.
+    """
+    with _STRUCTURE_CACHE_LOCK:
+        key = ('struct_list', which)
+        if key not in _STRUCTURE_CACHE:
+            _STRUCTURE_CACHE[key] = parse_structure_csv(download_structure_csv(which=which))
+        return _STRUCTURE_CACHE[key]
+
+def load_pradigi_structure(which=None):
+    return list(get_struct_list(which=which))
+
+
 
 
 
-PRADIGI_STRUCT_LIST = load_pradigi_structure()
-PRADIGI_ENGLISH_STRUCT_LIST = load_pradigi_structure(which='English')
+# PLACEMENT PLAN
+################################################################################
 
+PLACEMENT_PLAN_VERSION = 2
+PLACEMENT_PLAN_PATH = 'chefdata/trees/pradigi_placement_plan.json'
+ANY_LANGUAGE = '*'   # placements for the languages not named in `Use Only In`
 
+class PlacementPlan(object):
+    """
+    Placement of content in the channel compiled once from the structure rows:
+    the subjects of each age group (template of the language subtrees) and, for
+    each (language_en, age_group, subject_en), the website subjects and the game
+    rows to include, with the `Use Only In` filter already applied.
+    The plan is saved as JSON with the versions of the structure CSVs it was
+    compiled from, and loaded again instead of compiled while they don't change.
+    """
+
+    def __init__(self, subjects_by_age_group, placements, source_versions=None):
+        self.subjects_by_age_group = subjects_by_age_group  # age_group --> [subject_en]
+        self.placements = placements  # language_en --> age_group --> subject_en --> resources
+        self.source_versions = source_versions or {}  # csv_path --> sheet version
+
+    @classmethod
+    def compile(cls, struct_list, english_struct_list):
+        """
+        Build the plan from the rows of the structure CSV and of the English one.
+        """
+        subjects_in_age_group = {}
+        for row in struct_list + english_struct_list:
+            subjects_in_age_group.setdefault(row[AGE_GROUP_KEY], set()).add(row[SUBJECT_KEY])
+        subjects_by_age_group = {}
+        for age_group in PRADIGI_AGE_GROUPS:
+            subjects = subjects_in_age_group.get(age_group, set())
+            subjects_by_age_group[age_group] = [subject_en for subject_en in PRADIGI_SUBJECTS if subject_en in subjects]
+
+        placements = {ANY_LANGUAGE: cls.compile_rows(struct_list, None)}
+        languages_en = set(row[USE_ONLY_IN_KEY] for row in struct_list if row[USE_ONLY_IN_KEY])
+        for language_en in sorted(languages_en):
+            placements[language_en] = cls.compile_rows(struct_list, language_en)
+        placements['English'] = cls.compile_rows(english_struct_list, 'English')
+        return cls(subjects_by_age_group, placements)
+
+    @staticmethod
+    def compile_rows(struct_list, language_en):
+        """
+        Returns age_group --> subject_en --> {'website': [...], 'games': [...]}
+        for the rows of `struct_list` used in `language_en`.
+        """
+        placements = {}
+        for row in struct_list:
+            if row[USE_ONLY_IN_KEY] and not row[USE_ONLY_IN_KEY] == language_en:
+                # skip row if USE_ONLY set and different from current language
+                continue
+            subject_en = row[SUBJECT_KEY]
+            resources = placements.setdefault(row[AGE_GROUP_KEY], {}).setdefault(
+                subject_en, {'website': [], 'games': []})
+            if row[RESOURCE_TYPE_KEY] == 'Game':
+                resources['games'].append(row)
+            elif row[RESOURCE_TYPE_KEY] == 'Website Resources':
+                resources['website'].append(subject_en)
+            else:
+                print('Unknown resource type', row[RESOURCE_TYPE_KEY], 'in row', row)
+        return placements
+
+    def get_resources(self, age_group, subject_en, language_en):
+        placements = self.placements.get(language_en, self.placements[ANY_LANGUAGE])
+        resources = placements.get(age_group, {}).get(subject_en, None)
+        if resources is None:
+            return {'website': [], 'games': []}
+        return {'website': list(resources['website']), 'games': list(resources['games'])}
+
+    def to_dict(self):
+        return dict(
+            version=PLACEMENT_PLAN_VERSION,
+            source_versions=self.source_versions,
+            subjects_by_age_group=self.subjects_by_age_group,
+            placements=self.placements,
+        )
+
+    @classmethod
+    def from_dict(cls, plan_dict):
+        if plan_dict.get('version', None) != PLACEMENT_PLAN_VERSION:
+            raise ValueError('Unsupported placement plan version ' + str(plan_dict.get('version', None)))
+        return cls(plan_dict['subjects_by_age_group'], plan_dict['placements'],
+                   source_versions=plan_dict['source_versions'])
+
+    def save(self, path=PLACEMENT_PLAN_PATH):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as jsonfile:
+            json.dump(self.to_dict(), jsonfile, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=PLACEMENT_PLAN_PATH):
+        with open(path) as jsonfile:
+            return cls.from_dict(json.load(jsonfile))
+
+
+def load_current_placement_plan(source_versions, path=PLACEMENT_PLAN_PATH):
+    """
+    Returns the PlacementPlan saved in `path` if it was compiled from the
+    structure CSVs with `source_versions`, otherwise None.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        plan = PlacementPlan.load(path=path)
+    except (ValueError, KeyError) as e:
+        LOGGER.info('Not using saved placement plan {} ({})'.format(path, e))
+        return None
+    if plan.source_versions != source_versions:
+        LOGGER.info('Structure sheets changed since placement plan {} was saved'.format(path))
+        return None
+    LOGGER.info('Using saved placement plan ' + path)
+    return plan
+
+def get_placement_plan():
+    """
+    Returns the PlacementPlan for the current structure sheets: the saved plan
+    if the sheets didn't change since it was compiled, else a newly compiled one.
+    """
+    with _STRUCTURE_CACHE_LOCK:
+        if 'placement_plan' not in _STRUCTURE_CACHE:
+            csv_paths = [download_structure_csv(), download_structure_csv(which='English')]
+            source_versions = dict((csv_path, get_sheet_version(csv_path)) for csv_path in csv_paths)
+            plan = load_current_placement_plan(source_versions)
+            if plan is None:
+                plan = PlacementPlan.compile(get_struct_list(), get_struct_list(which='English'))
+                plan.source_versions = source_versions
+            _STRUCTURE_CACHE['placement_plan'] = plan
+        return _STRUCTURE_CACHE['placement_plan']
 
 
 
@@ -170,9 +311,6 @@ def get_tree_for_lang_from_structure():
         kind=content_kinds.TOPIC,
         children=[],
     )
-    struct_list = PRADIGI_STRUCT_LIST + PRADIGI_ENGLISH_STRUCT_LIST
-    struct_list = sorted(struct_list, key=itemgetter(AGE_GROUP_KEY, SUBJECT_KEY))
-    age_groups_dict = dict((k, list(g)) for k, g in groupby(struct_list, key=itemgetter(AGE_GROUP_KEY)))
     for age_group_title in PRADIGI_AGE_GROUPS:
         age_groups_subtree = dict(
             title=age_group_title,
@@ -180,21 +318,24 @@ def get_tree_for_lang_from_structure():
             children=[],
         )
         lang_tree['children'].append(age_groups_subtree)
-        items_in_age_group = list(age_groups_dict[age_group_title])
-        items_in_age_group = sorted(items_in_age_group, key=itemgetter(SUBJECT_KEY))
-        subjects_dict = dict((k, list(g)) for k, g in groupby(items_in_age_group, key=itemgetter(SUBJECT_KEY)))
-        for subject_en in PRADIGI_SUBJECTS:
-            if subject_en in subjects_dict:
-                subject_subtree = dict(
-                    title=subject_en,
-                    kind=content_kinds.TOPIC,
-                    children=[],
-                )
-                age_groups_subtree['children'].append(subject_subtree)
+        for subject_en in get_placement_plan().subjects_by_age_group[age_group_title]:
+            subject_subtree = dict(
+                title=subject_en,
+                kind=content_kinds.TOPIC,
+                children=[],
+            )
+            age_groups_subtree['children'].append(subject_subtree)
     # print('lang_tree=', lang_tree, flush=True)
     return lang_tree
 
-TEMPLATE_FOR_LANG = get_tree_for_lang_from_structure()
+def get_template_for_lang():
+    """
+    Returns the template structure for language-subtrees (shared, do not modify).
+    """
+    with _STRUCTURE_CACHE_LOCK:
+        if 'template_for_lang' not in _STRUCTURE_CACHE:
+            _STRUCTURE_CACHE['template_for_lang'] = get_tree_for_lang_from_structure()
+        return _STRUCTURE_CACHE['template_for_lang']
 
 
 
@@ -207,26 +348,4 @@ def get_resources_for_age_group_and_subject(age_group, subject_en, language_en):
         'games': [{game struct row}, {anothe game row}, ...]   # Include localized verison of games in this list
     }
     """
-    # print('in get_resources_for_age_group_and_subject with', age_group, subject_en, flush=True)
-    if language_en == 'English':
-        struct_list = PRADIGI_ENGLISH_STRUCT_LIST
-    else:
-        struct_list = PRADIGI_STRUCT_LIST
-    website = []
-    games = []
-    for row in struct_list:
-        if row[AGE_GROUP_KEY] == age_group and row[SUBJECT_KEY] == subject_en:
-            if row[USE_ONLY_IN_KEY] and not row[USE_ONLY_IN_KEY] == language_en:
-                # skip row if USE_ONLY set and different from current language
-                continue
-            if row[RESOURCE_TYPE_KEY] == 'Game':
-                games.append(row)
-            elif row[RESOURCE_TYPE_KEY] == 'Website Resources':
-                website.append(subject_en)
-            else:
-                print('Unknown resource type', row[RESOURCE_TYPE_KEY], 'in row', row)
-    # print('games=', games, flush=True)
-    return {'website':website, 'games':games}
-
-
-
+    return get_placement_plan().get_resources(age_group, subject_en, language_en)
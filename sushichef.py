@@ -15,31 +15,40 @@ sources into a single channel:
 https://docs.google.com/spreadsheets/d/1kPOnTVZ5vwq038x1aQNlA2AFtliLIcc2Xk5Kxr852mg/edit#gid=342105160
 """
 
-from cachecontrol.heuristics import OneDayCache
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import copy
 import json
 import logging
 import os
-import requests
 import shutil
+import threading
+import time
 
 from le_utils.constants import content_kinds, file_types, licenses
 from le_utils.constants.languages import getlang
 from ricecooker.chefs import JsonTreeChef
 from ricecooker.classes.licenses import get_license
 from ricecooker.config import LOGGER
-from ricecooker.utils.caching import (FileCache, CacheControlAdapter)
 from ricecooker.utils.jsontrees import write_tree_to_json_tree
 
+# record or replay all HTTP responses (set before structure and corrections CSVs are downloaded)
+import httparchive
+HTTP_ARCHIVE = httparchive.install_from_environment()
+
+import sheets
 from structure import GAMENAME_KEY, TAKE_FROM_KEY
-from structure import TEMPLATE_FOR_LANG
+from structure import get_template_for_lang
 from structure import get_resources_for_age_group_and_subject
 from structure import load_pradigi_structure
+from structure import get_placement_plan
 from structure import LANGS_WITH_NEW_VOCATIONAL_STRUCTURE, VOCATIONAL_SUBJECTS
 from transform import HTML5APP_ZIPS_LOCAL_DIR
-from transform import get_zip_file
-from transform import get_phet_zip_file
-from corrections import should_skip_file
+from transform import ZipFileJob, ZipFileJobs
+from corrections import get_corrections_rules, should_skip_file
+from resourcecache import VideoMetadataStore
+from resourcecatalog import get_resource_catalog
+from treestore import TREE_STORE
 
 
 
@@ -61,14 +70,6 @@ PRADIGI_DESCRIPTION = 'Developed by Pratham, these educational games, videos, '
 LOGGER.setLevel(logging.DEBUG)
 DEBUG_MODE = True  # source_urls in content desriptions
 
-# WebCache logic (downloaded web resources cached for one day -- good for dev)
-cache = FileCache('.webcache')
-basic_adapter = CacheControlAdapter(cache=cache)
-develop_adapter = CacheControlAdapter(heuristic=OneDayCache(), cache=cache)
-session = requests.Session()
-session.mount('http://www.' + PRADIGI_DOMAIN, develop_adapter)
-session.mount('https://www.' + PRADIGI_DOMAIN, develop_adapter)
-
 
 # SOURCE WEBSITES
 ################################################################################
@@ -398,55 +399,65 @@ PRADIGI_STRINGS = {
 ################################################################################
 
 def get_subtree_by_subject_en(lang, subject):
+    """
+    Returns the top-level subtree of the `lang` web resource tree whose
+    `subject_en` or `source_id` is `subject` (shared, do not modify).
+    """
     if lang not in PRADIGI_LANG_URL_MAP:
         raise ValueError('Language `lang` must be in PRADIGI_LANG_URL_MAP')
-    wrt_filename = 'chefdata/trees/pradigi_{}_web_resource_tree.json'.format(lang)
-    with open(wrt_filename) as jsonfile:
-        web_resource_tree = json.load(jsonfile)
-    subject_subtrees = web_resource_tree['children']
-    try:
-        for subject_subtree in subject_subtrees:
-            if 'subject_en' in subject_subtree and subject_subtree['subject_en'] == subject:
-                return subject_subtree
-            elif 'source_id' in subject_subtree and subject_subtree['source_id'] == subject:
-                return subject_subtree
-            else:
-                pass
-                # print('no subject_en in '+ subject_subtree['source_id'])
-    except Exception as e:
-        LOGGER.error("in get_subtree_by_subject_en: %s, %s, %s, %s" %
-                     (lang, subject, subject_subtree, e))
-    return None
+    return TREE_STORE.get_tree(lang).get_subject_subtree(subject)
 
 
 def get_subtree_by_source_id(lang, source_id):
     """
-    Walk the `lang` web resouce tree and finds the subtree that has `source_id`.
+    Returns the first subtree of the `lang` web resouce tree that has `source_id`
+    in depth-first order (shared, do not modify).
     """
     if lang not in PRADIGI_LANG_URL_MAP:
         raise ValueError('Language `lang` must be in PRADIGI_LANG_URL_MAP')
-    wrt_filename = 'chefdata/trees/pradigi_{}_web_resource_tree.json'.format(lang)
-    with open(wrt_filename) as jsonfile:
-        web_resource_tree = json.load(jsonfile)
-    # setup recusive find function
-    def recursive_find_by_source_id(subtree, source_id):
-        if subtree['source_id'] == source_id:
-            return subtree
-        if 'children' in subtree:
-            for child in subtree['children']:
-                result = recursive_find_by_source_id(child, source_id)
-                if result is not None:
-                    return result
-        return None
-    # use it on wrt
-    return recursive_find_by_source_id(web_resource_tree, source_id)
+    return TREE_STORE.get_tree(lang).get_by_source_id(source_id)
+
+
+
+def get_zip_file_path(zip_file_url, main_file, zip_jobs=None):
+    """
+    Returns the path of the zip file for an HTML5 node (None if it failed). If
+    `zip_jobs` is given, the zip file is added to it and, until its job is done,
+    the path is a placeholder for the zip file produced later, else it is produced now.
+    """
+    if zip_jobs is not None:
+        job = zip_jobs.add(zip_file_url, main_file)
+        return job.path if job.done else job.placeholder
+    return ZipFileJob(zip_file_url, main_file).run()
 
 
+def iter_ricecooker_children(tree, lang, filter_fn=lambda node: True, zip_jobs=None):
+    """
+    Generates the ricecooker nodes for the children of the web resource subtree
+    `tree` that pass `filter_fn`, skipping children with duplicate `source_id`s.
+    """
+    source_ids_seen_so_far = set()
+    for child in tree['children']:
+        if filter_fn(child):
+            try:
+                ricocooker_node = wrt_to_ricecooker_tree(child, lang, filter_fn=filter_fn, zip_jobs=zip_jobs)
+                if ricocooker_node:
+                    new_source_id = ricocooker_node['source_id']
+                    if new_source_id not in source_ids_seen_so_far:
+                        source_ids_seen_so_far.add(new_source_id)
+                        yield ricocooker_node
+                    else:
+                        print('Skipping node with duplicate source_id', ricocooker_node)
+            except Exception as e:
+                LOGGER.error("Failed to generate node for %s in %s %s " % (child['title'], lang, e) )
+                pass
 
-def wrt_to_ricecooker_tree(tree, lang, filter_fn=lambda node: True):
+
+def wrt_to_ricecooker_tree(tree, lang, filter_fn=lambda node: True, zip_jobs=None):
     """
     Transforms web resource subtree `tree` into a riccecooker tree of topics nodes,
     and content nodes, using `filter_fn` to determine if each node should be included or not.
+    Pass `zip_jobs` (a ZipFileJobs) to defer the processing of zip files.
     """
     kind = tree['kind']
     if kind in ['topic_page', 'subtopic_page', 'lesson_page', 'fun_page', 'story_page', 'special_subtopic_page']:
@@ -461,21 +472,8 @@ def wrt_to_ricecooker_tree(tree, lang, filter_fn=lambda node: True):
             license=PRADIGI_LICENSE,
             children=[],
         )
-        source_ids_seen_so_far = []
-        for child in tree['children']:
-            if filter_fn(child):
-                try:
-                    ricocooker_node = wrt_to_ricecooker_tree(child, lang, filter_fn=filter_fn)
-                    if ricocooker_node:
-                        new_source_id = ricocooker_node['source_id']
-                        if new_source_id not in source_ids_seen_so_far:
-                            topic_node['children'].append(ricocooker_node)
-                            source_ids_seen_so_far.append(new_source_id)
-                        else:
-                            print('Skipping node with duplicate source_id', ricocooker_node)
-                except Exception as e:
-                    LOGGER.error("Failed to generate node for %s in %s %s " % (child['title'], lang, e) )
-                    pass
+        topic_node['children'].extend(
+            iter_ricecooker_children(tree, lang, filter_fn=filter_fn, zip_jobs=zip_jobs))
         return topic_node
 
     elif kind == 'PrathamVideoResource':
@@ -517,10 +515,7 @@ def wrt_to_ricecooker_tree(tree, lang, filter_fn=lambda node: True):
             license=PRADIGI_LICENSE,
             files=[],
         )
-        if 'phet.zip' in tree['url']:
-            zip_tmp_path  = get_phet_zip_file(tree['url'], tree['main_file'])
-        else:
-            zip_tmp_path  = get_zip_file(tree['url'], tree['main_file'])
+        zip_tmp_path = get_zip_file_path(tree['url'], tree['main_file'], zip_jobs=zip_jobs)
         if zip_tmp_path is None:
             raise ValueError('Could not get zip file from %s' % tree['url'])
         html5zip_file = dict(
@@ -561,7 +556,7 @@ def should_compress_video(video_web_resource):
     to upload to Studio the original files. We compress large vidoes (> 30MB) in
     order to limit storage and transfer needs.
     """
-    size_bytes = video_web_resource['content-length']
+    size_bytes = get_video_size_bytes(video_web_resource)
     size_mb = int(size_bytes)/1024/1024
     if size_mb > 30:
         return True
@@ -569,60 +564,113 @@ def should_compress_video(video_web_resource):
         return False
 
 
+_VIDEO_METADATA_STORE = None
+
+def get_video_size_bytes(video_web_resource):
+    """
+    Returns the 'content-length' of the video from the video metadata store,
+    falling back to the value saved in the web resource tree (None if unknown).
+    """
+    global _VIDEO_METADATA_STORE
+    if _VIDEO_METADATA_STORE is None:
+        _VIDEO_METADATA_STORE = VideoMetadataStore()   # read-only (no HEAD requests)
+    size_bytes = _VIDEO_METADATA_STORE.get_content_length(video_web_resource['url'])
+    if size_bytes is None:
+        size_bytes = video_web_resource.get('content-length', None)
+    return size_bytes
+
+
 
 
 # GAMESREPO UTILS
 ################################################################################
 
-def find_games_for_lang(name, lang, take_from=None):
+WEBSITE_GAMES_OUTPUT = 'chefdata/trees/website_games_all_langs.json'
+
+
+def get_game_base_name(title_en, lang):
     """
-    Find first game from the following sources:
-      1. flattended website games list for `lang`
+    Returns the game name `title_en` without the `_LANG` suffixes used for `lang`.
     """
     suffixes = PRADIGI_STRINGS[lang]['gamesrepo_suffixes']
     suffixes = suffixes*2   # Double list to implement two-passes (needed for multi-suffix games)
     suffixes.append('_KKS_Hi')  # Mar 2nd Hi game used in other laguages
     suffixes.append('_KKS_MR')  # Mar 2nd MR game used in other laguages
-    language_en = PRADIGI_STRINGS[lang]['language_en'] # ???
+    title = title_en
+    for suffix in suffixes:
+        if title.strip().endswith(suffix):
+            title = title.replace(suffix, '').strip()
+    return title
 
-    # load website game web resource data
-    WEBSITE_GAMES_OUTPUT = 'chefdata/trees/website_games_all_langs.json'
-    website_data = json.load(open(WEBSITE_GAMES_OUTPUT, 'r'))
-    if lang in website_data:
-        website_data_lang = website_data[lang]
-    else:
-        website_data_lang = []
-
-    games = []
-    #
-    # Get game from website_games json by title_en (ignoring _LANG suffixes)
-    for game_resource in website_data_lang:
-        title = game_resource['title_en']
-        for suffix in suffixes:
-            if title.strip().endswith(suffix):
-                title = title.replace(suffix, '').strip()
-        if name == title:
-            # source_id = game_resource['source_id']
-            if len(games) == 0:
-                games.append(game_resource)
-        else:
-            if game_resource['title_en'].startswith(name):
-                print('>>>>> skipping game_resource', game_resource, 'even though it is similar', name, 'in lang', lang)
 
-    if len(games) == 0:
-        pass
-        # print('game', name, 'not found for lang', lang)
+class WebsiteGameIndex(object):
+    """
+    Index of the website games of each language (extracted from the web resource
+    trees by `extract_website_games_from_tree`) by base game name.
+    """
+
+    def __init__(self, website_games):
+        self.website_games = website_games   # lang --> list of game web resources
+        self.by_lang = {}                    # lang --> base name --> list of games
+        for lang, games in website_games.items():
+            index = {}
+            for game in games:
+                index.setdefault(get_game_base_name(game['title_en'], lang), []).append(game)
+            self.by_lang[lang] = index
+
+    def find(self, name, lang):
+        """
+        Returns the list of games in `lang` whose base name is `name` (all of them).
+        """
+        return self.by_lang.get(lang, {}).get(name, [])
+
+    def find_near_misses(self, name, lang):
+        """
+        Returns the games in `lang` whose name starts with `name` even though
+        their base name is different.
+        """
+        return [game for game in self.website_games.get(lang, [])
+                if game['title_en'].startswith(name) and get_game_base_name(game['title_en'], lang) != name]
+
+
+_WEBSITE_GAME_INDEX = None   # (signature of WEBSITE_GAMES_OUTPUT file, WebsiteGameIndex)
+_WEBSITE_GAME_INDEX_LOCK = threading.Lock()
+
+def get_website_game_index():
+    """
+    Returns the WebsiteGameIndex for the games saved in WEBSITE_GAMES_OUTPUT
+    (built again only if the file changed).
+    """
+    global _WEBSITE_GAME_INDEX
+    stat = os.stat(WEBSITE_GAMES_OUTPUT)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _WEBSITE_GAME_INDEX_LOCK:
+        if _WEBSITE_GAME_INDEX is None or _WEBSITE_GAME_INDEX[0] != signature:
+            with open(WEBSITE_GAMES_OUTPUT, 'r') as json_file:
+                website_games = json.load(json_file)
+            _WEBSITE_GAME_INDEX = (signature, WebsiteGameIndex(website_games))
+        return _WEBSITE_GAME_INDEX[1]
+
 
-    return games
+def find_games_for_lang(name, lang, take_from=None):
+    """
+    Find first game from the following sources:
+      1. flattended website games list for `lang`
+    Games with similar names are reported by `debugutils.print_game_near_misses`.
+    """
+    if lang not in PRADIGI_STRINGS:
+        raise ValueError('Language `lang` must be in PRADIGI_STRINGS')
+    return get_website_game_index().find(name, lang)[0:1]
 
 
 
 # WEBSITE GAME JSON to RICECOOKER JSON
 ################################################################################
 
-def website_game_webresouce_to_ricecooker_node(lang, web_resource):
+def website_game_webresouce_to_ricecooker_node(lang, web_resource, zip_jobs=None):
     """
     Create Ricecooker Json structure for game from web resource dict `web_resource`.
+    Pass `zip_jobs` (a ZipFileJobs) to defer the processing of the zip file.
     """
     game_node = dict(
         kind=content_kinds.HTML5,
@@ -634,7 +682,7 @@ def website_game_webresouce_to_ricecooker_node(lang, web_resource):
         thumbnail=web_resource.get('thumbnail_url'),
         files=[],
     )
-    zip_tmp_path = get_zip_file(web_resource['url'], web_resource['main_file'])
+    zip_tmp_path = get_zip_file_path(web_resource['url'], web_resource['main_file'], zip_jobs=zip_jobs)
     if zip_tmp_path:
         zip_file = dict(
             file_type=file_types.HTML5,
@@ -666,21 +714,72 @@ def get_all_game_names():
             game_names.append(struct_row[GAMENAME_KEY])
     return game_names
 
-ALL_MANUALLY_CURATED_GAME_NAMES = get_all_game_names()
+
+class GameNamePrefixIndex(object):
+    """
+    Sorted list of game names to find the longest name that is a prefix of a
+    string with a few bisections instead of a `startswith` check for each name.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def find_prefix(self, string):
+        """
+        Returns the longest name that `string` starts with, or None.
+        """
+        hi = bisect_right(self.names, string)
+        while hi > 0:
+            name = self.names[hi - 1]
+            if string.startswith(name):
+                return name
+            # names between the common prefix and `name` can't be prefixes of `string`
+            common_prefix = os.path.commonprefix([name, string])
+            hi = bisect_right(self.names, common_prefix, 0, hi - 1)
+        return None
+
+_WEBSITE_GAME_NAME_INDEX = None
+_WEBSITE_GAME_NAME_INDEX_LOCK = threading.Lock()
+
+def get_website_game_name_index():
+    """
+    Returns the GameNamePrefixIndex of the game names in the structure CSVs
+    (built when first needed so importing the chef doesn't load the sheets).
+    """
+    global _WEBSITE_GAME_NAME_INDEX
+    with _WEBSITE_GAME_NAME_INDEX_LOCK:
+        if _WEBSITE_GAME_NAME_INDEX is None:
+            _WEBSITE_GAME_NAME_INDEX = GameNamePrefixIndex(get_all_game_names())
+        return _WEBSITE_GAME_NAME_INDEX
+
+WEBSITE_GAMES_URL_PREFIXES = [
+    'https://www.prathamopenschool.org/CourseContent/Games/',
+    'http://www.prathamopenschool.org/CourseContent/Games/',
+]
+
+
+def match_website_game(url):
+    """
+    Checks if a `url` is a website game, i.e. a file in the website games dir
+    whose name starts with a game name from the structure CSV.
+    Returns (`title_en`, game name) where `title_en` is the path of the file
+    in the games dir without `.zip`, or None if `url` is not a website game.
+    """
+    for prefix in WEBSITE_GAMES_URL_PREFIXES:
+        if url.startswith(prefix):
+            url_path = url[len(prefix):]
+            game_name = get_website_game_name_index().find_prefix(url_path)
+            if game_name is None:
+                return None
+            return url_path.replace('.zip', ''), game_name
+    return None
 
 
 def is_website_game(url):
     """
     Checks if a `url` is a website game.
     """
-    if 'CourseContent/Games' not in url:
-        return False
-    url_path = url.replace('https://www.prathamopenschool.org/CourseContent/Games/', '')
-    url_path = url_path.replace('http://www.prathamopenschool.org/CourseContent/Games/', '')
-    for name in ALL_MANUALLY_CURATED_GAME_NAMES:
-        if url_path.startswith(name):
-            return True
-    return False
+    return match_website_game(url) is not None
 
 
 def extract_website_games_from_tree(lang):
@@ -692,9 +791,7 @@ def extract_website_games_from_tree(lang):
     if lang not in PRADIGI_LANG_URL_MAP:
         raise ValueError('Language `lang` must be in PRADIGI_LANG_URL_MAP')
     # READ IN
-    wrt_filename = 'chefdata/trees/pradigi_{}_web_resource_tree.json'.format(lang)
-    with open(wrt_filename) as jsonfile:
-        web_resource_tree = json.load(jsonfile)
+    web_resource_tree = TREE_STORE.get_tree(lang).tree
     # PROCESS
     website_games = []
     def recursive_extract_website_games(subtree):
@@ -708,11 +805,11 @@ def extract_website_games_from_tree(lang):
             for child in subtree['children']:
                 child_url = child['url']
                 if child['kind'] == 'PrathamZipResource':
-                    if is_website_game(child_url):
+                    website_game_match = match_website_game(child_url)
+                    if website_game_match:
+                        child = dict(child)   # tree nodes are shared by the TREE_STORE users
                         # extract all game names referenced in manual curation Excel file to process separately...
-                        child_url = child_url.replace('https://www.prathamopenschool.org/CourseContent/Games/', '')
-                        child_url = child_url.replace('http://www.prathamopenschool.org/CourseContent/Games/', '')
-                        child['title_en'] = child_url.replace('.zip', '')
+                        child['title_en'], game_name = website_game_match
                         print('EXTRACTED game name', child['title_en'], 'form url', child['url'])
                         website_games.append(child)
                     else:
@@ -736,6 +833,78 @@ def extract_website_games_from_tree(lang):
 
 
 
+# SELECTIVE CRAWL
+################################################################################
+
+def get_website_course_ids(lang, website_subjects):
+    """
+    Returns the course ids to look up in the `lang` web resource tree for the
+    `website_subjects` selected in the structure CSV.
+    """
+    course_ids = []
+    for desired_subject_en in website_subjects:
+        # Aug 27: custom logic to skip top-level vocational subjects
+        #         since they are now subtopics under Vocational
+        if lang in LANGS_WITH_NEW_VOCATIONAL_STRUCTURE:
+            if desired_subject_en in VOCATIONAL_SUBJECTS:
+                print('Skipping vocational subject', desired_subject_en, 'in', lang)
+                continue
+
+        # manual course_id rename for courses where subject_en not the same as cateogy_id
+        lookup_table = PRADIGI_STRINGS[lang]['course_ids_by_subject_en']
+        if desired_subject_en in lookup_table:
+            desired_subject_en = lookup_table[desired_subject_en]
+        course_ids.append(desired_subject_en)
+    return course_ids
+
+
+WEBSITE_GAME_COURSE_IDS_PATH_TMPL = 'chefdata/trees/pradigi_{}_game_course_ids.json'
+
+def save_website_game_course_ids(lang):
+    """
+    Saves the top-level course ids where website games were found in the `lang`
+    web resource tree, used by the selective crawls until the next full crawl.
+    Call only after a full crawl of `lang` (a selective crawl may skip games).
+    """
+    catalog = get_resource_catalog()
+    catalog.sync(lang)
+    course_ids = set()
+    for entry in catalog.find(lang=lang, kind='PrathamZipResource'):
+        if entry['course_id'] is not None and is_website_game(entry['url']):
+            course_ids.add(entry['course_id'])
+    path = WEBSITE_GAME_COURSE_IDS_PATH_TMPL.format(lang)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as jsonfile:
+        json.dump(sorted(course_ids), jsonfile, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def get_selected_course_ids(lang):
+    """
+    Returns the set of top-level course ids that `build_subtree_for_lang` uses:
+    the website subjects of all age groups in the structure CSV and the courses
+    where website games were found in the last full crawl of `lang` (saved by
+    `save_website_game_course_ids`). Returns None (crawl all courses) if `lang`
+    was never fully crawled, since games can be anywhere on the website.
+    """
+    path = WEBSITE_GAME_COURSE_IDS_PATH_TMPL.format(lang)
+    if not os.path.exists(path):
+        LOGGER.info('No game course ids from a full crawl of lang {} so crawling all courses'.format(lang))
+        return None
+    with open(path) as jsonfile:
+        course_ids = set(json.load(jsonfile))
+
+    language_en = PRADIGI_STRINGS[lang]['language_en']
+    for age_groups_subtree in get_template_for_lang()['children']:
+        for subject_subtree in age_groups_subtree['children']:
+            resources = get_resources_for_age_group_and_subject(
+                age_groups_subtree['title'], subject_subtree['title'], language_en)
+            course_ids.update(get_website_course_ids(lang, resources['website']))
+    return course_ids
+
+
+
+
 # CHEF
 ################################################################################
 
@@ -747,33 +916,104 @@ class PraDigiChef(JsonTreeChef):
     """
     RICECOOKER_JSON_TREE = 'pradigi_ricecooker_json_tree.json'
 
+    def __init__(self, *args, **kwargs):
+        super(PraDigiChef, self).__init__(*args, **kwargs)
+        self.arg_parser.add_argument('--offline', action='store_true',
+            help='Use the local snapshots of the structure and corrections sheets (see sheets.py)')
+
 
     def crawl(self, args, options):
         """
         Crawl website and save web resource trees in chefdata/trees/.
         """
+        from crawlengine import RequestBudget, DEFAULT_REQUEST_BUDGET
+        from requestscheduler import AdaptiveRequestScheduler
+        from resourcecache import ResourceIndex
+        import transform
         from pradigi_crawlers import PraDigiCrawler
-        
+
+        # max number of concurrent requests per host (default 1 = serial crawl)
+        max_in_flight_per_host = int(options.get('concurrency', 1))
+        # number of languages to crawl in parallel (default 1 = one after another)
+        parallel = int(options.get('parallel', 1))
+        # max number of concurrent requests shared by all language crawls
+        max_requests = int(options.get('budget', DEFAULT_REQUEST_BUDGET))
+        request_budget = RequestBudget(max_requests)
+        # use adaptive=t to adapt the number of concurrent requests (up to budget)
+        # to the server response times and errors, retrying failed requests
+        request_scheduler = None
+        if options.get('adaptive', False) in ['t', 'true', 'True', '1']:
+            request_scheduler = AdaptiveRequestScheduler(max_concurrency=max_requests)
+            transform.set_download_scheduler(request_scheduler)
+        # use incremental=t to only re-process the pages that changed since last crawl
+        incremental = options.get('incremental', False) in ['t', 'true', 'True', '1']
+        # use resume=t to continue the crawls from the last saved checkpoints
+        resume = options.get('resume', False) in ['t', 'true', 'True', '1']
+        # use stream=t to write the web resource trees while crawling (less memory)
+        stream_output = options.get('stream', False) in ['t', 'true', 'True', '1']
+        # use selective=t to crawl only the courses used in the channel structure
+        selective = options.get('selective', False) in ['t', 'true', 'True', '1']
+        # resources shared between languages are resolved only once per run
+        resource_index = ResourceIndex()
+        # the crawlers share one requests session and mount their adapters on it
+        # when created, so create them all here before any crawl uses the session
+        website_crawlers = dict((lang, PraDigiCrawler(lang=lang)) for lang in PRADIGI_WEBSITE_LANGUAGES)
+
+        def crawl_lang(lang):
+            start_time = time.time()
+            selected_course_ids = get_selected_course_ids(lang) if selective else None
+            website_crawler = website_crawlers[lang]
+            website_crawler.crawl(selected_course_ids=selected_course_ids,
+                                  max_in_flight_per_host=max_in_flight_per_host,
+                                  request_budget=request_budget,
+                                  incremental=incremental,
+                                  resume=resume,
+                                  resource_index=resource_index,
+                                  stream_output=stream_output,
+                                  request_scheduler=request_scheduler)    # Output is saved to appropriate wrt file
+            if selected_course_ids is None:
+                save_website_game_course_ids(lang)
+            return time.time() - start_time
+
         # website
+        crawl_start_time = time.time()
+        wall_times = {}
+        if parallel > 1:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = dict((lang, executor.submit(crawl_lang, lang)) for lang in PRADIGI_WEBSITE_LANGUAGES)
+                for lang, future in futures.items():
+                    wall_times[lang] = future.result()
+        else:
+            for lang in PRADIGI_WEBSITE_LANGUAGES:
+                wall_times[lang] = crawl_lang(lang)
         for lang in PRADIGI_WEBSITE_LANGUAGES:
-            website_crawler = PraDigiCrawler(lang=lang)
-            website_crawler.crawl()    # Output is saved to appropriate wrt file
+            LOGGER.info('Crawled lang {} in {:.1f}s'.format(lang, wall_times[lang]))
+        LOGGER.info('Crawled all languages in {:.1f}s'.format(time.time() - crawl_start_time))
+        LOGGER.info('Shared resource index: {} resources, {}'.format(
+            len(resource_index), dict(resource_index.stats)))
+        if request_scheduler is not None:
+            LOGGER.info('Adaptive request scheduler: ' + request_scheduler.summary())
 
         # extract
         website_games = {}
         for lang in PRADIGI_WEBSITE_LANGUAGES:
             lang_games = extract_website_games_from_tree(lang)
             website_games[lang] = lang_games
-        WEBSITE_GAMES_OUTPUT = 'chefdata/trees/website_games_all_langs.json'
         # Save website games
         with open(WEBSITE_GAMES_OUTPUT, 'w') as json_file:
             json.dump(website_games, json_file, ensure_ascii=False, indent=2, sort_keys=True)
+        # index website games by name for find_games_for_lang
+        get_website_game_index()
 
 
-    def build_subtree_for_lang(self, lang):
+    def build_subtree_for_lang(self, lang, zip_jobs=None):
+        """
+        Build the ricecooker json subtree for `lang`. Pass `zip_jobs` (a ZipFileJobs)
+        to collect the zip files to process instead of processing them now.
+        """
         LOGGER.info('Building subtree for lang {}'.format(lang))
         
-        lang_subtree = copy.deepcopy(TEMPLATE_FOR_LANG)
+        lang_subtree = copy.deepcopy(get_template_for_lang())
         lang_obj = getlang(lang)
         language_en = PRADIGI_STRINGS[lang]['language_en']
         first_native_name = lang_obj.native_name.split(',')[0].split('(')[0]
@@ -803,35 +1043,21 @@ class PraDigiChef(JsonTreeChef):
 
                 # A. Load website resources
                 if lang in PRADIGI_WEBSITE_LANGUAGES:
-                    for desired_subject_en in resources['website']:
-
-                        # Aug 27: custom logic to skip top-level vocational subjects
-                        #         since they are now subtopics under Vocational
-                        if lang in LANGS_WITH_NEW_VOCATIONAL_STRUCTURE:
-                            if desired_subject_en in VOCATIONAL_SUBJECTS:
-                                print('Skipping vocational subject', desired_subject_en, 'in', lang)
-                                continue
-
-                        # manual course_id rename for courses where subject_en not the same as cateogy_id
-                        lookup_table = PRADIGI_STRINGS[lang]['course_ids_by_subject_en']
-                        if desired_subject_en in lookup_table:
-                            desired_subject_en = lookup_table[desired_subject_en]
-                        #
+                    for desired_subject_en in get_website_course_ids(lang, resources['website']):
                         wrt_subtree = get_subtree_by_subject_en(lang, desired_subject_en)
                         if wrt_subtree:
-                            ricecooker_subtree = wrt_to_ricecooker_tree(wrt_subtree, lang)
                             # Set title to localized name obtained from website
-                            subject_subtree['title'] = ricecooker_subtree['title']
+                            subject_subtree['title'] = wrt_subtree['title']
                             # overwsite subject titles when translation is available
                             if subject_en in PRADIGI_STRINGS[lang]['subjects']:
                                 subject_subtree['title'] = PRADIGI_STRINGS[lang]['subjects'][subject_en]
-                            for child in ricecooker_subtree['children']:
-                                subject_subtree['children'].append(child)
+                            subject_subtree['children'].extend(
+                                iter_ricecooker_children(wrt_subtree, lang, zip_jobs=zip_jobs))
                         else:
                             print('no wrt for subject ' + desired_subject_en + ' in language ' + lang)
 
                 # Needed to avoid duplicates
-                web_resources_source_ids = [ch['source_id'] for ch in subject_subtree['children']]
+                web_resources_source_ids = set(ch['source_id'] for ch in subject_subtree['children'])
 
                 # B. Load game resources
                 game_rows = resources['games']
@@ -849,8 +1075,8 @@ class PraDigiChef(JsonTreeChef):
                             game_source_id  = game['source_id']
                             if game_source_id not in web_resources_source_ids:
                                 # website games:.
-                                node = website_game_webresouce_to_ricecooker_node(lang, game)
-                                web_resources_source_ids.append(game_source_id)
+                                node = website_game_webresouce_to_ricecooker_node(lang, game, zip_jobs=zip_jobs)
+                                web_resources_source_ids.add(game_source_id)
                             else:
                                 node = None
                         else:
@@ -888,6 +1114,39 @@ class PraDigiChef(JsonTreeChef):
         return lang_subtree
 
 
+    def build_subtrees(self, zip_jobs, build_workers=1):
+        """
+        Returns the list of the ricecooker json subtrees of all languages (in
+        the order of PRADIGI_WEBSITE_LANGUAGES) and adds the zip files they use
+        to `zip_jobs` (the zip files of the jobs already done are used as is).
+        Use `build_workers=N` to build N languages in parallel in a process pool
+        (same result as the serial build) that reads the packed web resource trees.
+        """
+        lang_subtrees = []
+        if build_workers > 1:
+            # build the tables once here so forked workers inherit them, and
+            # let spawned workers parse the sheet snapshots without revalidating
+            load_sheet_tables()
+            # the workers memory-map the packed web resource trees instead of
+            # each loading its own copy of the JSON trees
+            for lang in PRADIGI_WEBSITE_LANGUAGES:
+                if TREE_STORE.exists(lang):
+                    TREE_STORE.pack(lang)
+            with ProcessPoolExecutor(max_workers=build_workers,
+                                     initializer=init_build_worker,
+                                     initargs=(sheets.SHEET_SNAPSHOTS.get_checked(),)) as executor:
+                results = executor.map(build_subtree_for_lang_in_worker, PRADIGI_WEBSITE_LANGUAGES,
+                                       [zip_jobs]*len(PRADIGI_WEBSITE_LANGUAGES))
+                for lang_subtree, lang_zip_jobs in results:
+                    lang_subtrees.append(lang_subtree)
+                    zip_jobs.update(lang_zip_jobs)
+        else:
+            for lang in PRADIGI_WEBSITE_LANGUAGES:
+                lang_subtree = self.build_subtree_for_lang(lang, zip_jobs=zip_jobs)
+                lang_subtrees.append(lang_subtree)
+        return lang_subtrees
+
+
     def pre_run(self, args, options):
         """
         Build the ricecooker json tree for the entire channel
@@ -927,15 +1186,36 @@ class PraDigiChef(JsonTreeChef):
             language='mul',
             children=[],
         )
-        for lang in PRADIGI_WEBSITE_LANGUAGES:
-            lang_subtree = self.build_subtree_for_lang(lang)
-            ricecooker_json_tree['children'].append(lang_subtree)
+        # build the tree first to collect the zip files it uses and process them
+        # in a separate stage, then build it again with the zip file paths so the
+        # nodes whose zip file failed are skipped as if the zips were made inline
+        # use buildworkers=N to build the subtrees of N languages in parallel
+        build_workers = int(options.get('buildworkers', 1))
+        build_start_time = time.time()
+        zip_jobs = ZipFileJobs()
+        self.build_subtrees(zip_jobs, build_workers=build_workers)
+        LOGGER.info('Built ricecooker tree in {:.1f}s, processing {} zip files'.format(
+            time.time() - build_start_time, len(zip_jobs)))
+        # use zipworkers=N to process N zip files at a time in a process pool
+        zip_workers = int(options.get('zipworkers', 1))
+        zip_jobs.run_all(workers=zip_workers)
+        zip_jobs.save_report()
+        build_start_time = time.time()
+        lang_subtrees = self.build_subtrees(zip_jobs, build_workers=build_workers)
+        ricecooker_json_tree['children'].extend(lang_subtrees)
+        LOGGER.info('Built ricecooker tree with the zip files in {:.1f}s'.format(time.time() - build_start_time))
         json_tree_path = self.get_json_tree_path()
         write_tree_to_json_tree(json_tree_path, ricecooker_json_tree)
+        # save the placement plan used to build the tree (see structure.py)
+        get_placement_plan().save()
+        if HTTP_ARCHIVE is not None:
+            LOGGER.info('HTTP archive {}: {}'.format(HTTP_ARCHIVE.path, dict(HTTP_ARCHIVE.stats)))
 
 
     def run(self, args, options):
         print('options=', options, flush=True)
+        if args.get('offline', False):
+            sheets.set_offline()
         if 'crawlonly' in options:
             self.pre_run(args, options)
             print('Crawling done. Skipping rest of chef run since `crawlonly` is set.')
@@ -943,6 +1223,34 @@ class PraDigiChef(JsonTreeChef):
         super(PraDigiChef, self).run(args, options)
 
 
+def load_sheet_tables():
+    """
+    Build the cached tables derived from the structure and corrections sheets
+    (each is otherwise built the first time it is needed).
+    """
+    get_template_for_lang()
+    get_placement_plan()
+    get_corrections_rules()
+    get_website_game_name_index()
+
+
+def init_build_worker(checked_csv_paths):
+    """
+    Initializer of the worker processes of `PraDigiChef.build_subtrees`.
+    """
+    sheets.SHEET_SNAPSHOTS.mark_checked(checked_csv_paths)
+
+
+def build_subtree_for_lang_in_worker(lang, zip_jobs):
+    """
+    Build the subtree for `lang` in a worker process of `PraDigiChef.build_subtrees`
+    (`zip_jobs` is a copy of the parent's ZipFileJobs). Returns the subtree and
+    the ZipFileJobs it uses (both picklable).
+    """
+    lang_subtree = PraDigiChef().build_subtree_for_lang(lang, zip_jobs=zip_jobs)
+    return lang_subtree, zip_jobs
+
+
 
 
 # CLI
@@ -1,9 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import hashlib
+import json
 import logging
 import os
 import requests
 import shutil
 import tempfile
+import threading
+import time
 import zipfile
 from urllib.parse import urlparse
 
@@ -13,9 +17,9 @@ from ricecooker.utils.html import download_file
 from ricecooker.utils.zip import create_predictable_zip
 
 
-from corrections import (PRADIGI_CORRECTIONS_LIST, CORRECTIONS_ACTION_KEY,
-                         ADD_MARGIN_TOP_ACTION, CORRECTIONS_SOURCE_URL_PAT_KEY)
-from corrections import should_replace_with
+from corrections import classify, get_corrections_rules
+import httparchive
+from requestscheduler import AdaptiveRequestScheduler
 
 
 LOGGER.setLevel(logging.DEBUG)
@@ -31,8 +35,32 @@ HTML5APP_ZIPS_LOCAL_DIR = 'chefdata/zipfiles'
 # ZIP FILE DOWNLOADING, TRANFORMS, AND FIXUPS
 ################################################################################
 
+# Downloads adapt their concurrency to the server health and retry with backoff.
+# The scheduler is created when first needed (not on import), unless one shared
+# with the crawlers is set with `set_download_scheduler` to have one limit for all requests.
+_DOWNLOAD_SCHEDULER = None
+_DOWNLOAD_SCHEDULER_LOCK = threading.Lock()
+
+def get_download_scheduler():
+    """
+    Returns the AdaptiveRequestScheduler used for the zip file downloads.
+    """
+    global _DOWNLOAD_SCHEDULER
+    with _DOWNLOAD_SCHEDULER_LOCK:
+        if _DOWNLOAD_SCHEDULER is None:
+            _DOWNLOAD_SCHEDULER = AdaptiveRequestScheduler()
+        return _DOWNLOAD_SCHEDULER
+
+def set_download_scheduler(scheduler):
+    """
+    Use `scheduler` for the zip file downloads (None = create a new one when needed).
+    """
+    global _DOWNLOAD_SCHEDULER
+    with _DOWNLOAD_SCHEDULER_LOCK:
+        _DOWNLOAD_SCHEDULER = scheduler
+
 def make_request(url):
-    response = requests.get(url)
+    response = get_download_scheduler().run(lambda: requests.get(url), description='GET ' + url)
     if response.status_code != 200:
         LOGGER.error("ERROR when GETting: %s" % (url))
     return response
@@ -75,7 +103,7 @@ def get_zip_file(zip_file_url, main_file):
     destpath = make_temporary_dir_from_key(key)
     
     # Check for "REPLACE WITH:" correction rule for the current `zip_file_url`
-    replacement_url = should_replace_with(zip_file_url)
+    replacement_url = classify(zip_file_url)['replace_with']
     if replacement_url:
         zip_file_url = replacement_url
 
@@ -151,13 +179,7 @@ def get_zip_file(zip_file_url, main_file):
         os.rename(src, dest)
 
         # Logic to add margin-top:44px; for games that match Corrections tab
-        add_margin_top = False
-        for row in PRADIGI_CORRECTIONS_LIST:
-            if row[CORRECTIONS_ACTION_KEY] == ADD_MARGIN_TOP_ACTION:
-                pat = row[CORRECTIONS_SOURCE_URL_PAT_KEY]
-                m = pat.match(zip_file_url)
-                if m:
-                    add_margin_top = True
+        add_margin_top = classify(zip_file_url)['add_margin_top']
         if add_margin_top:
             if zip_file_url.endswith('CourseContent/Games/Mathematics.zip'):
                 LOGGER.info("adding body.margin-top:44px; to ALL .html files in: %s" % zip_file_url)
@@ -225,14 +247,14 @@ def get_phet_zip_file(zip_file_url, main_file_and_query):
       - Rename index.html to phetindex.thml
       - Add a custom index.html that uses javascrpt redirect to phetindex.thml?{sim_id}
     """
-    u = urlparse(main_file_and_query)
-    idk, sim_id = u.query.split('=')
-    assert idk == 'id', 'unknown query sting format found' + main_file_and_query
-    main_file = u.scheme + '://' + u.netloc + u.path  # skip querystring
-    
     destpath = tempfile.mkdtemp()
     LOGGER.info('saving phet zip file in dir ' + destpath)
     try:
+        u = urlparse(main_file_and_query)
+        idk, sim_id = u.query.split('=')
+        assert idk == 'id', 'unknown query sting format found' + main_file_and_query
+        main_file = u.scheme + '://' + u.netloc + u.path  # skip querystring
+
         download_file(zip_file_url, destpath, request_fn=make_request)
 
         zip_filename = zip_file_url.split('/')[-1]
@@ -266,3 +288,151 @@ def get_phet_zip_file(zip_file_url, main_file_and_query):
 
 
 
+
+
+
+# DEFERRED ZIP FILE JOBS
+################################################################################
+
+ZIP_JOB_PLACEHOLDER_PREFIX = 'zipjob:'
+ZIP_JOBS_REPORT_PATH = 'chefdata/trees/pradigi_zip_jobs_report.json'
+
+class ZipFileJob(object):
+    """
+    Handle for an HTML5 zip file to be produced later by `get_zip_file` (or by
+    `get_phet_zip_file` for phet simulations). Until then, the nodes that use it
+    have `placeholder` as the path of their zip file.
+    """
+
+    def __init__(self, zip_file_url, main_file):
+        self.zip_file_url = zip_file_url
+        self.main_file = main_file
+        self.key = zip_file_url + main_file
+        self.placeholder = ZIP_JOB_PLACEHOLDER_PREFIX + self.key
+        self.path = None    # path of the zip file (None if failed)
+        self.done = False
+        self.seconds = None  # time it took to produce the zip file
+
+    def run(self):
+        """
+        Produce the zip file. An error only fails this job: `path` stays None
+        and the nodes that use it are left out of the tree.
+        """
+        start_time = time.time()
+        try:
+            if 'phet.zip' in self.zip_file_url:
+                self.path = get_phet_zip_file(self.zip_file_url, self.main_file)
+            else:
+                self.path = get_zip_file(self.zip_file_url, self.main_file)
+        except Exception as e:
+            LOGGER.error('Failed to create zip file from %s %s: %s' % (self.zip_file_url, self.main_file, e))
+            self.path = None
+        finally:
+            self.done = True
+            self.seconds = time.time() - start_time
+        return self.path
+
+
+def init_zip_worker():
+    """
+    Initializer of the worker processes of `ZipFileJobs.run_all`.
+    """
+    # don't use the state (and locks) of the scheduler copied from the parent
+    set_download_scheduler(None)
+    archive = httparchive.get_installed_archive()
+    if archive is not None:
+        archive.reopen()
+
+
+def run_zip_file_job(job):
+    """
+    Run `job` in a worker process of `ZipFileJobs.run_all` and return it.
+    """
+    job.run()
+    return job
+
+
+class ZipFileJobs(object):
+    """
+    Ordered set of ZipFileJobs (one per zip file url and main file) collected
+    while building the ricecooker tree, so the zip files can be processed in a
+    separate stage. Once the jobs are done, building the tree again with the
+    same ZipFileJobs uses the zip file paths instead of the placeholders.
+    """
+
+    def __init__(self):
+        self.jobs = {}   # key --> ZipFileJob (in the order added)
+
+    def add(self, zip_file_url, main_file):
+        """
+        Returns the job for the zip file (creates it if needed).
+        """
+        job = ZipFileJob(zip_file_url, main_file)
+        return self.jobs.setdefault(job.key, job)
+
+    def update(self, other):
+        """
+        Add the jobs of the ZipFileJobs `other` (e.g. collected by another process).
+        """
+        for key, job in other.jobs.items():
+            self.jobs.setdefault(key, job)
+
+    def run_all(self, workers=1):
+        """
+        Produce the zip files of the jobs not done yet, `workers` at a time in
+        a process pool if `workers` > 1 (each job runs in one process).
+        """
+        if not os.path.exists(HTML5APP_ZIPS_LOCAL_DIR):
+            os.makedirs(HTML5APP_ZIPS_LOCAL_DIR, exist_ok=True)
+        pending_jobs = [job for job in self.jobs.values() if not job.done]
+        start_time = time.time()
+        if workers > 1 and len(pending_jobs) > 1:
+            get_corrections_rules()   # load once here so forked workers inherit it
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_zip_worker) as executor:
+                futures = dict((executor.submit(run_zip_file_job, job), job) for job in pending_jobs)
+                for future in as_completed(futures):
+                    try:
+                        done_job = future.result()
+                    except Exception as e:
+                        # the worker process died (job errors are handled in ZipFileJob.run)
+                        done_job = futures[future]
+                        LOGGER.error('Zip file job for %s %s failed in worker: %s' %
+                                     (done_job.zip_file_url, done_job.main_file, e))
+                        done_job.path = None
+                        done_job.done = True
+                        done_job.seconds = time.time() - start_time
+                    self.jobs[done_job.key] = done_job
+                    self.log_job(done_job)
+        else:
+            for job in pending_jobs:
+                job.run()
+                self.log_job(job)
+        wall_time = time.time() - start_time
+        done_jobs = [self.jobs[job.key] for job in pending_jobs]
+        LOGGER.info('Processed {} zip files in {:.1f}s with {} workers ({:.1f}s of job time, {} failed)'.format(
+            len(done_jobs), wall_time, max(workers, 1), sum(job.seconds for job in done_jobs),
+            len([job for job in done_jobs if job.path is None])))
+
+    def log_job(self, job):
+        LOGGER.info('Zip file job done in {:.1f}s ({}): {} {}'.format(
+            job.seconds, 'ok' if job.path else 'failed', job.zip_file_url, job.main_file))
+
+    def save_report(self, path=ZIP_JOBS_REPORT_PATH):
+        """
+        Save the timings and results of the jobs, slowest first.
+        """
+        report = []
+        for job in self.jobs.values():
+            report.append(dict(
+                zip_file_url=job.zip_file_url,
+                main_file=job.main_file,
+                path=job.path,
+                done=job.done,
+                seconds=job.seconds,
+            ))
+        report.sort(key=lambda entry: -(entry['seconds'] or 0))
+        with open(path, 'w') as json_file:
+            json.dump(report, json_file, ensure_ascii=False, indent=2)
+
+    def __len__(self):
+        return len(self.jobs)
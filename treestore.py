@@ -0,0 +1,143 @@
+"""
+Loaded-once store of the web resource trees produced by the crawlers, with
+indexes for the lookups done when building the ricecooker tree.
+"""
+import json
+import os
+import threading
+
+from packedtree import PackedTree, PACKED_TREE_EXT, pack_json_tree
+
+WEB_RESOURCE_TREE_PATH_TMPL = 'chefdata/trees/pradigi_{}_web_resource_tree.json'
+
+
+
+# INDEXED WEB RESOURCE TREE
+################################################################################
+
+class WebResourceTree(object):
+    """
+    Web resource tree of one language with dict indexes of its nodes by
+    `source_id`, `url`, and `kind` (built on first lookup), and of its top-level
+    subject subtrees by `subject_en` and `source_id`. The nodes are shared by all the users of the
+    tree so they must not be modified.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree           # root dict or PackedNode (see packedtree.py)
+        self.subjects = {}         # subject_en or source_id --> top-level subtree
+        self.by_source_id = None   # source_id --> first node in depth-first order
+        self.by_url = None         # url --> first node in depth-first order
+        self.by_kind = None        # kind --> list of nodes in depth-first order
+        self._lock = threading.Lock()
+        for subject_subtree in tree.get('children', []):
+            for key in ['subject_en', 'source_id']:
+                if key in subject_subtree:
+                    self.subjects.setdefault(subject_subtree[key], subject_subtree)
+
+    def build_indexes(self):
+        """
+        Builds the node indexes on first use, so building the ricecooker tree
+        from the subject subtrees only reads the nodes it uses.
+        """
+        with self._lock:
+            if self.by_kind is not None:
+                return
+            by_source_id, by_url, by_kind = {}, {}, {}
+            stack = [self.tree]
+            while stack:
+                node = stack.pop()
+                if 'source_id' in node:
+                    by_source_id.setdefault(node['source_id'], node)
+                if 'url' in node:
+                    by_url.setdefault(node['url'], node)
+                by_kind.setdefault(node.get('kind', None), []).append(node)
+                stack.extend(reversed(node.get('children', [])))
+            self.by_source_id, self.by_url, self.by_kind = by_source_id, by_url, by_kind
+
+    def get_subject_subtree(self, subject):
+        """
+        Returns the top-level subtree whose `subject_en` or `source_id` is `subject`.
+        """
+        return self.subjects.get(subject, None)
+
+    def get_by_source_id(self, source_id):
+        self.build_indexes()
+        return self.by_source_id.get(source_id, None)
+
+    def get_by_url(self, url):
+        self.build_indexes()
+        return self.by_url.get(url, None)
+
+    def get_by_kind(self, kind):
+        self.build_indexes()
+        return self.by_kind.get(kind, [])
+
+
+
+# TREE STORE
+################################################################################
+
+class WebResourceTreeStore(object):
+    """
+    Loads the web resource tree of each language once per process and keeps it
+    with its indexes. A tree is loaded again only if its file changed on disk
+    (e.g. after the crawl of that language). Safe to use from multiple threads.
+    If the packed tree of a language (see `pack`) is at least as new as its JSON
+    tree, the packed tree is memory-mapped instead of loading the JSON.
+    """
+
+    def __init__(self, path_tmpl=WEB_RESOURCE_TREE_PATH_TMPL):
+        self.path_tmpl = path_tmpl
+        self._trees = {}   # lang --> (file path and signature, WebResourceTree)
+        self._lock = threading.Lock()
+
+    def get_path(self, lang):
+        return self.path_tmpl.format(lang)
+
+    def get_packed_path(self, lang):
+        return os.path.splitext(self.get_path(lang))[0] + PACKED_TREE_EXT
+
+    def exists(self, lang):
+        return os.path.exists(self.get_path(lang))
+
+    def is_packed(self, lang):
+        """
+        Returns True if the packed tree for `lang` is up to date with the JSON tree.
+        """
+        packed_path = self.get_packed_path(lang)
+        return os.path.exists(packed_path) and \
+            os.stat(packed_path).st_mtime_ns >= os.stat(self.get_path(lang)).st_mtime_ns
+
+    def pack(self, lang):
+        """
+        Writes the packed tree for `lang` from the JSON tree unless it is up to
+        date, so that the processes that use the tree share one mapped copy.
+        """
+        with self._lock:
+            if not self.is_packed(lang):
+                pack_json_tree(self.get_path(lang), self.get_packed_path(lang))
+
+    def get_tree(self, lang):
+        """
+        Returns the WebResourceTree for `lang`.
+        """
+        with self._lock:
+            path = self.get_packed_path(lang) if self.is_packed(lang) else self.get_path(lang)
+            stat = os.stat(path)
+            signature = (path, stat.st_mtime_ns, stat.st_size)
+            if lang not in self._trees or self._trees[lang][0] != signature:
+                if path.endswith(PACKED_TREE_EXT):
+                    tree = PackedTree(path).root
+                else:
+                    with open(path) as jsonfile:
+                        tree = json.load(jsonfile)
+                self._trees[lang] = (signature, WebResourceTree(tree))
+            return self._trees[lang][1]
+
+    def clear(self):
+        with self._lock:
+            self._trees = {}
+
+
+TREE_STORE = WebResourceTreeStore()